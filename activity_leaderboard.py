@@ -0,0 +1,92 @@
+# activity_leaderboard.py
+import heapq
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import mysql.connector
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "Most active users" over rolling windows without scanning session history.
+#
+# user_activity_daily holds one counter row per user per day (sessions started,
+# pages viewed). session_tracker adds to it in the same batched transaction as
+# its user_sessions upsert, so nothing is written per request. Each worker
+# keeps the top ACTIVITY_TOPK_SIZE users for every window in memory. One
+# grouped query over the last max(ACTIVITY_WINDOWS) days refreshes them at
+# most every ACTIVITY_TOPK_TTL seconds, and heapq.nlargest picks the leaders,
+# so a dashboard read is a slice of a short list.
+#
+# Schema: add_user_activity_daily_table.sql
+ACTIVITY_WINDOWS = (7, 30, 90)
+ACTIVITY_TOPK_SIZE = int(os.getenv("ACTIVITY_TOPK_SIZE", "20"))
+ACTIVITY_TOPK_TTL = int(os.getenv("ACTIVITY_TOPK_TTL", "300"))
+
+_boards = {}  # window days -> [{"email", "sessions", "page_views"}, ...] best first
+_loaded_at = None
+_refresh_lock = threading.Lock()
+
+
+def add_activity(cursor, counts: dict):
+    """Adds {(date, email): (sessions, page_views)} to the daily counters. The caller commits."""
+    if not counts:
+        return
+    cursor.executemany("""
+        INSERT INTO user_activity_daily (activity_date, email, sessions, page_views)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE sessions = sessions + VALUES(sessions), page_views = page_views + VALUES(page_views)
+    """, [(day, email, sessions, page_views) for (day, email), (sessions, page_views) in counts.items()])
+
+
+def _load_boards(today) -> dict:
+    since = {days: today - timedelta(days=days - 1) for days in ACTIVITY_WINDOWS}
+    columns = ", ".join(
+        f"SUM(CASE WHEN activity_date >= %s THEN sessions ELSE 0 END), "
+        f"SUM(CASE WHEN activity_date >= %s THEN page_views ELSE 0 END)"
+        for _ in ACTIVITY_WINDOWS
+    )
+    params = [since[days] for days in ACTIVITY_WINDOWS for _ in range(2)]
+    conn = None
+    cursor = None
+    try:
+        conn = mysql.connector.connect(
+            host=os.getenv("DB_HOST"),
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASS"),
+            database=os.getenv("DB_NAME")
+        )
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT email, {columns}
+            FROM user_activity_daily
+            WHERE activity_date >= %s
+            GROUP BY email
+        """, tuple(params) + (since[max(ACTIVITY_WINDOWS)],))
+        rows = cursor.fetchall()
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+
+    boards = {}
+    for i, days in enumerate(ACTIVITY_WINDOWS):
+        s, p = 1 + 2 * i, 2 + 2 * i
+        leaders = heapq.nlargest(ACTIVITY_TOPK_SIZE, (r for r in rows if r[s]), key=lambda r: (r[s], r[p]))
+        boards[days] = [{"email": r[0], "sessions": int(r[s]), "page_views": int(r[p])} for r in leaders]
+    return boards
+
+
+def top_users(window_days: int = 30, k: int = 5) -> list:
+    """The k most active users over the last window_days days (sessions, then pages viewed)."""
+    global _boards, _loaded_at
+    if window_days not in ACTIVITY_WINDOWS:
+        raise ValueError(f"window_days must be one of {ACTIVITY_WINDOWS}")
+    if _loaded_at is None or time.monotonic() - _loaded_at > ACTIVITY_TOPK_TTL:
+        with _refresh_lock:
+            # Another thread may have refreshed while we waited
+            if _loaded_at is None or time.monotonic() - _loaded_at > ACTIVITY_TOPK_TTL:
+                _boards = _load_boards(datetime.utcnow().date())
+                _loaded_at = time.monotonic()
+    return [dict(entry, count=entry["sessions"]) for entry in _boards.get(window_days, [])[:k]]
@@ -0,0 +1,129 @@
+# activity_sketches.py
+import threading
+from datetime import datetime, timedelta
+
+from hyperloglog import HyperLogLog
+
+# Distinct-count sketches of site activity, one HyperLogLog per UTC day per
+# metric:
+#   users             - logged-in users seen
+#   ips               - client IPs seen (all traffic)
+#   path_users:/xyz   - logged-in users per top-level path ("/admin/user/..." → "/admin")
+# The page-view middleware calls observe(), which only updates in-memory
+# sketches. session_tracker's periodic flush merges them into
+# activity_sketches within its own transaction: the stored rows are locked,
+# the registers max-merged, and the result written back, so every worker's
+# contribution survives. A window count (DAU/WAU/MAU, unique IPs) fetches at
+# most one small row per day and merges them in about a millisecond.
+#
+# Schema: add_activity_sketches_table.sql
+MAX_PATHS_PER_DAY = 200  # Per worker; later paths are folded into "path_users:other"
+
+_pending = {}  # (day, metric) -> HyperLogLog
+_lock = threading.Lock()
+
+
+def path_key(path: str) -> str:
+    segment = path.strip("/").split("/", 1)[0]
+    return f"/{segment}" if segment else "/"
+
+
+def _sketch(day, metric) -> HyperLogLog:
+    sketch = _pending.get((day, metric))
+    if sketch is None:
+        sketch = _pending[(day, metric)] = HyperLogLog()
+    return sketch
+
+
+def observe(email: str = None, ip: str = None, path: str = None, now: datetime = None):
+    """Adds one request to today's sketches. Memory only."""
+    day = (now or datetime.utcnow()).date()
+    with _lock:
+        if ip:
+            _sketch(day, "ips").add(ip)
+        if email:
+            email = email.lower()
+            _sketch(day, "users").add(email)
+            if path:
+                metric = f"path_users:{path_key(path)}"
+                if (day, metric) not in _pending and sum(1 for d, m in _pending if d == day and m.startswith("path_users:")) >= MAX_PATHS_PER_DAY:
+                    metric = "path_users:other"
+                _sketch(day, metric).add(email)
+
+
+def take() -> dict:
+    """Hands over the pending sketches for a flush."""
+    global _pending
+    with _lock:
+        taken, _pending = _pending, {}
+    return taken
+
+
+def restore(taken: dict):
+    """Merges sketches from a failed flush back into the pending set."""
+    with _lock:
+        for key, sketch in taken.items():
+            current = _pending.get(key)
+            _pending[key] = sketch if current is None else current.merge(sketch)
+
+
+def write(cursor, taken: dict):
+    """Merges taken sketches into the stored ones. Runs inside the caller's transaction."""
+    if not taken:
+        return
+    keys = list(taken)
+    where = " OR ".join(["(day = %s AND metric = %s)"] * len(keys))
+    cursor.execute(f"SELECT day, metric, registers FROM activity_sketches WHERE {where} FOR UPDATE",
+                   tuple(v for key in keys for v in key))
+    stored = {(day, metric): HyperLogLog.from_bytes(registers) for day, metric, registers in cursor.fetchall()}
+    rows = []
+    for key, sketch in taken.items():
+        merged = stored[key].merge(sketch) if key in stored else sketch
+        rows.append((key[0], key[1], merged.to_bytes()))
+    cursor.executemany("""
+        INSERT INTO activity_sketches (day, metric, registers) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE registers = VALUES(registers)
+    """, rows)
+
+
+def _merged_counts(cursor, metrics: list, today, windows: dict) -> dict:
+    """{name: distinct count} for windows {name: (metric, days)} ending today."""
+    since = today - timedelta(days=max(days for _, days in windows.values()) - 1)
+    cursor.execute(f"""
+        SELECT metric, day, registers FROM activity_sketches
+        WHERE metric IN ({', '.join(['%s'] * len(metrics))}) AND day >= %s
+    """, tuple(metrics) + (since,))
+    sketches = [(metric, day, HyperLogLog.from_bytes(registers)) for metric, day, registers in cursor.fetchall()]
+    counts = {}
+    for name, (metric, days) in windows.items():
+        start = today - timedelta(days=days - 1)
+        merged = HyperLogLog()
+        for m, day, sketch in sketches:
+            if m == metric and day >= start:
+                merged.merge(sketch)
+        counts[name] = merged.count()
+    return counts
+
+
+def active_counts(cursor, today=None) -> dict:
+    """DAU/WAU/MAU and 30-day unique IPs, using an existing cursor."""
+    today = today or datetime.utcnow().date()
+    return _merged_counts(cursor, ["users", "ips"], today, {
+        "dau": ("users", 1), "wau": ("users", 7), "mau": ("users", 30), "unique_ips_30d": ("ips", 30),
+    })
+
+
+def distinct_count(cursor, metric: str, days: int, today=None) -> int:
+    """Distinct count of one metric over the last `days` days."""
+    today = today or datetime.utcnow().date()
+    return _merged_counts(cursor, [metric], today, {"count": (metric, days)})["count"]
+
+
+def daily_counts(cursor, metric: str, since, today=None) -> dict:
+    """{day: distinct count} of one metric for each stored day from `since` to today."""
+    today = today or datetime.utcnow().date()
+    cursor.execute("""
+        SELECT day, registers FROM activity_sketches
+        WHERE metric = %s AND day BETWEEN %s AND %s
+    """, (metric, since, today))
+    return {day: HyperLogLog.from_bytes(registers).count() for day, registers in cursor.fetchall()}
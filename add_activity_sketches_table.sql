@@ -0,0 +1,8 @@
+-- Daily HyperLogLog sketches of distinct users/IPs (see activity_sketches.py).
+-- registers is a zlib-compressed 4 KB sketch, usually well under 2 KB stored.
+CREATE TABLE IF NOT EXISTS activity_sketches (
+    metric VARCHAR(191) NOT NULL,
+    day DATE NOT NULL,
+    registers BLOB NOT NULL,
+    PRIMARY KEY (metric, day)
+);
@@ -0,0 +1,20 @@
+-- Normalized audit_logs action category (see auth_utils.audit_category), written by log_action.
+-- Per-user counts such as password reset events become an index lookup instead of LIKE '%RESET_PASSWORD%'.
+ALTER TABLE audit_logs ADD COLUMN IF NOT EXISTS category VARCHAR(32) DEFAULT NULL;
+
+-- One-time backfill of rows logged before the column existed
+UPDATE audit_logs SET category = CASE
+    WHEN UPPER(action) LIKE '%RESET_PASSWORD%' OR UPPER(action) = 'PASSWORD_RESET' THEN 'password_reset'
+    WHEN UPPER(action) LIKE 'ADMIN\_%' OR UPPER(action) IN ('BAN_USER', 'UNBAN_USER') THEN 'admin'
+    WHEN UPPER(action) IN ('LOGIN', 'LOGOUT', 'LOGIN_FAILURE', 'ACCOUNT_LOCKED') THEN 'auth'
+    WHEN UPPER(action) IN ('REGISTER_SUCCESS', 'REGISTER_FAILURE', 'PROFILE_UPDATED',
+                           'CHANGE_PASSWORD_SUCCESS', 'CHANGE_PASSWORD_FAILURE') THEN 'account'
+    WHEN UPPER(action) IN ('SUBSCRIPTION_STARTED', 'CHURN') THEN 'billing'
+    ELSE 'other'
+END
+WHERE category IS NULL;
+
+-- Reset counts per user
+CREATE INDEX IF NOT EXISTS idx_audit_logs_email_category ON audit_logs (email, category);
+-- Per-user event history, newest first; InnoDB appends the id primary key as the keyset tie-breaker.
+CREATE INDEX IF NOT EXISTS idx_audit_logs_email_timestamp ON audit_logs (email, timestamp);
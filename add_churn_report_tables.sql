@@ -0,0 +1,9 @@
+-- Churn report support (see churn_report.py).
+-- Keyset pagination walks this index newest-first; InnoDB appends the id primary key as the tie-breaker.
+CREATE INDEX IF NOT EXISTS idx_audit_logs_action_timestamp ON audit_logs (action, timestamp);
+
+-- Churn events per calendar month, folded in incrementally from audit_logs
+CREATE TABLE IF NOT EXISTS churn_monthly (
+    month DATE NOT NULL PRIMARY KEY,
+    churned INT NOT NULL DEFAULT 0
+);
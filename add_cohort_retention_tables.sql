@@ -0,0 +1,21 @@
+-- Signup cohort retention matrix maintained by cohort_retention.py.
+-- cohort_retention holds one counter per (signup month, metric, months since signup):
+--   signups   - users who signed up in the cohort month (months_since is always 0)
+--   converted - users whose first premium start fell in that month offset
+--   premium   - net change in premium users at that offset (+1 start, -1 churn);
+--               the running sum over months_since is the number still premium
+CREATE TABLE IF NOT EXISTS cohort_retention (
+    cohort_month DATE NOT NULL,
+    metric VARCHAR(20) NOT NULL,
+    months_since SMALLINT NOT NULL,
+    users INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (cohort_month, metric, months_since)
+);
+
+-- Per-user state so replayed or duplicate audit events are only counted once
+CREATE TABLE IF NOT EXISTS cohort_user_state (
+    email VARCHAR(255) NOT NULL PRIMARY KEY,
+    cohort_month DATE NOT NULL,
+    is_premium TINYINT(1) NOT NULL DEFAULT 0,
+    converted_month DATE DEFAULT NULL
+);
@@ -0,0 +1,20 @@
+-- Append-only ledger of paid Stripe invoices (see invoice_ledger.py).
+-- Amounts are in minor units (pence/cents); times are UTC.
+CREATE TABLE IF NOT EXISTS invoice_ledger (
+    invoice_id VARCHAR(255) NOT NULL PRIMARY KEY,
+    customer_id VARCHAR(255) DEFAULT NULL,
+    subscription_id VARCHAR(255) DEFAULT NULL,
+    customer_email VARCHAR(255) DEFAULT NULL,
+    amount_paid INT NOT NULL,
+    currency CHAR(3) NOT NULL,
+    period_start DATETIME DEFAULT NULL,
+    period_end DATETIME DEFAULT NULL,
+    paid_at DATETIME NOT NULL,
+    price_id VARCHAR(255) DEFAULT NULL,
+    plan VARCHAR(50) DEFAULT NULL,
+    billing_reason VARCHAR(50) DEFAULT NULL,
+    recorded_at DATETIME NOT NULL,
+    INDEX idx_invoice_ledger_paid_at (currency, paid_at),
+    INDEX idx_invoice_ledger_customer (customer_id, paid_at),
+    INDEX idx_invoice_ledger_period (currency, period_end, period_start)
+);
@@ -0,0 +1,6 @@
+-- Resume cursors for long-running batch jobs (see job_checkpoints.py)
+CREATE TABLE IF NOT EXISTS job_checkpoints (
+    job_name VARCHAR(100) NOT NULL PRIMARY KEY,
+    cursor_value VARCHAR(255) DEFAULT NULL,
+    updated_at DATETIME NOT NULL
+);
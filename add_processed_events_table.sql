@@ -0,0 +1,9 @@
+-- Idempotency claims for Stripe webhook deliveries (see event_store.py); pruned after EVENT_STORE_RETENTION_DAYS
+CREATE TABLE IF NOT EXISTS processed_events (
+    event_id VARCHAR(255) NOT NULL,
+    endpoint VARCHAR(50) NOT NULL,
+    event_type VARCHAR(100) NOT NULL,
+    claimed_at DATETIME NOT NULL,
+    PRIMARY KEY (event_id, endpoint),
+    INDEX idx_processed_events_claimed (claimed_at)
+);
@@ -0,0 +1,18 @@
+-- Page traffic rollups (see traffic_rollups.py), written by the session tracker's batched flush.
+-- The admin traffic dashboard reads only these and activity_sketches, never raw page_views.
+-- segment is 'anonymous', 'free' or 'premium'.
+CREATE TABLE IF NOT EXISTS traffic_hourly (
+    hour DATETIME NOT NULL,
+    segment VARCHAR(16) NOT NULL,
+    views INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (hour, segment)
+);
+
+-- path is the matched route template, so rows per day are bounded by the number of routes
+CREATE TABLE IF NOT EXISTS traffic_paths_daily (
+    day DATE NOT NULL,
+    path VARCHAR(191) NOT NULL,
+    segment VARCHAR(16) NOT NULL,
+    views INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, path, segment)
+);
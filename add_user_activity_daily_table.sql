@@ -0,0 +1,8 @@
+-- Per-user daily activity counters (see activity_leaderboard.py), filled by session_tracker.py flushes
+CREATE TABLE IF NOT EXISTS user_activity_daily (
+    activity_date DATE NOT NULL,
+    email VARCHAR(255) NOT NULL,
+    sessions INT NOT NULL DEFAULT 0,
+    page_views INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (activity_date, email)
+);
@@ -0,0 +1,15 @@
+-- Sessions tracked from request traffic (see session_tracker.py); times are UTC.
+-- ended_at stays NULL while the session is active; idle sessions are closed at their last request.
+-- Closed rows are never reopened: a resumed cookie starts a new row and the closed one moves to a derived ID.
+CREATE TABLE IF NOT EXISTS user_sessions (
+    session_id CHAR(32) NOT NULL PRIMARY KEY,
+    email VARCHAR(255) NOT NULL,
+    started_at DATETIME NOT NULL,
+    last_seen_at DATETIME NOT NULL,
+    ended_at DATETIME DEFAULT NULL,
+    duration_seconds INT NOT NULL DEFAULT 0,
+    page_views INT NOT NULL DEFAULT 0,
+    INDEX idx_user_sessions_email (email, started_at),
+    INDEX idx_user_sessions_started (started_at),
+    INDEX idx_user_sessions_open (ended_at, last_seen_at)
+);
@@ -0,0 +1,2 @@
+-- Webhooks resolve users by Stripe customer ID (see customer_resolver.py)
+CREATE INDEX IF NOT EXISTS idx_users_stripe_customer ON users (stripe_customer_id);
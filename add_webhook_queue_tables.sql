@@ -0,0 +1,25 @@
+-- Durable ingest queue for Stripe webhook events (see webhook_queue.py)
+CREATE TABLE IF NOT EXISTS stripe_webhook_events (
+    event_id VARCHAR(255) NOT NULL PRIMARY KEY,
+    event_type VARCHAR(100) NOT NULL,
+    payload MEDIUMTEXT NOT NULL,
+    customer_id VARCHAR(255) DEFAULT NULL,
+    object_id VARCHAR(255) DEFAULT NULL,
+    event_created BIGINT DEFAULT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    next_attempt_at DATETIME NOT NULL,
+    locked_at DATETIME DEFAULT NULL,
+    last_error TEXT DEFAULT NULL,
+    received_at DATETIME NOT NULL,
+    processed_at DATETIME DEFAULT NULL,
+    INDEX idx_webhook_events_status_next (status, next_attempt_at),
+    INDEX idx_webhook_events_received (received_at),
+    INDEX idx_webhook_events_customer (customer_id, status)
+);
+
+-- Upgrade for tables created before per-customer partitioning
+ALTER TABLE stripe_webhook_events ADD COLUMN IF NOT EXISTS customer_id VARCHAR(255) DEFAULT NULL;
+ALTER TABLE stripe_webhook_events ADD COLUMN IF NOT EXISTS object_id VARCHAR(255) DEFAULT NULL;
+ALTER TABLE stripe_webhook_events ADD COLUMN IF NOT EXISTS event_created BIGINT DEFAULT NULL;
+CREATE INDEX IF NOT EXISTS idx_webhook_events_customer ON stripe_webhook_events (customer_id, status);
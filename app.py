@@ -2,12 +2,13 @@
 import os
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, Form, Depends, HTTPException
+from fastapi import FastAPI, Request, Form, Depends, HTTPException, UploadFile, File
 from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.concurrency import run_in_threadpool
 import mysql.connector
 import bcrypt
 from typing import Optional
@@ -17,12 +18,26 @@ from slowapi import Limiter
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 import stripe
+import stripe_client
 from auth_utils import verify_user, create_user, get_admin_stats, update_user_status, admin_reset_password, log_action
+from entitlement_cache import get_entitlement, invalidate_entitlement
+from customer_resolver import customer_for_email
+from bulk_import import parse_rows, import_users
+import invalidation_bus
+import webhook_queue
+import plan_catalog
+import invoice_ledger
+import subscription_analytics
+import cohort_retention
+import churn_report
+import session_tracker
+import activity_leaderboard
+import activity_sketches
+import user_activity
+import traffic_rollups
+import event_store
 from stripe_payments import router as stripe_payments_router
-from stripe_webhook import router as stripe_webhook_router
-
-# load your Stripe secret key from .env
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+from stripe_webhook import router as stripe_webhook_router, handle_event as handle_stripe_event
 
 # for creating customer portal sessions
 STRIPE_PORTAL_RETURN_URL = os.getenv("STRIPE_PORTAL_RETURN_URL", "https://cricketstatspack.com/billing")
@@ -63,6 +78,14 @@ class PageViewLoggerMiddleware(BaseHTTPMiddleware):
             if path.startswith("/static") or path == "/api/webhook":
                  return response
 
+            # Heartbeat for the session tracker, distinct-count sketches and traffic rollups (in memory; flushed in batches)
+            activity_sketches.observe(email, ip, path)
+            route = request.scope.get("route")
+            traffic_rollups.record(getattr(route, "path", None),
+                                   traffic_rollups.segment_for(email, session.get("is_premium", False)))
+            if email:
+                session_tracker.touch(session_tracker.session_id_for(email, session.get("login_time")), email)
+
             conn = None
             cursor = None
             try:
@@ -120,6 +143,42 @@ app.add_middleware(PageViewLoggerMiddleware)
 app.include_router(stripe_payments_router)
 app.include_router(stripe_webhook_router)
 
+# Join the cross-worker cache invalidation bus (runs per worker, after the Gunicorn fork)
+@app.on_event("startup")
+async def start_invalidation_bus():
+    invalidation_bus.start()
+
+@app.on_event("shutdown")
+async def stop_invalidation_bus():
+    invalidation_bus.stop()
+
+# Keeps the plan catalog in step with the prices configured in Stripe
+@app.on_event("startup")
+async def start_plan_catalog_refresh():
+    plan_catalog.start_refresh()
+
+@app.on_event("shutdown")
+async def stop_plan_catalog_refresh():
+    plan_catalog.stop_refresh()
+
+# Background workers that drain the durable Stripe webhook queue
+@app.on_event("startup")
+async def start_webhook_workers():
+    webhook_queue.start_workers(handle_stripe_event)
+
+@app.on_event("shutdown")
+async def stop_webhook_workers():
+    webhook_queue.stop_workers()
+
+# Batched writer for request-driven session tracking
+@app.on_event("startup")
+async def start_session_tracker():
+    session_tracker.start()
+
+@app.on_event("shutdown")
+async def stop_session_tracker():
+    session_tracker.stop()
+
 # your existing mounts & templates
 templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -181,7 +240,7 @@ async def login_submit(request: Request, email: str = Form(...), password: str =
                 log_action(email, "LOGIN_FAILURE", "Account locked")
                 return templates.TemplateResponse("login.html", {"request": request, "error": error_message}, status_code=403)
 
-        is_valid_user = verify_user(email, password)
+        is_valid_user = await run_in_threadpool(verify_user, email, password)
 
         if is_valid_user:
             print(f"âœ… Login success for {email} â€” redirecting to dashboard")
@@ -288,6 +347,7 @@ async def register_submit(
         if user:
             request.session["user_id"] = user["email"]
             request.session["is_premium"] = bool(user.get("is_premium", False))
+            request.session["login_time"] = datetime.utcnow().isoformat()
             log_action(user["email"], "login", "User logged in successfully (auto-login after registration)")
             print(f"âœ… Session set for auto-login: {user['email']}, Premium: {request.session['is_premium']}")
             return RedirectResponse("/dashboard", status_code=302)
@@ -312,12 +372,12 @@ async def subscribe_page(request: Request):
         return RedirectResponse("/login")
     return templates.TemplateResponse("subscribe.html", {
         "request": request,
-        "monthly_price_id": os.getenv("STRIPE_PRICE_ID_MONTHLY"),
-        "annual_price_id": os.getenv("STRIPE_PRICE_ID_ANNUAL"),
+        "monthly_plan": plan_catalog.plan("monthly"),
+        "annual_plan": plan_catalog.plan("annual"),
     })
 
 
-# Updated dashboard route to always check DB and update session using email
+# Updated dashboard route to refresh premium status from the entitlement cache
 @app.get("/dashboard", response_class=HTMLResponse)
 async def dashboard(request: Request):
     user_email = request.session.get("user_id")
@@ -328,18 +388,10 @@ async def dashboard(request: Request):
         return RedirectResponse("/login", status_code=303)
     
     try:
-        conn = mysql.connector.connect(
-            host=os.getenv("DB_HOST"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASS"),
-            database=os.getenv("DB_NAME")
-        )
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT is_premium FROM users WHERE email = %s", (user_email,))
-        user = cursor.fetchone()
+        entitlement = get_entitlement(user_email)
 
-        if user:
-            request.session["is_premium"] = bool(user.get("is_premium"))
+        if entitlement:
+            request.session["is_premium"] = entitlement["is_premium"]
         else:
             logger.warning(f"User with email {user_email} found in session but not in DB during dashboard load.")
             request.session["is_premium"] = False
@@ -350,11 +402,6 @@ async def dashboard(request: Request):
     except Exception as e:
         logger.error(f"Dashboard DB check failed unexpectedly for {user_email}: {e}")
         request.session["is_premium"] = request.session.get("is_premium", False)
-    finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
 
     return templates.TemplateResponse("dashboard.html", {"request": request})
 
@@ -367,6 +414,7 @@ async def logout(request: Request):
 
     if email:
         log_action(email, "logout", "User logged out")
+        session_tracker.end(session_tracker.session_id_for(email, login_time_str), email)
 
     if email and login_time_str:
         try:
@@ -650,7 +698,7 @@ async def change_password_submit(
 
     email = request.session["user_id"]
 
-    if not verify_user(email, current_password):
+    if not await run_in_threadpool(verify_user, email, current_password):
         print(f"Change password failed for {email}: Incorrect current password.")
         log_action(email, "CHANGE_PASSWORD_FAILURE", "Incorrect current password")
         return templates.TemplateResponse("change_password.html", {
@@ -789,6 +837,7 @@ async def profile_update(
              WHERE email             = %s
         """, (display_name, int(bool(notify_newsletter)), user_email))
         conn.commit()
+        invalidation_bus.publish("user", user_email)
         
         logger.info(f"Profile updated successfully for user: {user_email}")
         logger.debug(f"Profile update details: name='{display_name}', newsletter={notify_newsletter}")
@@ -817,22 +866,13 @@ async def billing(request: Request):
     
     # Check if user is premium and get Stripe customer ID
     try:
-        conn = mysql.connector.connect(
-            host=os.getenv("DB_HOST"), user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASS"), database=os.getenv("DB_NAME")
-        )
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(
-            "SELECT is_premium, stripe_customer_id FROM users WHERE email = %s", 
-            (user_email,)
-        )
-        user_data = cursor.fetchone()
+        user_data = get_entitlement(user_email)
         
         if not user_data:
             logger.warning(f"User {user_email} not found in database")
             return RedirectResponse(url="/profile", status_code=302)
         
-        is_premium = bool(user_data["is_premium"])
+        is_premium = user_data["is_premium"]
         stripe_customer_id = user_data["stripe_customer_id"]
         
         logger.debug(f"User {user_email} - Premium: {is_premium}, Stripe ID: {stripe_customer_id}")
@@ -840,11 +880,6 @@ async def billing(request: Request):
     except Exception as e:
         logger.error(f"Error fetching user data for {user_email}: {e}")
         return RedirectResponse(url="/profile", status_code=302)
-    finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
     
     # If user is not premium, redirect to profile
     if not is_premium:
@@ -852,57 +887,28 @@ async def billing(request: Request):
         return RedirectResponse(url="/profile", status_code=302)    
     # For premium users, redirect to Stripe Customer Portal
     try:
-        # Try with existing customer ID first
-        if stripe_customer_id:
-            logger.debug(f"Creating customer portal session for existing customer {stripe_customer_id}")
-            portal_session = stripe.billing_portal.Session.create(
-                customer=stripe_customer_id,
-                return_url=STRIPE_PORTAL_RETURN_URL
-            )
-            logger.info(f"Redirecting premium user {user_email} to Stripe Customer Portal")
-            return RedirectResponse(url=portal_session.url, status_code=302)
-        
-        # If no customer ID, search by email
-        else:
-            logger.debug(f"No stored customer ID, searching Stripe by email: {user_email}")
-            customers = stripe.Customer.list(email=user_email, limit=1).data
-            if customers:
-                cust_id = customers[0].id
-                logger.info(f"Found Stripe customer by email search: {cust_id}")
-                
-                # Update database with found customer ID
-                try:
-                    conn = mysql.connector.connect(
-                        host=os.getenv("DB_HOST"), user=os.getenv("DB_USER"),
-                        password=os.getenv("DB_PASS"), database=os.getenv("DB_NAME")
-                    )
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        "UPDATE users SET stripe_customer_id = %s WHERE email = %s",
-                        (cust_id, user_email)
-                    )
-                    conn.commit()
-                    logger.debug(f"Updated database with customer ID {cust_id} for {user_email}")
-                except Exception as db_err:
-                    logger.error(f"Error updating customer ID for {user_email}: {db_err}")
-                finally:
-                    if cursor:
-                        cursor.close()
-                    if conn and conn.is_connected():
-                        conn.close()
-                
-                # Create portal session
-                portal_session = stripe.billing_portal.Session.create(
-                    customer=cust_id,
-                    return_url=STRIPE_PORTAL_RETURN_URL
-                )
-                logger.info(f"Redirecting premium user {user_email} to Stripe Customer Portal (found by email)")
-                return RedirectResponse(url=portal_session.url, status_code=302)
-            else:
-                logger.warning(f"Premium user {user_email} has no Stripe customer ID and none found by email")
-                # Redirect to subscribe page to set up billing
-                return RedirectResponse(url="/subscribe", status_code=302)
-                
+        # Stored customer ID first; otherwise the resolver searches Stripe once and stores the result
+        cust_id = stripe_customer_id or await stripe_client.arun(customer_for_email, user_email)
+        if not cust_id:
+            logger.warning(f"Premium user {user_email} has no Stripe customer ID and none found by email")
+            # Redirect to subscribe page to set up billing
+            return RedirectResponse(url="/subscribe", status_code=302)
+
+        logger.debug(f"Creating customer portal session for customer {cust_id}")
+        portal_session = await stripe_client.acall("portal.create", stripe.billing_portal.Session.create,
+            customer=cust_id,
+            return_url=STRIPE_PORTAL_RETURN_URL
+        )
+        logger.info(f"Redirecting premium user {user_email} to Stripe Customer Portal")
+        return RedirectResponse(url=portal_session.url, status_code=302)
+
+    except stripe_client.StripeUnavailable:
+        logger.warning(f"Stripe circuit open; billing unavailable for {user_email}")
+        return templates.TemplateResponse("error.html", {
+            "request": request,
+            "error_title": "Billing temporarily unavailable",
+            "error_message": "Our payment provider is having problems right now. Your subscription is unaffected; please try again in a few minutes."
+        }, status_code=503)
     except stripe.error.StripeError as stripe_err:
         logger.error(f"Stripe API error for user {user_email}: {str(stripe_err)}")
         return templates.TemplateResponse("error.html", {
@@ -937,7 +943,7 @@ async def billing(request: Request):
 # --- Admin Dashboard Route ---
 
 @app.get("/admin", response_class=HTMLResponse)
-async def admin_dashboard(request: Request):
+async def admin_dashboard(request: Request, window: int = 30):
     user_email = request.session.get("user_id")
     logger.info(f"Admin dashboard access attempt by: {user_email or 'Not logged in'}")
     
@@ -947,7 +953,9 @@ async def admin_dashboard(request: Request):
         
         # Try to get admin stats, with fallback for local development
         try:
-            stats, users = get_admin_stats()
+            if window not in activity_leaderboard.ACTIVITY_WINDOWS:
+                window = 30
+            stats, users = get_admin_stats(activity_window_days=window)
             logger.debug(f"Admin stats fetched from database. Number of users: {len(users) if users else 0}")
         except Exception as db_error:
             logger.warning(f"Database error in admin dashboard: {db_error}")
@@ -1080,6 +1088,7 @@ async def reset_user_password(
 
         if cursor.rowcount > 0:
              print(f"ðŸ” Admin reset password for {email}")
+             invalidation_bus.publish("user", email)
              success = True
         else:
              print(f"âš ï¸ Admin password reset: User {email} not found or DB error.")
@@ -1162,7 +1171,7 @@ async def view_user_details(email: str, request: Request):
         cursor.execute("""
             SELECT COUNT(*) AS count
             FROM audit_logs
-            WHERE email=%s AND action LIKE '%RESET_PASSWORD%'
+            WHERE email=%s AND category = 'password_reset'
         """, (email,))
         result = cursor.fetchone()
         reset_activity_count = result['count'] if result else 0
@@ -1184,17 +1193,144 @@ async def view_user_details(email: str, request: Request):
         "logs": audit_logs,
         "reset_activity_count": reset_activity_count
     })
+
+@app.get("/admin/user/{email}/activity")
+async def view_user_activity(email: str, request: Request, sessions_before: Optional[str] = None,
+                             events_before: Optional[str] = None):
+    """Account summary, sessions and audit events for one user, a keyset page of each list at a time."""
+    verify_admin(request)
+
+    try:
+        if sessions_before:
+            user_activity.decode_cursor(sessions_before)
+        if events_before:  # Audit event cursors end in the numeric row id
+            int(user_activity.decode_cursor(events_before)[1])
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid page cursor.")
+
+    try:
+        activity = await run_in_threadpool(user_activity.fetch, email, sessions_before, events_before)
+    except mysql.connector.Error as err:
+        print(f"🔥 DB Error fetching user activity for {email}: {err}")
+        raise HTTPException(status_code=500, detail="Database error fetching user activity.")
+    if not activity:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    user = activity["user"]
+    user["created_at_formatted"] = user["created_at"].strftime('%Y-%m-%d %H:%M:%S UTC') if user.get("created_at") else None
+    user["current_period_end_formatted"] = user["current_period_end"].strftime('%Y-%m-%d') if user.get("current_period_end") else 'N/A'
+    user["lock_until_formatted"] = user["lock_until"].strftime('%Y-%m-%d %H:%M:%S UTC') if user.get("lock_until") else 'N/A'
+
+    return templates.TemplateResponse("admin_user_activity.html", {
+        "request": request,
+        "user": user,
+        "reset_activity_count": activity["reset_activity_count"],
+        "sessions": activity["sessions"],
+        "events": activity["events"],
+        "next_sessions": activity["next_sessions"],
+        "next_events": activity["next_events"],
+        "sessions_before": sessions_before,
+        "events_before": events_before,
+        "page_size": user_activity.PAGE_SIZE,
+        "now": datetime.now
+    })
 # --- End Admin User Detail Route ---
 
 # --- New Admin Churn Report Route ---
 @app.get("/admin/churn")
-async def churn_report(request: Request):
+async def churn_report_page(request: Request, start: Optional[str] = None, end: Optional[str] = None,
+                            after: Optional[str] = None):
+    """Churn events newest first, one keyset page at a time, with monthly counts."""
+    verify_admin(request)
+
+    try:
+        start_dt = datetime.strptime(start, "%Y-%m-%d") if start else None
+        # The end date is inclusive in the form
+        end_dt = datetime.strptime(end, "%Y-%m-%d") + timedelta(days=1) if end else None
+        if after:
+            churn_report.decode_cursor(after)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date or page cursor.")
+
+    try:
+        report = await run_in_threadpool(churn_report.report, start_dt, end_dt, after)
+    except mysql.connector.Error as err:
+        print(f"🔥 DB Error fetching churn report: {err}")
+        raise HTTPException(status_code=500, detail="Database error fetching churn report.")
+
+    for user in report["rows"]:
+        if user.get('timestamp'):
+            user['timestamp_formatted'] = user['timestamp'].strftime('%Y-%m-%d %H:%M:%S UTC')
+
+    return templates.TemplateResponse("churn_report.html", {
+        "request": request,
+        "churned": report["rows"],
+        "monthly": report["monthly"],
+        "total": report["total"],
+        "next_cursor": report["next_cursor"],
+        "is_first_page": not after,
+        "start": start or "",
+        "end": end or ""
+    })
+# --- End Admin Churn Report Route ---
+
+
+# --- Subscription Analytics Routes ---
+
+def _analytics_report(start: Optional[str], end: Optional[str], currency: Optional[str], refresh: bool):
+    try:
+        start_date = datetime.strptime(start, "%Y-%m-%d").date() if start else None
+        end_date = datetime.strptime(end, "%Y-%m-%d").date() if end else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be YYYY-MM-DD.")
+    if start_date and not end_date:
+        end_date = min(start_date + timedelta(days=29), datetime.utcnow().date())
+    try:
+        return subscription_analytics.report(start_date, end_date, currency, refresh=refresh)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except mysql.connector.Error as err:
+        logger.error(f"DB error building subscription analytics: {err}")
+        raise HTTPException(status_code=500, detail="Database error building analytics.")
+
+@app.get("/admin/analytics", response_class=HTMLResponse)
+async def admin_analytics(request: Request, start: Optional[str] = None, end: Optional[str] = None,
+                          currency: Optional[str] = None, refresh: bool = False):
+    """MRR, churn, ARPU and LTV for a date range (default: last 30 days)."""
     verify_admin(request)
+    report = await run_in_threadpool(_analytics_report, start, end, currency, refresh)
+    return templates.TemplateResponse("admin_analytics.html", {
+        "request": request,
+        "report": report,
+        "summary": report["summary"],
+        "daily": list(reversed(report["daily"]))
+    })
 
-    churned_users = []
+@app.get("/admin/api/analytics")
+async def admin_analytics_json(request: Request, start: Optional[str] = None, end: Optional[str] = None,
+                               currency: Optional[str] = None, refresh: bool = False):
+    """The same report as JSON, including the daily series."""
+    verify_admin(request)
+    return JSONResponse(await run_in_threadpool(_analytics_report, start, end, currency, refresh))
+
+@app.get("/admin/cohorts", response_class=HTMLResponse)
+async def admin_cohorts(request: Request, months: int = 12):
+    """Signup cohort conversion and premium retention, read from the precomputed matrix."""
+    verify_admin(request)
+    try:
+        cohorts = await run_in_threadpool(cohort_retention.retention_matrix, max(1, min(months, 60)))
+    except mysql.connector.Error as err:
+        logger.error(f"DB error reading cohort retention: {err}")
+        raise HTTPException(status_code=500, detail="Database error reading cohort retention.")
+    return templates.TemplateResponse("admin_cohorts.html", {
+        "request": request,
+        "cohorts": cohorts,
+        "max_age": max((len(c["cells"]) for c in cohorts), default=0)
+    })
+
+def _active_user_counts(path: Optional[str], days: int) -> dict:
     conn = None
     cursor = None
-
     try:
         conn = mysql.connector.connect(
             host=os.getenv("DB_HOST"),
@@ -1202,33 +1338,59 @@ async def churn_report(request: Request):
             password=os.getenv("DB_PASS"),
             database=os.getenv("DB_NAME")
         )
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT email, timestamp, details
-            FROM audit_logs
-            WHERE action='churn'
-            ORDER BY timestamp DESC
-        """)
-        churned_users = cursor.fetchall()
-        for user in churned_users:
-            if user.get('timestamp'):
-                user['timestamp_formatted'] = user['timestamp'].strftime('%Y-%m-%d %H:%M:%S UTC')
-
-    except mysql.connector.Error as err:
-        print(f"ðŸ”¥ DB Error fetching churn report: {err}")
-        raise HTTPException(status_code=500, detail="Database error fetching churn report.")
-    except Exception as e:
-        print(f"ðŸ”¥ Unexpected error fetching churn report: {e}")
-        raise HTTPException(status_code=500, detail="Unexpected error fetching churn report.")
+        cursor = conn.cursor()
+        counts = activity_sketches.active_counts(cursor)
+        if path:
+            key = activity_sketches.path_key(path)
+            counts["path"] = {"path": key, "days": days,
+                              "users": activity_sketches.distinct_count(cursor, f"path_users:{key}", days)}
+        return counts
     finally:
         if cursor: cursor.close()
         if conn and conn.is_connected(): conn.close()
 
-    return templates.TemplateResponse("churn_report.html", {
+@app.get("/admin/api/active-users")
+async def admin_active_users(request: Request, path: Optional[str] = None, days: int = 30):
+    """DAU/WAU/MAU and unique IPs from the HyperLogLog sketches; optionally distinct users of one path."""
+    verify_admin(request)
+    try:
+        counts = await run_in_threadpool(_active_user_counts, path, max(1, min(days, 366)))
+    except mysql.connector.Error as err:
+        logger.error(f"DB error reading activity sketches: {err}")
+        raise HTTPException(status_code=500, detail="Database error reading activity sketches.")
+    return JSONResponse(counts)
+
+def _traffic_report(days: int, refresh: bool) -> dict:
+    try:
+        return traffic_rollups.report(days, refresh=refresh)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except mysql.connector.Error as err:
+        logger.error(f"DB error building traffic report: {err}")
+        raise HTTPException(status_code=500, detail="Database error building traffic report.")
+
+@app.get("/admin/traffic", response_class=HTMLResponse)
+async def admin_traffic(request: Request, days: int = 7, refresh: bool = False):
+    """Page traffic from the rollup tables: views, unique visitors, top and premium pages."""
+    verify_admin(request)
+    report = await run_in_threadpool(_traffic_report, days, refresh)
+    return templates.TemplateResponse("admin_traffic.html", {
         "request": request,
-        "churned": churned_users
+        "report": report,
+        "summary": report["summary"],
+        "windows": traffic_rollups.TRAFFIC_WINDOWS,
+        "daily": list(reversed(report["daily"])),
+        "hourly": list(reversed(report["hourly"])),
+        "max_hourly": max((h["views"] for h in report["hourly"]), default=0)
     })
-# --- End Admin Churn Report Route ---
+
+@app.get("/admin/api/traffic")
+async def admin_traffic_json(request: Request, days: int = 7, refresh: bool = False):
+    """The same traffic report as JSON."""
+    verify_admin(request)
+    return JSONResponse(await run_in_threadpool(_traffic_report, days, refresh))
+
+# --- End Subscription Analytics Routes ---
 
 
 # --- Export Users Route (Replacing previous implementation) ---
@@ -1309,6 +1471,72 @@ async def export_users(request: Request):
 
 # --- End Export Users Route ---
 
+# --- Bulk Import Users Route ---
+
+@app.post("/admin/import-users")
+async def import_users_route(
+    request: Request,
+    file: UploadFile = File(...),
+    format: Optional[str] = Form(None),
+    dry_run: bool = Form(False)
+):
+    """Provision many accounts at once from a CSV or NDJSON upload; returns per-row results."""
+    admin_email = verify_admin(request)
+
+    fmt = format or ("ndjson" if (file.filename or "").endswith((".ndjson", ".jsonl")) else "csv")
+    try:
+        rows = parse_rows(await file.read(), fmt)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        logger.warning(f"Bulk import by {admin_email} rejected: {e}")
+        raise HTTPException(status_code=400, detail=f"Could not parse upload: {e}")
+
+    logger.info(f"Bulk import of {len(rows)} rows ({fmt}) started by {admin_email}")
+    try:
+        # Hashing is CPU-bound and runs in worker processes; keep the event loop free meanwhile
+        summary = await run_in_threadpool(import_users, rows, dry_run=dry_run)
+    except mysql.connector.Error as err:
+        logger.error(f"DB error during bulk import by {admin_email}: {err}")
+        log_action(admin_email, "ADMIN_BULK_IMPORT_FAILURE", f"Rows: {len(rows)}, Error: {err}")
+        raise HTTPException(status_code=500, detail="Database error during import.")
+
+    log_action(admin_email, "ADMIN_BULK_IMPORT", f"Rows: {len(rows)}, Dry run: {dry_run}, Results: {summary['counts']}")
+    return JSONResponse(summary)
+
+# --- End Bulk Import Users Route ---
+
+# --- Webhook Queue Admin Routes ---
+
+@app.get("/admin/webhook-queue")
+async def webhook_queue_status(request: Request):
+    """Queue depth, oldest pending age and worker counters for the webhook queue."""
+    verify_admin(request)
+    try:
+        metrics = await run_in_threadpool(webhook_queue.queue_metrics)
+    except mysql.connector.Error as err:
+        logger.error(f"DB error reading webhook queue metrics: {err}")
+        raise HTTPException(status_code=500, detail="Database error reading webhook queue.")
+    return JSONResponse(metrics)
+
+@app.post("/admin/webhook-queue/requeue")
+async def webhook_queue_requeue(request: Request, event_id: Optional[str] = Form(None)):
+    """Returns dead-lettered webhook events (one, or all) to the queue."""
+    admin_email = verify_admin(request)
+    try:
+        count = await run_in_threadpool(webhook_queue.requeue_dead, event_id)
+    except mysql.connector.Error as err:
+        logger.error(f"DB error requeueing webhook events: {err}")
+        raise HTTPException(status_code=500, detail="Database error requeueing events.")
+    log_action(admin_email, "ADMIN_WEBHOOK_REQUEUE", f"Event: {event_id or 'all dead'}, Requeued: {count}")
+    return JSONResponse({"requeued": count})
+
+# --- End Webhook Queue Admin Routes ---
+
+@app.get("/admin/stripe-metrics")
+async def stripe_metrics(request: Request):
+    """Per-operation Stripe latencies, retries and circuit breaker state for this worker."""
+    verify_admin(request)
+    return JSONResponse(stripe_client.stripe_metrics())
+
 # --- Stripe Webhook ---
 @app.post("/stripe-webhook")
 async def stripe_webhook(request: Request):
@@ -1324,13 +1552,22 @@ async def stripe_webhook(request: Request):
         logger.info(f"Stripe event constructed: id={event.id}, type={event.type}")
     except ValueError as e:
         logger.error(f"Invalid webhook payload: {e}", exc_info=True)
-        return HTTPException(status_code=400, detail="Invalid payload")
+        raise HTTPException(status_code=400, detail="Invalid payload")
     except stripe.error.SignatureVerificationError as e:
         logger.error(f"Webhook signature verification failed: {e}", exc_info=True)
-        return HTTPException(status_code=400, detail="Invalid signature")
+        raise HTTPException(status_code=400, detail="Invalid signature")
     except Exception as e:
         logger.error(f"Error constructing Stripe event: {e}", exc_info=True)
-        return HTTPException(status_code=500, detail="Could not process webhook event")
+        raise HTTPException(status_code=500, detail="Could not process webhook event")
+
+    # Reject redeliveries of events this endpoint has already handled
+    try:
+        if not event_store.claim(event.id, event.type, "stripe_webhook"):
+            logger.info(f"Duplicate delivery of Stripe event {event.id} ignored.")
+            return {"status": "duplicate"}
+    except mysql.connector.Error as err:
+        logger.error(f"Could not record claim for Stripe event {event.id}: {err}")
+        raise HTTPException(status_code=500, detail="Could not process webhook event")
 
     # Handle the event
     try:
@@ -1345,9 +1582,8 @@ async def stripe_webhook(request: Request):
         elif event.type == 'invoice.payment_succeeded':
             invoice = event.data.object
             logger.info(f"Invoice payment succeeded: {invoice.id} for customer {invoice.customer}")
-            # ... logic for successful payment ...
-            # e.g., update_subscription_period(invoice.customer, invoice.subscription)
-            # logger.info(f"Subscription period updated for invoice {invoice.id}")
+            if invoice.get("amount_paid"):
+                invoice_ledger.record_invoice(invoice)  # INSERT IGNORE; the queued handler may record it too
             
         elif event.type == 'invoice.payment_failed':
             invoice = event.data.object
@@ -1375,69 +1611,10 @@ async def stripe_webhook(request: Request):
         return {"status": "success"}
     except Exception as e:
         logger.error(f"Error handling Stripe event type {event.type if event else 'UNKNOWN'}: {e}", exc_info=True)
+        event_store.release(event.id, "stripe_webhook")
         # Return 500 so Stripe retries, but be cautious about retry storms for non-recoverable errors.
-        return HTTPException(status_code=500, detail="Error processing webhook event")
-
+        raise HTTPException(status_code=500, detail="Error processing webhook event")
 
-@app.get("/manage-subscription")
-async def manage_subscription(request: Request):
-    """Generate a Stripe portal session URL and redirect to it."""
-    user_email = request.session.get("user_id")
-    if not user_email:
-        logger.info("User not logged in, redirecting to login.")
-        return RedirectResponse("/login", status_code=303)
-    
-    logger.info(f"User {user_email} accessing subscription management")
-    
-    conn = None
-    cursor = None
-    try:
-        # Fetch stripe_customer_id from the database
-        conn = mysql.connector.connect(
-            host=os.getenv("DB_HOST"), user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASS"), database=os.getenv("DB_NAME")
-        )
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT stripe_customer_id FROM users WHERE email=%s", (user_email,))
-        row = cursor.fetchone()
-        
-        if not row or not row.get("stripe_customer_id"):
-            logger.warning(f"No Stripe customer ID found for user {user_email}")
-            # No customer ID means they aren't set up in Stripe, redirect to billing or subscribe
-            is_premium = request.session.get("is_premium", False)
-            if is_premium:
-                logger.warning(f"Premium user {user_email} has no Stripe customer ID")
-                return RedirectResponse("/billing", status_code=303)
-            else:
-                logger.info(f"Non-premium user {user_email} redirected to subscribe page")
-                return RedirectResponse("/subscribe", status_code=303)
-        
-        cust_id = row["stripe_customer_id"]
-          # Create Customer Portal session
-        logger.debug(f"Creating customer portal session for {user_email}")
-        portal_session = stripe.billing_portal.Session.create(
-            customer=cust_id,
-            return_url=STRIPE_PORTAL_RETURN_URL
-        )
-        
-        logger.info(f"Redirecting user {user_email} to Stripe Customer Portal")
-        return RedirectResponse(portal_session.url, status_code=303)
-        
-    except stripe.error.StripeError as stripe_err:
-        logger.error(f"Stripe API error for user {user_email}: {str(stripe_err)}")
-        return templates.TemplateResponse("error.html", {
-            "request": request,
-            "error_message": "There was an error connecting to our payment provider. Please try again later."
-        })
-    except Exception as e:
-        logger.error(f"Error generating customer portal for {user_email}: {str(e)}", exc_info=True)
-        return templates.TemplateResponse("error.html", {
-            "request": request, 
-            "error_message": "An unexpected error occurred. Please try again later."
-        })
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.get("/cancel-subscription")
 async def cancel_subscription(request: Request):
@@ -1459,18 +1636,8 @@ async def cancel_subscription(request: Request):
     conn = None
     cursor = None
     try:
-        # Fetch stripe_customer_id and subscription_id from the database
-        conn = mysql.connector.connect(
-            host=os.getenv("DB_HOST"), user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASS"), database=os.getenv("DB_NAME")
-        )
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("""
-            SELECT stripe_customer_id, subscription_id 
-            FROM users 
-            WHERE email = %s
-        """, (user_email,))
-        row = cursor.fetchone()
+        # Fetch stripe_customer_id and subscription_id from the entitlement cache
+        row = get_entitlement(user_email)
         if not row or not row.get("stripe_customer_id") or not row.get("subscription_id"):
             logger.warning(f"No valid subscription information found for user {user_email}")
             return RedirectResponse("/billing?error=no_subscription", status_code=303)
@@ -1479,7 +1646,7 @@ async def cancel_subscription(request: Request):
         try:
             # First check if the subscription exists and is active
             try:
-                subscription = stripe.Subscription.retrieve(row["subscription_id"])
+                subscription = await stripe_client.acall("subscription.retrieve", stripe.Subscription.retrieve, row["subscription_id"])
                 if subscription.status not in ['active', 'trialing']:
                     logger.warning(f"Subscription {row['subscription_id']} for {user_email} is not active (status: {subscription.status})")
                     return RedirectResponse("/billing?error=no_subscription", status_code=303)
@@ -1488,18 +1655,24 @@ async def cancel_subscription(request: Request):
                 return RedirectResponse("/billing?error=no_subscription", status_code=303)
                 
             # Proceed with cancellation
-            stripe.Subscription.modify(
+            await stripe_client.acall("subscription.modify", stripe.Subscription.modify,
                 row["subscription_id"],
                 cancel_at_period_end=True
             )
             
             # Update the user record in the database
+            conn = mysql.connector.connect(
+                host=os.getenv("DB_HOST"), user=os.getenv("DB_USER"),
+                password=os.getenv("DB_PASS"), database=os.getenv("DB_NAME")
+            )
+            cursor = conn.cursor()
             cursor.execute("""
                 UPDATE users 
                 SET subscription_status = 'canceled' 
                 WHERE email = %s
             """, (user_email,))
             conn.commit()
+            invalidate_entitlement(user_email)
             
             logger.info(f"Subscription {row['subscription_id']} for {user_email} marked for cancellation at period end")
             
@@ -1542,14 +1715,12 @@ async def billing_debug(request: Request):
         
         # Try to get a portal URL for the user
         try:
-            # Search for a customer with the given email
-            customers = stripe.Customer.list(email=user_email, limit=1).data
-            if customers:
-                cust_id = customers[0].id
-                logger.info(f"Debug: Found Stripe customer by email search: {cust_id}")
+            cust_id = await stripe_client.arun(customer_for_email, user_email)
+            if cust_id:
+                logger.info(f"Debug: Resolved Stripe customer: {cust_id}")
                 
                 # Create portal session
-                portal_session = stripe.billing_portal.Session.create(
+                portal_session = await stripe_client.acall("portal.create", stripe.billing_portal.Session.create,
                     customer=cust_id,
                     return_url=STRIPE_PORTAL_RETURN_URL
                 )
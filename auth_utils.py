@@ -3,7 +3,14 @@ import bcrypt
 import os
 from dotenv import load_dotenv
 import stripe # Import stripe
+import stripe_client
 from datetime import datetime # Add datetime import for log_action
+from entitlement_cache import invalidate_entitlement
+import invalidation_bus
+import plan_catalog
+import invoice_ledger
+import activity_leaderboard
+import activity_sketches
 
 load_dotenv()
 
@@ -21,6 +28,10 @@ SECURITY_QUESTIONS = [
     "What is your favorite book?",
 ]
 
+# Premium state is reconciled in bulk by reconcile_subscriptions.py; set to 1 to
+# also check Stripe on every successful login
+STRIPE_LOGIN_RECONCILE = os.getenv("STRIPE_LOGIN_RECONCILE", "0") == "1"
+
 # Updated function signature to use email
 def verify_user(email: str, password: str) -> bool:
     conn = None # Define conn and cursor outside try for broader scope if needed later
@@ -67,15 +78,16 @@ def verify_user(email: str, password: str) -> bool:
             print(f"✅ Password verified for email: {email}") # Updated print statement
 
             # --- Add Stripe Fallback Check ---
-            try:
-                stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+            if not STRIPE_LOGIN_RECONCILE:
+                return True
 
+            try:
                 # Lookup user subscription by customer ID
                 customer_id = user.get("stripe_customer_id") # Assumes 'stripe_customer_id' column exists
 
                 if customer_id:
                     print(f"ℹ️ Found Stripe Customer ID: {customer_id} for email {email}. Checking active subscriptions...")
-                    subscriptions = stripe.Subscription.list(customer=customer_id, status="active", limit=1) # Limit 1 is enough
+                    subscriptions = stripe_client.call("subscription.list", stripe.Subscription.list, customer=customer_id, status="active", limit=1) # Limit 1 is enough
 
                     is_premium_stripe = len(subscriptions.data) > 0
                     is_premium_db = bool(user.get("is_premium")) # Ensure DB value is boolean
@@ -98,6 +110,7 @@ def verify_user(email: str, password: str) -> bool:
                             # Use email from the 'user' dict which is confirmed to exist
                             update_cursor.execute("UPDATE users SET is_premium = %s WHERE email = %s", (int(is_premium_stripe), user["email"]))
                             update_conn.commit()
+                            invalidate_entitlement(user["email"])
                             print(f"✅ DB updated successfully for {email}.")
                         except mysql.connector.Error as db_err:
                             print(f"🔥 DB Update Error during Stripe fallback check for {email}: {db_err}")
@@ -198,7 +211,7 @@ def create_user(email: str, password: str, q1: str, a1: str, q2: str, a2: str) -
 
 # --- Admin Functions ---
 
-def get_admin_stats():
+def get_admin_stats(activity_window_days: int = 30):
     """Fetches comprehensive statistics and user details for the admin dashboard."""
     stats = {
         # Basic user metrics
@@ -206,12 +219,17 @@ def get_admin_stats():
         "premium_users": 0,
         "free_users": 0,
         "active_sessions": 0,
+        "dau": 0,
+        "wau": 0,
+        "mau": 0,
+        "unique_ips_30d": 0,
         
         # Revenue metrics
         "monthly_revenue": 0,
         "annual_revenue": 0,
         "all_time_revenue": 0,
         "avg_revenue_per_user": 0,
+        "revenue_source": "estimate",
         
         # Subscription metrics
         "monthly_subs": 0,
@@ -228,6 +246,7 @@ def get_admin_stats():
         "total_sessions": 0,
         "avg_duration": 0,
         "most_active_users": [],
+        "most_active_window": activity_window_days,
         
         # Account status
         "banned_users": 0,
@@ -325,40 +344,40 @@ def get_admin_stats():
             stats["all_time_premium_users"] = result["count"]
 
         # --- Revenue Calculations ---
-        # Monthly revenue using correct GBP pricing
-        monthly_revenue = (stats["monthly_subs"] * 5.00) + (stats["annual_subs"] * (49.99 / 12))
+        # Current prices from the plan catalog (0 if a plan is not configured)
+        monthly_plan = plan_catalog.plan("monthly")
+        annual_plan = plan_catalog.plan("annual")
+        monthly_mrr = monthly_plan.monthly_amount if monthly_plan else 0.0
+        annual_mrr = annual_plan.monthly_amount if annual_plan else 0.0
+        monthly_revenue = (stats["monthly_subs"] * monthly_mrr) + (stats["annual_subs"] * annual_mrr)
         stats["monthly_revenue"] = round(monthly_revenue, 2)
         
         # Annual revenue (current active subscriptions)
-        annual_revenue = (stats["monthly_subs"] * 5.00 * 12) + (stats["annual_subs"] * 49.99)
+        annual_revenue = monthly_revenue * 12
         stats["annual_revenue"] = round(annual_revenue, 2)
         
         # All-time revenue estimate (based on all users who ever had Stripe customer IDs)
-        all_time_revenue = stats["all_time_premium_users"] * 49.99  # Conservative estimate using annual price
+        all_time_revenue = stats["all_time_premium_users"] * (annual_plan.amount if annual_plan else 0.0)  # Conservative estimate using annual price
         stats["all_time_revenue"] = round(all_time_revenue, 2)
         
+        # Prefer actual paid invoices once the ledger has been populated
+        try:
+            ledger = invoice_ledger.revenue_summary(cursor, monthly_plan.currency if monthly_plan else "gbp")
+        except mysql.connector.Error:
+            ledger = None  # invoice_ledger table might not exist yet
+        if ledger and ledger["invoices"]:
+            stats["monthly_revenue"] = round(ledger["mrr"], 2)
+            stats["annual_revenue"] = round(ledger["mrr"] * 12, 2)
+            stats["all_time_revenue"] = round(ledger["all_time_revenue"], 2)
+            stats["revenue_source"] = "ledger"
+
         # Average revenue per user (ARPU)
         if stats["total_users"] > 0:
             stats["avg_revenue_per_user"] = round(stats["all_time_revenue"] / stats["total_users"], 2)
         
         # Conversion rate (percentage of users who became premium)
         if stats["total_users"] > 0:
-            stats["conversion_rate"] = round((stats["all_time_premium_users"] / stats["total_users"]) * 100, 1)# For active_sessions, let's count unique users from session_logs in last 30 days
-        try:
-            cursor.execute("""
-                SELECT COUNT(DISTINCT email) as count 
-                FROM session_logs 
-                WHERE created_at >= DATE_SUB(NOW(), INTERVAL 30 DAY)
-                AND email IS NOT NULL
-            """)
-            result = cursor.fetchone()
-            if result: 
-                stats["active_sessions"] = result["count"]
-            else:
-                stats["active_sessions"] = 0
-        except mysql.connector.Error:
-            # session_logs table might not exist
-            stats["active_sessions"] = 0
+            stats["conversion_rate"] = round((stats["all_time_premium_users"] / stats["total_users"]) * 100, 1)
 
         # --- New Session Stats ---
         # Use a standard cursor (or fetch specific columns) for session stats if dictionary=True causes issues
@@ -367,31 +386,30 @@ def get_admin_stats():
         cursor = conn.cursor() # Standard cursor for session stats
 
         try:
-            cursor.execute("SELECT COUNT(*) FROM session_logs")
-            result = cursor.fetchone()
-            stats["total_sessions"] = result[0] if result else 0
+            # Distinct users/IPs from the daily HyperLogLog sketches (about 1.6% error)
+            stats.update(activity_sketches.active_counts(cursor))
+            stats["active_sessions"] = stats["mau"]
+        except mysql.connector.Error:
+            # activity_sketches table might not exist yet
+            stats["active_sessions"] = 0
 
-            cursor.execute("SELECT AVG(duration_seconds) FROM session_logs")
+        try:
+            # Sessions tracked from request traffic (session_tracker.py); only closed ones have a final duration
+            cursor.execute("SELECT COUNT(*), AVG(CASE WHEN ended_at IS NOT NULL THEN duration_seconds END) FROM user_sessions")
             result = cursor.fetchone()
+            stats["total_sessions"] = result[0] if result else 0
             # Handle potential None if table is empty, round the average
-            stats["avg_duration"] = round(result[0] or 0)
-
-            # Fetch most active users (returns list of tuples: (email, count))
-            cursor.execute("""
-                SELECT email, COUNT(*) AS count
-                FROM session_logs
-                WHERE email IS NOT NULL  /* Exclude null emails if necessary */
-                GROUP BY email
-                ORDER BY count DESC
-                LIMIT 5
-            """)
-            # Convert list of tuples to list of dicts for easier template access
-            most_active_raw = cursor.fetchall()
-            stats["most_active_users"] = [{"email": email, "count": count} for email, count in most_active_raw]
+            stats["avg_duration"] = round((result[1] if result else 0) or 0)
         except mysql.connector.Error:
-            # session_logs table might not exist
+            # user_sessions table might not exist yet
             stats["total_sessions"] = 0
             stats["avg_duration"] = 0
+
+        try:
+            # In-memory top-K over the daily activity counters (list of dicts with 'email' and 'count')
+            stats["most_active_users"] = activity_leaderboard.top_users(activity_window_days, 5)
+        except mysql.connector.Error:
+            # user_activity_daily table might not exist yet
             stats["most_active_users"] = []
 
         # Re-create dictionary cursor for fetching user details
@@ -468,6 +486,8 @@ def update_user_status(email: str, status_field: str, value: bool):
 
         if cursor.rowcount > 0:
             print(f"✅ User '{email}' status updated: {status_field} set to {value}")
+            invalidate_entitlement(email)
+            invalidation_bus.publish("user", email)
             return True
         else:
             print(f"⚠️ User '{email}' not found or status already set.")
@@ -519,6 +539,7 @@ def admin_reset_password(email: str, new_password: str) -> bool: # Add new_passw
 
         if cursor.rowcount > 0:
             print(f"✅ Password hash updated successfully by admin for user '{email}'.")
+            invalidation_bus.publish("user", email)
             return True
         else:
             print(f"⚠️ User '{email}' not found for admin password reset.")
@@ -539,6 +560,30 @@ def admin_reset_password(email: str, new_password: str) -> bool: # Add new_passw
 # --- End Admin Password Reset Function ---
 
 # --- Add Audit Log Helper ---
+# Normalized audit_logs.category, indexed with email so per-user counts (e.g.
+# password reset events) never pattern-match action names. Keep in sync with
+# the backfill in add_audit_log_category.sql.
+ACCOUNT_ACTIONS = ("REGISTER_SUCCESS", "REGISTER_FAILURE", "PROFILE_UPDATED",
+                   "CHANGE_PASSWORD_SUCCESS", "CHANGE_PASSWORD_FAILURE")
+AUTH_ACTIONS = ("LOGIN", "LOGOUT", "LOGIN_FAILURE", "ACCOUNT_LOCKED")
+BILLING_ACTIONS = ("SUBSCRIPTION_STARTED", "CHURN")
+
+
+def audit_category(action: str) -> str:
+    action = (action or "").upper()
+    if "RESET_PASSWORD" in action or action == "PASSWORD_RESET":
+        return "password_reset"
+    if action.startswith("ADMIN_") or action in ("BAN_USER", "UNBAN_USER"):
+        return "admin"
+    if action in AUTH_ACTIONS:
+        return "auth"
+    if action in ACCOUNT_ACTIONS:
+        return "account"
+    if action in BILLING_ACTIONS:
+        return "billing"
+    return "other"
+
+
 def log_action(email: str, action: str, details: str = ""):
     """Logs an action to the audit_logs table."""
     conn = None
@@ -552,8 +597,8 @@ def log_action(email: str, action: str, details: str = ""):
         )
         cursor = conn.cursor()
         cursor.execute(
-            "INSERT INTO audit_logs (email, action, details, timestamp) VALUES (%s, %s, %s, %s)",
-            (email, action, details, datetime.now()) # Add timestamp
+            "INSERT INTO audit_logs (email, action, category, details, timestamp) VALUES (%s, %s, %s, %s, %s)",
+            (email, action, audit_category(action), details, datetime.now()) # Add timestamp
         )
         conn.commit()
     except mysql.connector.Error as db_err:
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# bench_login.py
+"""
+Reproducible throughput/latency benchmark for POST /login, /register and
+/verify-security.
+
+Runs the real FastAPI app in-process under uvicorn against a local database
+(the SQLite stand-in from fake_db.py by default, or the MySQL in .env with
+--db mysql) and a fake Stripe server with configurable latency, drives
+concurrent load per route and writes the results as JSON so runs can be
+compared between commits.
+
+Usage:
+    python bench_login.py --requests 200 --concurrency 16 --stripe-latency-ms 120
+    python bench_login.py --compare bench_results/login-abc1234-....json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import bcrypt
+import requests
+
+ROUTES = ["login", "register", "verify-security"]
+BENCH_PASSWORD = "bench-password"
+BENCH_ANSWER_1 = "rover"
+BENCH_ANSWER_2 = "leeds"
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return "unknown"
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    values = sorted(latencies)
+    count = len(values)
+    return {
+        "requests": count,
+        "errors": errors,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(count / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "mean": round(sum(values) / count * 1000, 2) if count else 0.0,
+            "p50": round(percentile(values, 50) * 1000, 2),
+            "p90": round(percentile(values, 90) * 1000, 2),
+            "p95": round(percentile(values, 95) * 1000, 2),
+            "p99": round(percentile(values, 99) * 1000, 2),
+            "max": round(values[-1] * 1000, 2) if values else 0.0,
+        },
+    }
+
+
+def seed_fake_users(fake_db, fake_stripe, count: int, premium_fraction: float, rounds: int) -> list:
+    """Creates bench users sharing one password/answer hash so seeding stays fast."""
+    pw_hash = bcrypt.hashpw(BENCH_PASSWORD.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+    a1_hash = bcrypt.hashpw(BENCH_ANSWER_1.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+    a2_hash = bcrypt.hashpw(BENCH_ANSWER_2.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+    users = []
+    premium_every = int(1 / premium_fraction) if premium_fraction > 0 else 0
+    for i in range(count):
+        email = f"bench-user-{i}@example.com"
+        customer_id = None
+        if premium_every and i % premium_every == 0:
+            customer_id = fake_stripe.add_customer(email)["id"]
+            fake_stripe.add_subscription(customer_id)
+        users.append({
+            "email": email,
+            "password_hash": pw_hash,
+            "security_question_1": "What was your first pet's name?",
+            "security_answer_1_hash": a1_hash,
+            "security_question_2": "In what city were you born?",
+            "security_answer_2_hash": a2_hash,
+            "is_premium": 1 if customer_id else 0,
+            "stripe_customer_id": customer_id,
+            "reset_attempts": 0,
+            "failed_logins": 0,
+        })
+    fake_db.seed_users(users)
+    return [u["email"] for u in users]
+
+
+def run_route(base_url: str, route: str, emails: list, total: int, concurrency: int, run_id: str) -> dict:
+    local = threading.local()
+    counter = iter(range(total))
+    counter_lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    results_lock = threading.Lock()
+
+    def session() -> requests.Session:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session
+
+    def request_for(i: int) -> tuple:
+        email = emails[i % len(emails)]
+        if route == "login":
+            return "/login", {"email": email, "password": BENCH_PASSWORD}
+        if route == "register":
+            return "/register", {
+                "email": f"bench-reg-{run_id}-{i}@example.com",
+                "password": BENCH_PASSWORD,
+                "security_question_1": "What was your first pet's name?",
+                "security_answer_1": BENCH_ANSWER_1,
+                "security_question_2": "In what city were you born?",
+                "security_answer_2": BENCH_ANSWER_2,
+            }
+        return "/verify-security", {"email": email, "answer1": BENCH_ANSWER_1, "answer2": BENCH_ANSWER_2}
+
+    def worker():
+        while True:
+            with counter_lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            path, data = request_for(i)
+            started = time.perf_counter()
+            try:
+                response = session().post(base_url + path, data=data, allow_redirects=False, timeout=60)
+                ok = response.status_code in (200, 302, 303)
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with results_lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors[0] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    return summarize(latencies, errors[0], time.perf_counter() - started)
+
+
+def compare(current: dict, baseline_path: str):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\nComparison against {baseline_path} (commit {baseline['meta'].get('commit')}):", file=sys.stderr)
+    for route, stats in current["routes"].items():
+        base = baseline.get("routes", {}).get(route)
+        if not base:
+            continue
+        def delta(new, old):
+            return f"{((new - old) / old * 100):+.1f}%" if old else "n/a"
+        print(
+            f"  {route:16s} rps {stats['throughput_rps']:8.1f} ({delta(stats['throughput_rps'], base['throughput_rps'])})"
+            f"  p99 {stats['latency_ms']['p99']:8.1f}ms ({delta(stats['latency_ms']['p99'], base['latency_ms']['p99'])})",
+            file=sys.stderr,
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark login/register/verify-security throughput.")
+    parser.add_argument("--routes", default=",".join(ROUTES), help="Comma-separated routes to drive")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per route")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent client threads")
+    parser.add_argument("--users", type=int, default=200, help="Seeded users (fake DB only)")
+    parser.add_argument("--premium-fraction", type=float, default=0.5, help="Share of seeded users with a Stripe subscription")
+    parser.add_argument("--stripe-latency-ms", type=float, default=100.0, help="Fake Stripe response latency")
+    parser.add_argument("--stripe-jitter-ms", type=float, default=0.0, help="Fake Stripe latency jitter")
+    parser.add_argument("--seed-bcrypt-rounds", type=int, default=12, help="bcrypt cost of the seeded hashes")
+    parser.add_argument("--db", choices=["fake", "mysql"], default="fake", help="Database backend")
+    parser.add_argument("--label", default="", help="Free-form label stored with the results")
+    parser.add_argument("--output", help="Results JSON path (default: bench_results/login-<commit>-<time>.json)")
+    parser.add_argument("--compare", help="Baseline results JSON to compare against")
+    args = parser.parse_args(argv)
+
+    routes = [r.strip() for r in args.routes.split(",") if r.strip()]
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        parser.error(f"Unknown routes: {', '.join(sorted(unknown))}")
+
+    # Configure the app before it is imported
+    os.environ.setdefault("SECRET_KEY", "bench-secret-key")
+    os.environ["LOG_LEVEL"] = "WARNING"
+    os.environ["STRIPE_SECRET_KEY"] = "sk_test_bench"
+    os.environ.setdefault("INVALIDATION_BUS_DIR", tempfile.mkdtemp(prefix="cricketapp-bench-bus-"))
+    os.environ.setdefault("WEBHOOK_QUEUE_WORKERS", "0")  # The dispatcher needs MySQL named locks
+
+    import fake_db
+    from fake_stripe import FakeStripe
+
+    fake_stripe = FakeStripe(latency_ms=args.stripe_latency_ms, jitter_ms=args.stripe_jitter_ms)
+    fake_stripe.start()
+
+    emails = []
+    if args.db == "fake":
+        fake_db.install()
+        emails = seed_fake_users(fake_db, fake_stripe, args.users, args.premium_fraction, args.seed_bcrypt_rounds)
+    else:
+        print("⚠️ Using the MySQL database from .env; bench users must already exist "
+              f"with password '{BENCH_PASSWORD}' and answers '{BENCH_ANSWER_1}'/'{BENCH_ANSWER_2}'.", file=sys.stderr)
+        emails = [f"bench-user-{i}@example.com" for i in range(args.users)]
+
+    import stripe
+    import uvicorn
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        import app as app_module
+    stripe.api_base = fake_stripe.base_url
+    app_module.limiter.enabled = False  # The 5/minute login limit would otherwise dominate
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(app_module.app, host="127.0.0.1", port=port, log_level="warning", access_log=False))
+    server_thread = threading.Thread(target=server.run, name="bench-uvicorn", daemon=True)
+    server_thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    base_url = f"http://127.0.0.1:{port}"
+
+    run_id = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    results = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "label": args.label,
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "db": args.db,
+            "requests_per_route": args.requests,
+            "concurrency": args.concurrency,
+            "users": len(emails),
+            "premium_fraction": args.premium_fraction,
+            "stripe_latency_ms": args.stripe_latency_ms,
+            "stripe_jitter_ms": args.stripe_jitter_ms,
+        },
+        "routes": {},
+    }
+
+    try:
+        for route in routes:
+            print(f"🏏 Driving POST /{route}: {args.requests} requests @ concurrency {args.concurrency}...", file=sys.stderr)
+            stripe_before = fake_stripe.request_count
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                stats = run_route(base_url, route, emails, args.requests, args.concurrency, run_id)
+            stats["stripe_calls"] = fake_stripe.request_count - stripe_before
+            results["routes"][route] = stats
+            if stats["errors"]:
+                # Throughput of failed requests measures the error page, not the route
+                print(f"❌ {stats['errors']} of {stats['requests']} request(s) to /{route} failed", file=sys.stderr)
+                continue
+            print(f"   {stats['throughput_rps']} req/s, p50 {stats['latency_ms']['p50']}ms, "
+                  f"p99 {stats['latency_ms']['p99']}ms, errors {stats['errors']}", file=sys.stderr)
+    finally:
+        server.should_exit = True
+        server_thread.join(timeout=10)
+        fake_stripe.stop()
+        if args.db == "fake":
+            fake_db.uninstall()
+
+    output = args.output or os.path.join("bench_results", f"login-{results['meta']['commit']}-{run_id}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"📄 Results written to {output}", file=sys.stderr)
+
+    failed = [route for route, stats in results["routes"].items() if stats["errors"]]
+    if failed:
+        print(f"❌ Benchmark invalid: requests failed on {', '.join(failed)}", file=sys.stderr)
+        return 1
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# bulk_import.py
+"""
+Bulk user provisioning for club and school onboarding.
+
+Accepts CSV (with a header row) or NDJSON with the fields:
+    email, password, security_question_1, security_answer_1,
+    security_question_2, security_answer_2
+
+bcrypt hashing is spread across CPU cores, duplicates are detected through the
+unique index on users.email, and rows are inserted with multi-row INSERTs in
+chunked transactions. Every input row gets a result entry.
+
+Usage:
+    python bulk_import.py users.csv [--format csv|ndjson] [--report results.json]
+    python bulk_import.py --benchmark 500 [--workers 8]
+"""
+import argparse
+import csv
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+import mysql.connector
+from mysql.connector import errorcode
+from dotenv import load_dotenv
+
+load_dotenv()
+
+REQUIRED_FIELDS = [
+    "email", "password",
+    "security_question_1", "security_answer_1",
+    "security_question_2", "security_answer_2",
+]
+DEFAULT_CHUNK_SIZE = 500
+
+
+def _connect():
+    return mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASS"),
+        database=os.getenv("DB_NAME")
+    )
+
+
+def parse_rows(data, fmt: str = "csv") -> list:
+    """Parses CSV or NDJSON text/bytes into a list of row dicts."""
+    if isinstance(data, bytes):
+        data = data.decode("utf-8-sig")
+
+    if fmt == "csv":
+        return [dict(row) for row in csv.DictReader(io.StringIO(data))]
+    if fmt == "ndjson":
+        rows = []
+        for line_no, line in enumerate(data.splitlines(), start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                rows.append({"_parse_error": f"Invalid JSON on line {line_no}"})
+                continue
+            if not isinstance(row, dict):
+                row = {"_parse_error": f"Line {line_no} is not a JSON object"}
+            rows.append(row)
+        return rows
+    raise ValueError(f"Unsupported import format: {fmt}")
+
+
+def _validate(row: dict):
+    """Returns an error message for an unusable row, or None."""
+    if row.get("_parse_error"):
+        return row["_parse_error"]
+    missing = [f for f in REQUIRED_FIELDS if not str(row.get(f) or "").strip()]
+    if missing:
+        return f"Missing fields: {', '.join(missing)}"
+    not_text = [f for f in REQUIRED_FIELDS if not isinstance(row[f], str)]
+    if not_text:
+        return f"Fields must be text: {', '.join(not_text)}"
+    if "@" not in row["email"]:
+        return "Invalid email format"
+    if len(row["password"]) < 8:
+        return "Password must be at least 8 characters long"
+    return None
+
+
+def _hash_credentials(values: tuple) -> tuple:
+    """Hashes (password, answer1, answer2). Top-level so worker processes can pickle it."""
+    return tuple(
+        bcrypt.hashpw(v.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+        for v in values
+    )
+
+
+def hash_rows(rows: list, workers: int = None) -> list:
+    """Hashes the credentials of every row in parallel across CPU cores."""
+    values = [(r["password"], r["security_answer_1"], r["security_answer_2"]) for r in rows]
+    if not values:
+        return []
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        return [_hash_credentials(v) for v in values]
+    # spawn avoids forking a threaded web worker
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        return list(pool.map(_hash_credentials, values, chunksize=max(1, len(values) // (workers * 4))))
+
+
+def _existing_emails(cursor, emails: list) -> set:
+    """Looks up which of the given emails already exist, via the unique email index."""
+    if not emails:
+        return set()
+    placeholders = ", ".join(["%s"] * len(emails))
+    cursor.execute(f"SELECT email FROM users WHERE email IN ({placeholders})", tuple(emails))
+    return {row[0].lower() for row in cursor.fetchall()}
+
+
+def _insert_chunk(conn, cursor, chunk: list):
+    """Inserts one chunk in a single transaction with a multi-row INSERT."""
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s)"] * len(chunk))
+    params = []
+    for row, (pw_hash, a1_hash, a2_hash) in chunk:
+        params.extend([
+            pw_hash, row["email"], 0,
+            row["security_question_1"], a1_hash,
+            row["security_question_2"], a2_hash,
+            0,
+        ])
+    cursor.execute(f"""
+        INSERT INTO users (
+            password_hash, email, is_premium,
+            security_question_1, security_answer_1_hash,
+            security_question_2, security_answer_2_hash,
+            reset_attempts
+        )
+        VALUES {placeholders}
+    """, tuple(params))
+    conn.commit()
+
+
+def import_users(rows: list, chunk_size: int = DEFAULT_CHUNK_SIZE, workers: int = None, dry_run: bool = False) -> dict:
+    """Creates users in bulk and returns a summary with one result per input row."""
+    started = time.perf_counter()
+    results = [None] * len(rows)
+    candidates = []  # (index, row)
+    seen = set()
+
+    for i, row in enumerate(rows):
+        error = _validate(row)
+        email = str(row.get("email") or "").strip()
+        if error:
+            results[i] = {"row": i + 1, "email": email, "status": "invalid", "detail": error}
+            continue
+        row = dict(row, email=email)
+        if email.lower() in seen:
+            results[i] = {"row": i + 1, "email": email, "status": "duplicate_in_file", "detail": "Email appears earlier in the file"}
+            continue
+        seen.add(email.lower())
+        candidates.append((i, row))
+
+    conn = None
+    cursor = None
+    try:
+        if not dry_run and candidates:
+            conn = _connect()
+            cursor = conn.cursor()
+
+            # Skip accounts that already exist before spending CPU on hashing them
+            remaining = []
+            for start in range(0, len(candidates), chunk_size):
+                batch = candidates[start:start + chunk_size]
+                existing = _existing_emails(cursor, [row["email"] for _, row in batch])
+                for i, row in batch:
+                    if row["email"].lower() in existing:
+                        results[i] = {"row": i + 1, "email": row["email"], "status": "exists", "detail": "Email already registered"}
+                    else:
+                        remaining.append((i, row))
+            candidates = remaining
+
+        hash_started = time.perf_counter()
+        hashes = hash_rows([row for _, row in candidates], workers=workers)
+        hash_seconds = time.perf_counter() - hash_started
+
+        for start in range(0, len(candidates), chunk_size):
+            batch = candidates[start:start + chunk_size]
+            chunk = [(row, hashes[start + j]) for j, (_, row) in enumerate(batch)]
+
+            if dry_run:
+                for i, row in batch:
+                    results[i] = {"row": i + 1, "email": row["email"], "status": "would_create", "detail": ""}
+                continue
+
+            try:
+                _insert_chunk(conn, cursor, chunk)
+                for i, row in batch:
+                    results[i] = {"row": i + 1, "email": row["email"], "status": "created", "detail": ""}
+            except mysql.connector.Error as err:
+                conn.rollback()
+                if err.errno != errorcode.ER_DUP_ENTRY:
+                    print(f"🔥 [Import] DB error inserting chunk starting at row {batch[0][0] + 1}: {err}")
+                    for i, row in batch:
+                        results[i] = {"row": i + 1, "email": row["email"], "status": "error", "detail": str(err)}
+                    continue
+
+                # Someone registered one of these emails since the pre-check; drop them and retry once
+                existing = _existing_emails(cursor, [row["email"] for row, _ in chunk])
+                retry = [(row, h) for row, h in chunk if row["email"].lower() not in existing]
+                try:
+                    if retry:
+                        _insert_chunk(conn, cursor, retry)
+                    for i, row in batch:
+                        if row["email"].lower() in existing:
+                            results[i] = {"row": i + 1, "email": row["email"], "status": "exists", "detail": "Email already registered"}
+                        else:
+                            results[i] = {"row": i + 1, "email": row["email"], "status": "created", "detail": ""}
+                except mysql.connector.Error as retry_err:
+                    conn.rollback()
+                    print(f"🔥 [Import] Retry failed for chunk starting at row {batch[0][0] + 1}: {retry_err}")
+                    for i, row in batch:
+                        if results[i] is None:
+                            results[i] = {"row": i + 1, "email": row["email"], "status": "error", "detail": str(retry_err)}
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    elapsed = time.perf_counter() - started
+    summary = {
+        "total_rows": len(rows),
+        "counts": counts,
+        "elapsed_seconds": round(elapsed, 3),
+        "hash_seconds": round(hash_seconds, 3),
+        "rows_per_second": round(len(rows) / elapsed, 1) if elapsed > 0 else None,
+        "results": results,
+    }
+    print(f"✅ [Import] Processed {len(rows)} rows in {elapsed:.1f}s: {counts}")
+    return summary
+
+
+def run_benchmark(n: int, workers: int = None, chunk_size: int = DEFAULT_CHUNK_SIZE, with_db: bool = False) -> dict:
+    """Measures hashing/import throughput on synthetic users against a sequential baseline."""
+    run_id = int(time.time())
+    rows = [{
+        "email": f"bench-{run_id}-{i}@example.com",
+        "password": f"bench-password-{i}",
+        "security_question_1": "What was your first pet's name?",
+        "security_answer_1": f"pet-{i}",
+        "security_question_2": "In what city were you born?",
+        "security_answer_2": f"city-{i}",
+    } for i in range(n)]
+
+    sample = rows[:max(1, min(n, 20))]
+    t0 = time.perf_counter()
+    hash_rows(sample, workers=1)
+    sequential_rate = len(sample) / (time.perf_counter() - t0)
+
+    summary = import_users(rows, chunk_size=chunk_size, workers=workers, dry_run=not with_db)
+    report = {
+        "rows": n,
+        "workers": workers or os.cpu_count(),
+        "with_db": with_db,
+        "sequential_users_per_second": round(sequential_rate, 2),
+        "parallel_users_per_second": summary["rows_per_second"],
+        "speedup": round(summary["rows_per_second"] / sequential_rate, 2) if sequential_rate else None,
+        "elapsed_seconds": summary["elapsed_seconds"],
+        "hash_seconds": summary["hash_seconds"],
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-import users from CSV or NDJSON.")
+    parser.add_argument("path", nargs="?", help="CSV or NDJSON file to import")
+    parser.add_argument("--format", choices=["csv", "ndjson"], help="Input format (default: from file extension)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Rows per INSERT transaction")
+    parser.add_argument("--workers", type=int, default=None, help="Hashing processes (default: CPU count)")
+    parser.add_argument("--dry-run", action="store_true", help="Validate and hash without writing to the DB")
+    parser.add_argument("--report", help="Write per-row results as JSON to this file")
+    parser.add_argument("--benchmark", type=int, metavar="N", help="Benchmark with N synthetic users instead of importing")
+    parser.add_argument("--benchmark-db", action="store_true", help="Include DB inserts in the benchmark (creates bench-* users)")
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        run_benchmark(args.benchmark, workers=args.workers, chunk_size=args.chunk_size, with_db=args.benchmark_db)
+        return 0
+
+    if not args.path:
+        parser.error("path is required unless --benchmark is given")
+
+    fmt = args.format or ("ndjson" if args.path.endswith((".ndjson", ".jsonl")) else "csv")
+    with open(args.path, "rb") as f:
+        rows = parse_rows(f.read(), fmt)
+
+    summary = import_users(rows, chunk_size=args.chunk_size, workers=args.workers, dry_run=args.dry_run)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        print(f"📄 Per-row results written to {args.report}")
+    else:
+        for result in summary["results"]:
+            if result["status"] not in ("created", "would_create"):
+                print(f"  row {result['row']}: {result['email']} -> {result['status']} {result['detail']}")
+    return 0 if "error" not in summary["counts"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
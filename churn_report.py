@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# churn_report.py
+"""
+Churn report queries for /admin/churn.
+
+Rows come from audit_logs with action = 'churn'. Each page is read with keyset
+pagination on idx_audit_logs_action_timestamp (newest first, id as the
+tie-breaker), so a page costs the same however deep it is. Monthly counts come
+from churn_monthly. That table is brought up to date with only the audit rows
+added since its checkpoint, so the report never counts the whole log.
+
+Schema: add_churn_report_tables.sql, add_job_checkpoints_table.sql
+
+Usage:
+    python churn_report.py            # Fold new churn events into churn_monthly
+"""
+import os
+import sys
+from datetime import datetime
+
+import mysql.connector
+from dotenv import load_dotenv
+
+from job_checkpoints import load_checkpoint, save_checkpoint
+
+load_dotenv()
+
+JOB_NAME = "churn_monthly"
+REFRESH_LOCK_NAME = "cricketapp_churn_monthly"
+PAGE_SIZE = 50
+
+
+def _connect():
+    return mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASS"),
+        database=os.getenv("DB_NAME")
+    )
+
+
+def refresh_monthly(conn) -> int:
+    """Adds churn events logged since the last refresh to churn_monthly. Returns the number added.
+
+    A MySQL named lock keeps concurrent refreshes (two admins, or the cron run)
+    from counting the same rows twice; a caller that cannot get it skips the refresh.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, 0)", (REFRESH_LOCK_NAME,))
+        row = cursor.fetchone()
+        if not row or row[0] != 1:
+            return 0
+        try:
+            last_id = int(load_checkpoint(conn, JOB_NAME) or 0)
+            cursor.execute("""
+                SELECT DATE_SUB(DATE(timestamp), INTERVAL DAYOFMONTH(timestamp) - 1 DAY) AS month, COUNT(*), MAX(id)
+                FROM audit_logs
+                WHERE id > %s AND action = 'churn' AND timestamp IS NOT NULL
+                GROUP BY month
+            """, (last_id,))
+            months = cursor.fetchall()
+            if not months:
+                return 0
+            cursor.executemany("""
+                INSERT INTO churn_monthly (month, churned) VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE churned = churned + VALUES(churned)
+            """, [(month, count) for month, count, _ in months])
+            save_checkpoint(conn, JOB_NAME, str(max(max_id for _, _, max_id in months)))  # Commits with the counts
+            return sum(count for _, count, _ in months)
+        except mysql.connector.Error:
+            conn.rollback()
+            raise
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (REFRESH_LOCK_NAME,))
+            cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def monthly_counts(cursor, start: datetime = None, end: datetime = None) -> list:
+    """churn_monthly rows (newest first) for the months overlapping [start, end)."""
+    query = "SELECT month, churned FROM churn_monthly WHERE 1 = 1"
+    params = []
+    if start:
+        query += " AND month >= %s"
+        params.append(start.replace(day=1).date())
+    if end:
+        query += " AND month < %s"
+        params.append(end)
+    cursor.execute(query + " ORDER BY month DESC", tuple(params))
+    return cursor.fetchall()
+
+
+def encode_cursor(row: dict) -> str:
+    return f"{row['timestamp'].strftime('%Y%m%d%H%M%S%f')}-{row['id']}"
+
+
+def decode_cursor(value: str) -> tuple:
+    """Inverse of encode_cursor; raises ValueError for anything else."""
+    stamp, row_id = value.split("-", 1)
+    return datetime.strptime(stamp, "%Y%m%d%H%M%S%f"), int(row_id)
+
+
+def churn_page(cursor, start: datetime = None, end: datetime = None, after: str = None,
+               limit: int = PAGE_SIZE) -> tuple:
+    """One page of churn rows, newest first. Returns (rows, next cursor or None)."""
+    query = "SELECT id, email, timestamp, details FROM audit_logs WHERE action = 'churn'"
+    params = []
+    if start:
+        query += " AND timestamp >= %s"
+        params.append(start)
+    if end:
+        query += " AND timestamp < %s"
+        params.append(end)
+    if after:
+        after_ts, after_id = decode_cursor(after)
+        query += " AND (timestamp < %s OR (timestamp = %s AND id < %s))"
+        params.extend([after_ts, after_ts, after_id])
+    query += " ORDER BY timestamp DESC, id DESC LIMIT %s"
+    params.append(limit + 1)
+    cursor.execute(query, tuple(params))
+    rows = cursor.fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def count_in_range(cursor, start: datetime, end: datetime) -> int:
+    """Exact count for a filtered range; an index range scan on (action, timestamp)."""
+    query = "SELECT COUNT(*) AS count FROM audit_logs WHERE action = 'churn'"
+    params = []
+    if start:
+        query += " AND timestamp >= %s"
+        params.append(start)
+    if end:
+        query += " AND timestamp < %s"
+        params.append(end)
+    cursor.execute(query, tuple(params))
+    return (cursor.fetchone() or {}).get("count", 0)
+
+
+def report(start: datetime = None, end: datetime = None, after: str = None, limit: int = PAGE_SIZE) -> dict:
+    """Everything the churn page needs, from one connection."""
+    conn = None
+    cursor = None
+    try:
+        conn = _connect()
+        refresh_monthly(conn)
+        cursor = conn.cursor(dictionary=True)
+        rows, next_cursor = churn_page(cursor, start, end, after, limit)
+        months = monthly_counts(cursor, start, end)
+        # Unfiltered totals come straight from the aggregate
+        total = count_in_range(cursor, start, end) if (start or end) else sum(m["churned"] for m in months)
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+    return {"rows": rows, "next_cursor": next_cursor, "monthly": months, "total": total}
+
+
+def main():
+    conn = _connect()
+    try:
+        added = refresh_monthly(conn)
+    finally:
+        conn.close()
+    print(f"✅ [Churn] Folded {added} new churn event(s) into churn_monthly.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# cohort_retention.py
+"""
+Signup cohort retention: free→premium conversion and premium retention by
+signup month × months since signup.
+
+The matrix lives in cohort_retention as a few counters per cohort, and is
+kept up to date by a daily job. The job reads only what has changed since
+its last checkpoint: users with a higher id (signups) and audit_logs rows
+with a higher id ('subscription_started' / 'churn'). Per-user premium state
+in cohort_user_state makes repeated events idempotent (a second start
+without a churn in between is not counted again). Each batch and its
+checkpoint are committed together, so an interrupted run resumes cleanly.
+The admin view only reads the small matrix table.
+
+Schema: add_cohort_retention_tables.sql, add_job_checkpoints_table.sql
+Cron (daily):
+    30 2 * * *  cd /srv/cricketapp && python cohort_retention.py
+
+Usage:
+    python cohort_retention.py [--rebuild] [--print]
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+from datetime import date, datetime
+
+import mysql.connector
+from dotenv import load_dotenv
+
+from job_checkpoints import clear_checkpoint, load_checkpoint, save_checkpoint
+
+load_dotenv()
+
+USERS_JOB_NAME = "cohort_retention_users"
+EVENTS_JOB_NAME = "cohort_retention_events"
+BATCH_SIZE = 5000
+START_ACTION = "subscription_started"
+CHURN_ACTION = "churn"
+
+
+def _connect():
+    return mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASS"),
+        database=os.getenv("DB_NAME")
+    )
+
+
+def month_start(value) -> date:
+    return date(value.year, value.month, 1)
+
+
+def months_between(cohort: date, month: date) -> int:
+    # Events dated before signup (e.g. imported users) count as month 0
+    return max(0, (month.year - cohort.year) * 12 + month.month - cohort.month)
+
+
+def _shift_months(month: date, delta: int) -> date:
+    index = month.year * 12 + month.month - 1 + delta
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _add_counts(cursor, counts: Counter):
+    if not counts:
+        return
+    cursor.executemany("""
+        INSERT INTO cohort_retention (cohort_month, metric, months_since, users)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE users = users + VALUES(users)
+    """, [key + (n,) for key, n in counts.items() if n])
+
+
+def process_signups(conn) -> int:
+    """Adds users created since the last run to their signup cohorts."""
+    last_id = int(load_checkpoint(conn, USERS_JOB_NAME) or 0)
+    processed = 0
+    while True:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT id, email, created_at FROM users
+                WHERE id > %s ORDER BY id LIMIT %s
+            """, (last_id, BATCH_SIZE))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            counts = Counter()
+            states = []
+            for _, email, created_at in rows:
+                cohort = month_start(created_at or datetime.utcnow())
+                counts[(cohort, "signups", 0)] += 1
+                states.append((email.lower(), cohort))
+            _add_counts(cursor, counts)
+            cursor.executemany("INSERT IGNORE INTO cohort_user_state (email, cohort_month) VALUES (%s, %s)", states)
+        except mysql.connector.Error:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        last_id = rows[-1][0]
+        save_checkpoint(conn, USERS_JOB_NAME, str(last_id))  # Commits the batch with its checkpoint
+        processed += len(rows)
+    return processed
+
+
+def _load_states(cursor, emails: list) -> dict:
+    """cohort_user_state rows for these emails, falling back to users.created_at for unseen users."""
+    placeholders = ", ".join(["%s"] * len(emails))
+    cursor.execute(f"""
+        SELECT email, cohort_month, is_premium, converted_month
+        FROM cohort_user_state WHERE email IN ({placeholders})
+    """, tuple(emails))
+    states = {row[0].lower(): {"cohort": row[1], "premium": bool(row[2]), "converted": row[3]}
+              for row in cursor.fetchall()}
+    missing = [e for e in emails if e not in states]
+    if missing:
+        # Signed up after this run's signup pass; their signup is counted next run
+        cursor.execute(f"SELECT email, created_at FROM users WHERE email IN ({', '.join(['%s'] * len(missing))})",
+                       tuple(missing))
+        for email, created_at in cursor.fetchall():
+            states[email.lower()] = {"cohort": month_start(created_at or datetime.utcnow()), "premium": False, "converted": None}
+    return states
+
+
+def process_events(conn) -> dict:
+    """Applies premium starts and churns logged since the last run."""
+    last_id = int(load_checkpoint(conn, EVENTS_JOB_NAME) or 0)
+    totals = Counter()
+    while True:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT id, email, action, timestamp FROM audit_logs
+                WHERE id > %s AND action IN (%s, %s) AND email IS NOT NULL
+                ORDER BY id LIMIT %s
+            """, (last_id, START_ACTION, CHURN_ACTION, BATCH_SIZE))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            states = _load_states(cursor, list({row[1].lower() for row in rows}))
+            counts = Counter()
+            changed = set()
+            for _, email, action, timestamp in rows:
+                state = states.get(email.lower())
+                if state is None or timestamp is None:
+                    totals["skipped"] += 1  # User deleted since, or an undated row
+                    continue
+                month = month_start(timestamp)
+                offset = months_between(state["cohort"], month)
+                if action == START_ACTION and not state["premium"]:
+                    state["premium"] = True
+                    counts[(state["cohort"], "premium", offset)] += 1
+                    if state["converted"] is None:
+                        state["converted"] = month
+                        counts[(state["cohort"], "converted", offset)] += 1
+                    changed.add(email.lower())
+                elif action == CHURN_ACTION and state["premium"]:
+                    state["premium"] = False
+                    counts[(state["cohort"], "premium", offset)] -= 1
+                    changed.add(email.lower())
+                else:
+                    totals["ignored"] += 1  # Repeated start, or churn of a user who was not premium
+            _add_counts(cursor, counts)
+            if changed:
+                cursor.executemany("""
+                    INSERT INTO cohort_user_state (email, cohort_month, is_premium, converted_month)
+                    VALUES (%s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE is_premium = VALUES(is_premium), converted_month = VALUES(converted_month)
+                """, [(e, states[e]["cohort"], int(states[e]["premium"]), states[e]["converted"]) for e in changed])
+        except mysql.connector.Error:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        last_id = rows[-1][0]
+        save_checkpoint(conn, EVENTS_JOB_NAME, str(last_id))
+        totals["events"] += len(rows)
+    return dict(totals)
+
+
+def rebuild(conn):
+    """Drops the matrix and state so the next run recomputes from the full history."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DELETE FROM cohort_retention")
+        cursor.execute("DELETE FROM cohort_user_state")
+        conn.commit()
+    finally:
+        cursor.close()
+    clear_checkpoint(conn, USERS_JOB_NAME)
+    clear_checkpoint(conn, EVENTS_JOB_NAME)
+
+
+def update(rebuild_first: bool = False) -> dict:
+    """The daily job: folds new signups and subscription events into the matrix."""
+    started = time.perf_counter()
+    conn = _connect()
+    try:
+        if rebuild_first:
+            rebuild(conn)
+        signups = process_signups(conn)
+        events = process_events(conn)
+    finally:
+        if conn.is_connected():
+            conn.close()
+    elapsed = round(time.perf_counter() - started, 2)
+    print(f"✅ [Cohorts] Added {signups} signup(s) and {events.get('events', 0)} subscription event(s) "
+          f"({events.get('ignored', 0)} repeated, {events.get('skipped', 0)} skipped) in {elapsed}s.")
+    return {"signups": signups, "elapsed_seconds": elapsed, **events}
+
+
+def retention_matrix(months: int = 12, today: date = None) -> list:
+    """The last `months` signup cohorts, each with one cell per month since signup (up to now).
+
+    Cells carry 'converted' (cumulative users who have gone premium), 'premium'
+    (users premium at the end of that month) and the matching percentages:
+    conversion of the cohort, and retention of those who converted.
+    """
+    today = today or datetime.utcnow().date()
+    first = _shift_months(month_start(today), -(months - 1))
+    conn = None
+    cursor = None
+    try:
+        conn = _connect()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT cohort_month, metric, months_since, users
+            FROM cohort_retention
+            WHERE cohort_month >= %s
+        """, (first,))
+        rows = cursor.fetchall()
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+
+    by_cohort = {}
+    for cohort_month, metric, months_since, users in rows:
+        by_cohort.setdefault(cohort_month, {}).setdefault(metric, Counter())[months_since] += users
+
+    cohorts = []
+    for cohort_month in sorted(by_cohort, reverse=True):
+        metrics = by_cohort[cohort_month]
+        size = metrics.get("signups", Counter())[0]
+        age = months_between(cohort_month, month_start(today))
+        converted = premium = 0
+        cells = []
+        for k in range(age + 1):
+            converted += metrics.get("converted", Counter())[k]
+            premium += metrics.get("premium", Counter())[k]
+            cells.append({
+                "converted": converted,
+                "premium": premium,
+                "conversion_pct": round(converted * 100.0 / size, 1) if size else None,
+                "retention_pct": round(premium * 100.0 / converted, 1) if converted else None,
+            })
+        cohorts.append({"cohort": cohort_month.strftime("%Y-%m"), "signups": size, "cells": cells})
+    return cohorts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Update the signup cohort retention matrix.")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute the matrix from the full history")
+    parser.add_argument("--print", dest="print_matrix", action="store_true", help="Print the last 12 cohorts afterwards")
+    args = parser.parse_args(argv)
+
+    update(rebuild_first=args.rebuild)
+    if args.print_matrix:
+        for row in retention_matrix():
+            cells = " ".join(f"{c['conversion_pct'] if c['conversion_pct'] is not None else '-':>5}" for c in row["cells"])
+            print(f"  {row['cohort']} ({row['signups']:>5} signups)  conversion %: {cells}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
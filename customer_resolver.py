@@ -0,0 +1,256 @@
+# customer_resolver.py
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import mysql.connector
+import stripe
+from dotenv import load_dotenv
+
+import invalidation_bus
+import stripe_client
+
+load_dotenv()
+
+# Maps between Stripe customer IDs and user emails, in both directions.
+# Lookups go to a bounded in-memory LRU first, then to the users table
+# (stripe_customer_id is indexed), and only ask Stripe when neither knows the
+# answer. Checkout handling records new mappings as soon as it links a
+# customer to a user; customers found by a Stripe email search are written
+# back to users.stripe_customer_id. Whenever a user's customer changes, linked()
+# publishes a "user" invalidation so other workers drop the old mapping.
+# Concurrent lookups of the same email share one Stripe search.
+# Index: add_users_stripe_customer_index.sql
+CUSTOMER_CACHE_SIZE = int(os.getenv("CUSTOMER_CACHE_SIZE", "10000"))
+
+_by_customer = OrderedDict()
+_by_email = OrderedDict()
+_lock = threading.Lock()
+_inflight = {}
+_stats = {"memory_hits": 0, "db_hits": 0, "stripe_lookups": 0, "stripe_searches": 0, "shared_lookups": 0}
+
+
+def _cache_get(cache: OrderedDict, key: str) -> Optional[str]:
+    with _lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+            _stats["memory_hits"] += 1
+        return value
+
+
+def _cache_put(cache: OrderedDict, key: str, value: str):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > CUSTOMER_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def remember(customer_id: str, email: str):
+    """Records a customer ↔ email mapping in this worker's LRUs."""
+    if not customer_id or not email:
+        return
+    with _lock:
+        _cache_put(_by_customer, customer_id, email)
+        _cache_put(_by_email, email, customer_id)
+
+
+def linked(customer_id: str, email: str):
+    """Records that the user's row now points at this customer, in every worker.
+
+    The "user" invalidation drops the email's old mapping everywhere (and the
+    entitlement cache entry); this worker then remembers the new one.
+    """
+    if not customer_id or not email:
+        return
+    invalidation_bus.publish("user", email)
+    remember(customer_id, email)
+
+
+def _email_from_db(customer_id: str) -> Optional[str]:
+    conn = None
+    cursor = None
+    try:
+        conn = mysql.connector.connect(
+            host=os.getenv("DB_HOST"),
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASS"),
+            database=os.getenv("DB_NAME")
+        )
+        cursor = conn.cursor()
+        cursor.execute("SELECT email FROM users WHERE stripe_customer_id = %s LIMIT 1", (customer_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+
+
+def linked_email_for_customer(customer_id: str) -> Optional[str]:
+    """The email of the local user linked to this customer, from the users table only.
+
+    Unlike email_for_customer this never asks Stripe, so a customer that no
+    user is linked to resolves to None.
+    """
+    if not customer_id:
+        return None
+    email = _email_from_db(customer_id)
+    if email:
+        with _lock:
+            _stats["db_hits"] += 1
+        remember(customer_id, email)
+    return email
+
+
+def email_for_customer(customer_id: str) -> Optional[str]:
+    """Resolves a Stripe customer ID to an email, or None if it cannot be found.
+
+    DB and Stripe errors propagate so webhook processing can be retried.
+    """
+    if not customer_id:
+        return None
+    email = _cache_get(_by_customer, customer_id)
+    if email:
+        return email
+
+    email = _email_from_db(customer_id)
+    if email:
+        with _lock:
+            _stats["db_hits"] += 1
+    else:
+        with _lock:
+            _stats["stripe_lookups"] += 1
+        customer = stripe_client.call("customer.retrieve", stripe.Customer.retrieve, customer_id)
+        if customer.get("deleted"):
+            return None
+        email = customer.get("email")
+        print(f"ℹ️ [Customers] Resolved {customer_id} via Stripe (not linked to a user locally).")
+
+    remember(customer_id, email)
+    return email
+
+
+def _customer_from_db(email: str) -> Optional[str]:
+    conn = None
+    cursor = None
+    try:
+        conn = mysql.connector.connect(
+            host=os.getenv("DB_HOST"),
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASS"),
+            database=os.getenv("DB_NAME")
+        )
+        cursor = conn.cursor()
+        cursor.execute("SELECT stripe_customer_id FROM users WHERE email = %s", (email,))
+        row = cursor.fetchone()
+        return row[0] if row and row[0] else None
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+
+
+def _store_customer_id(email: str, customer_id: str):
+    """Writes a customer found by Stripe search back to the user's row."""
+    conn = None
+    cursor = None
+    try:
+        conn = mysql.connector.connect(
+            host=os.getenv("DB_HOST"),
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASS"),
+            database=os.getenv("DB_NAME")
+        )
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE users SET stripe_customer_id = %s WHERE email = %s AND stripe_customer_id IS NULL",
+            (customer_id, email)
+        )
+        conn.commit()
+        updated = cursor.rowcount
+    except mysql.connector.Error as err:
+        print(f"🔥 [Customers] Could not store customer ID {customer_id} for {email}: {err}")
+        return
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+    if updated:
+        linked(customer_id, email)
+
+
+def _lookup_customer(email: str) -> Optional[str]:
+    customer_id = _customer_from_db(email)
+    if customer_id:
+        with _lock:
+            _stats["db_hits"] += 1
+        return customer_id
+
+    with _lock:
+        _stats["stripe_searches"] += 1
+    customers = stripe_client.call("customer.list", stripe.Customer.list, email=email, limit=1).data
+    if not customers:
+        return None
+    customer_id = customers[0].id
+    print(f"ℹ️ [Customers] Found Stripe customer {customer_id} for {email} by email search.")
+    _store_customer_id(email, customer_id)
+    return customer_id
+
+
+def customer_for_email(email: str) -> Optional[str]:
+    """Resolves a user's Stripe customer ID, or None if Stripe has no customer for them.
+
+    Concurrent calls for the same email wait for a single lookup. DB and Stripe
+    errors propagate to every waiting caller.
+    """
+    if not email:
+        return None
+    customer_id = _cache_get(_by_email, email)
+    if customer_id:
+        return customer_id
+
+    with _lock:
+        flight = _inflight.get(email)
+        leader = flight is None
+        if leader:
+            flight = {"done": threading.Event(), "result": None, "error": None}
+            _inflight[email] = flight
+        else:
+            _stats["shared_lookups"] += 1
+
+    if not leader:
+        flight["done"].wait()
+        if flight["error"]:
+            raise flight["error"]
+        return flight["result"]
+
+    try:
+        flight["result"] = _lookup_customer(email)
+        remember(flight["result"], email)
+    except Exception as e:
+        flight["error"] = e
+        raise
+    finally:
+        with _lock:
+            _inflight.pop(email, None)
+        flight["done"].set()
+    return flight["result"]
+
+
+def resolver_stats() -> dict:
+    with _lock:
+        return dict(_stats, cached_customers=len(_by_customer), cached_emails=len(_by_email))
+
+
+def _forget_email(email: Optional[str]):
+    """Drops mappings for a user whose row changed (key None clears everything)."""
+    with _lock:
+        if email is None:
+            _by_customer.clear()
+            _by_email.clear()
+            return
+        _by_email.pop(email, None)
+        for customer_id in [c for c, e in _by_customer.items() if e == email]:
+            del _by_customer[customer_id]
+
+
+invalidation_bus.subscribe("user", _forget_email)
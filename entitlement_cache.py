@@ -0,0 +1,122 @@
+# entitlement_cache.py
+import os
+import threading
+from typing import Optional
+
+import mysql.connector
+from cachetools import TTLCache
+from dotenv import load_dotenv
+
+import invalidation_bus
+
+load_dotenv()
+
+# Bounded per-user cache of subscription entitlements. Entries expire after the
+# TTL as a safety net, but the normal path is explicit invalidation whenever a
+# webhook, login reconciliation or admin action changes the user's row. Each
+# worker keeps its own copy; invalidations reach the others over the bus.
+ENTITLEMENT_NAMESPACE = "entitlement"
+ENTITLEMENT_CACHE_SIZE = int(os.getenv("ENTITLEMENT_CACHE_SIZE", "10000"))
+ENTITLEMENT_CACHE_TTL = int(os.getenv("ENTITLEMENT_CACHE_TTL", "300"))
+
+_cache = TTLCache(maxsize=ENTITLEMENT_CACHE_SIZE, ttl=ENTITLEMENT_CACHE_TTL)
+_lock = threading.Lock()
+# email -> [generation, loads in flight], only while a load is running. _drop
+# bumps the generation so a row read before an invalidation is not cached.
+_generations = {}
+
+
+def _load_entitlement(email: str) -> Optional[dict]:
+    """Reads the entitlement fields for a user straight from the users table."""
+    conn = None
+    cursor = None
+    try:
+        conn = mysql.connector.connect(
+            host=os.getenv("DB_HOST"),
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASS"),
+            database=os.getenv("DB_NAME")
+        )
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("""
+            SELECT is_premium, subscription_type, subscription_status,
+                   current_period_end, stripe_customer_id, subscription_id
+            FROM users
+            WHERE email = %s
+        """, (email,))
+        row = cursor.fetchone()
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+
+    if not row:
+        return None
+
+    return {
+        "is_premium": bool(row.get("is_premium")),
+        "plan": row.get("subscription_type"),
+        "status": row.get("subscription_status"),
+        "period_end": row.get("current_period_end"),
+        "stripe_customer_id": row.get("stripe_customer_id"),
+        "subscription_id": row.get("subscription_id"),
+    }
+
+
+def get_entitlement(email: str) -> Optional[dict]:
+    """Returns the cached entitlement for a user, loading it from the DB on a miss.
+
+    Returns None when the user does not exist. Database errors propagate so
+    callers can fall back the same way they did before the cache existed.
+    """
+    with _lock:
+        cached = _cache.get(email)
+        if cached is not None:
+            return dict(cached)
+        state = _generations.setdefault(email, [0, 0])
+        state[1] += 1
+        generation = state[0]
+
+    entitlement = None
+    try:
+        entitlement = _load_entitlement(email)
+    finally:
+        with _lock:
+            state = _generations[email]
+            state[1] -= 1
+            if state[1] == 0:
+                del _generations[email]
+            # Not cached if invalidated while loading: the row may predate the change
+            if entitlement is not None and state[0] == generation:
+                _cache[email] = entitlement
+    if entitlement is None:
+        return None
+    return dict(entitlement)
+
+
+def _drop(email: Optional[str]):
+    with _lock:
+        if email is None:
+            _cache.clear()
+            for state in _generations.values():
+                state[0] += 1
+        else:
+            _cache.pop(email, None)
+            if email in _generations:
+                _generations[email][0] += 1
+
+
+def invalidate_entitlement(email: str):
+    """Drops a user's cached entitlement in every worker so the next read goes to the DB."""
+    if not email:
+        return
+    invalidation_bus.publish(ENTITLEMENT_NAMESPACE, email)
+
+
+def clear_entitlements():
+    """Drops every cached entitlement in every worker."""
+    invalidation_bus.publish(ENTITLEMENT_NAMESPACE, None)
+
+
+invalidation_bus.subscribe(ENTITLEMENT_NAMESPACE, _drop)
+# Any change to a user's row (ban/disable, admin edits, profile updates) is published on "user"
+invalidation_bus.subscribe("user", _drop)
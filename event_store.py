@@ -0,0 +1,137 @@
+# event_store.py
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import mysql.connector
+from mysql.connector import errorcode
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Idempotency store for Stripe events, which are delivered at least once.
+# A delivery is accepted only if its (event_id, endpoint) pair can be claimed
+# by inserting into processed_events; the primary key makes the claim atomic
+# across workers. A bounded in-memory set of recently seen IDs sits in front
+# so redeliveries hitting the same worker are rejected without a DB round trip.
+# claim_in() records a claim inside the caller's transaction, so the webhook
+# queue can claim and enqueue an event atomically. Claims older than
+# EVENT_STORE_RETENTION_DAYS (well past Stripe's 3-day redelivery window) are
+# pruned by the webhook dispatcher.
+# Schema: add_processed_events_table.sql
+EVENT_STORE_RECENT_SIZE = int(os.getenv("EVENT_STORE_RECENT_SIZE", "10000"))
+EVENT_STORE_RETENTION_DAYS = int(os.getenv("EVENT_STORE_RETENTION_DAYS", "30"))
+PRUNE_BATCH_SIZE = 1000
+
+_recent = OrderedDict()
+_recent_lock = threading.Lock()
+
+
+def _remember(key: tuple):
+    with _recent_lock:
+        _recent[key] = True
+        _recent.move_to_end(key)
+        while len(_recent) > EVENT_STORE_RECENT_SIZE:
+            _recent.popitem(last=False)
+
+
+def seen_recently(event_id: str, endpoint: str) -> bool:
+    """True if this worker has already claimed or rejected the event (no DB access)."""
+    with _recent_lock:
+        return (event_id, endpoint) in _recent
+
+
+def mark_seen(event_id: str, endpoint: str):
+    """Records a claim committed by the caller (after claim_in) in this worker's recent set."""
+    _remember((event_id, endpoint))
+
+
+def claim_in(cursor, event_id: str, event_type: str, endpoint: str) -> bool:
+    """Inserts a claim in the caller's transaction. Returns False if the event is already claimed.
+
+    Nothing is committed: the claim lands or rolls back with the caller's other
+    writes. Call mark_seen() once the transaction has committed.
+    """
+    try:
+        cursor.execute(
+            "INSERT INTO processed_events (event_id, endpoint, event_type, claimed_at) VALUES (%s, %s, %s, %s)",
+            (event_id, endpoint, event_type, datetime.utcnow())
+        )
+    except mysql.connector.IntegrityError as err:
+        if err.errno != errorcode.ER_DUP_ENTRY:
+            raise
+        return False
+    return True
+
+
+def claim(event_id: str, event_type: str, endpoint: str) -> bool:
+    """Atomically claims an event for processing. Returns False for a duplicate delivery.
+
+    Raises mysql.connector.Error if the claim could not be recorded.
+    """
+    key = (event_id, endpoint)
+    if seen_recently(event_id, endpoint):
+        return False
+
+    conn = None
+    cursor = None
+    try:
+        conn = mysql.connector.connect(
+            host=os.getenv("DB_HOST"),
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASS"),
+            database=os.getenv("DB_NAME")
+        )
+        cursor = conn.cursor()
+        claimed = claim_in(cursor, event_id, event_type, endpoint)
+        conn.commit()
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+
+    _remember(key)
+    return claimed
+
+
+def release(event_id: str, endpoint: str):
+    """Gives up a claim after a failure so Stripe's next delivery is processed."""
+    with _recent_lock:
+        _recent.pop((event_id, endpoint), None)
+
+    conn = None
+    cursor = None
+    try:
+        conn = mysql.connector.connect(
+            host=os.getenv("DB_HOST"),
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASS"),
+            database=os.getenv("DB_NAME")
+        )
+        cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM processed_events WHERE event_id = %s AND endpoint = %s",
+            (event_id, endpoint)
+        )
+        conn.commit()
+    except mysql.connector.Error as err:
+        print(f"🔥 [EventStore] Could not release claim on {event_id} ({endpoint}): {err}")
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+
+
+def prune(conn) -> int:
+    """Deletes claims older than the retention window, in batches. Returns rows deleted."""
+    cutoff = datetime.utcnow() - timedelta(days=EVENT_STORE_RETENTION_DAYS)
+    deleted = 0
+    cursor = conn.cursor()
+    try:
+        while True:
+            cursor.execute("DELETE FROM processed_events WHERE claimed_at < %s LIMIT %s", (cutoff, PRUNE_BATCH_SIZE))
+            conn.commit()
+            deleted += cursor.rowcount
+            if cursor.rowcount < PRUNE_BATCH_SIZE:
+                return deleted
+    finally:
+        cursor.close()
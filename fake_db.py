@@ -0,0 +1,335 @@
+# fake_db.py
+"""
+SQLite-backed stand-in for mysql.connector, used by the benchmark harnesses.
+
+install() patches mysql.connector.connect so the app's unmodified DB code runs
+against a local SQLite file: %s placeholders are translated, dictionary cursors
+are supported and duplicate keys surface as mysql.connector.IntegrityError with
+errno 1062. ON DUPLICATE KEY UPDATE becomes SQLite's ON CONFLICT DO UPDATE
+(VALUES(col) is excluded.col), IF/LEAST/GREATEST/TIMESTAMPDIFF(SECOND, ...)
+are provided and FOR UPDATE is dropped, so the batched flushes of the session tracker run as they do
+in production. Unlike MySQL, later assignments in an upsert see the old row.
+It covers the SQL used on the auth/billing/webhook and request-tracking
+paths, not every MySQL feature (DATE_SUB, named locks and friends are not
+emulated).
+"""
+import os
+import re
+import sqlite3
+import tempfile
+from datetime import date, datetime
+
+import mysql.connector
+from mysql.connector import errorcode
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT UNIQUE NOT NULL COLLATE NOCASE,
+    password_hash TEXT NOT NULL,
+    display_name TEXT,
+    security_question_1 TEXT,
+    security_answer_1_hash TEXT,
+    security_question_2 TEXT,
+    security_answer_2_hash TEXT,
+    is_premium INTEGER DEFAULT 0,
+    is_disabled INTEGER DEFAULT 0,
+    is_banned INTEGER DEFAULT 0,
+    subscription_type TEXT,
+    subscription_status TEXT,
+    subscription_id TEXT,
+    stripe_customer_id TEXT,
+    current_period_end TIMESTAMP,
+    notify_newsletter INTEGER DEFAULT 0,
+    reset_attempts INTEGER DEFAULT 0,
+    failed_logins INTEGER DEFAULT 0,
+    lock_until TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_users_stripe_customer_id ON users (stripe_customer_id);
+CREATE TABLE IF NOT EXISTS audit_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT,
+    action TEXT,
+    category TEXT,
+    details TEXT,
+    timestamp TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS session_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT,
+    login_time TIMESTAMP,
+    logout_time TIMESTAMP,
+    duration_seconds INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS page_views (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT,
+    path TEXT,
+    ip_address TEXT,
+    timestamp TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS user_sessions (
+    session_id TEXT NOT NULL PRIMARY KEY,
+    email TEXT NOT NULL,
+    started_at TIMESTAMP NOT NULL,
+    last_seen_at TIMESTAMP NOT NULL,
+    ended_at TIMESTAMP DEFAULT NULL,
+    duration_seconds INTEGER NOT NULL DEFAULT 0,
+    page_views INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_user_sessions_open ON user_sessions (ended_at, last_seen_at);
+CREATE TABLE IF NOT EXISTS user_activity_daily (
+    activity_date DATE NOT NULL,
+    email TEXT NOT NULL,
+    sessions INTEGER NOT NULL DEFAULT 0,
+    page_views INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (activity_date, email)
+);
+CREATE TABLE IF NOT EXISTS activity_sketches (
+    metric TEXT NOT NULL,
+    day DATE NOT NULL,
+    registers BLOB NOT NULL,
+    PRIMARY KEY (metric, day)
+);
+CREATE TABLE IF NOT EXISTS traffic_hourly (
+    hour TIMESTAMP NOT NULL,
+    segment TEXT NOT NULL,
+    views INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (hour, segment)
+);
+CREATE TABLE IF NOT EXISTS traffic_paths_daily (
+    day DATE NOT NULL,
+    path TEXT NOT NULL,
+    segment TEXT NOT NULL,
+    views INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, path, segment)
+);
+CREATE TABLE IF NOT EXISTS processed_events (
+    event_id TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    event_type TEXT NOT NULL,
+    claimed_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (event_id, endpoint)
+);
+CREATE TABLE IF NOT EXISTS stripe_webhook_events (
+    event_id TEXT NOT NULL PRIMARY KEY,
+    event_type TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    customer_id TEXT DEFAULT NULL,
+    object_id TEXT DEFAULT NULL,
+    event_created INTEGER DEFAULT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL,
+    locked_at TIMESTAMP DEFAULT NULL,
+    last_error TEXT DEFAULT NULL,
+    received_at TIMESTAMP NOT NULL,
+    processed_at TIMESTAMP DEFAULT NULL
+);
+CREATE TABLE IF NOT EXISTS job_checkpoints (
+    job_name TEXT NOT NULL PRIMARY KEY,
+    cursor_value TEXT DEFAULT NULL,
+    updated_at TIMESTAMP NOT NULL
+);
+CREATE TABLE IF NOT EXISTS invoice_ledger (
+    invoice_id TEXT NOT NULL PRIMARY KEY,
+    customer_id TEXT DEFAULT NULL,
+    subscription_id TEXT DEFAULT NULL,
+    customer_email TEXT DEFAULT NULL,
+    amount_paid INTEGER NOT NULL,
+    currency TEXT NOT NULL,
+    period_start TIMESTAMP DEFAULT NULL,
+    period_end TIMESTAMP DEFAULT NULL,
+    paid_at TIMESTAMP NOT NULL,
+    price_id TEXT DEFAULT NULL,
+    plan TEXT DEFAULT NULL,
+    billing_reason TEXT DEFAULT NULL,
+    recorded_at TIMESTAMP NOT NULL
+);
+CREATE TABLE IF NOT EXISTS churn_monthly (
+    month DATE NOT NULL PRIMARY KEY,
+    churned INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS cohort_retention (
+    cohort_month DATE NOT NULL,
+    metric TEXT NOT NULL,
+    months_since INTEGER NOT NULL,
+    users INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (cohort_month, metric, months_since)
+);
+CREATE TABLE IF NOT EXISTS cohort_user_state (
+    email TEXT NOT NULL PRIMARY KEY,
+    cohort_month DATE NOT NULL,
+    is_premium INTEGER NOT NULL DEFAULT 0,
+    converted_month DATE DEFAULT NULL
+);
+"""
+
+_PLACEHOLDER = re.compile(r"%s")
+_UPSERT = re.compile(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", re.IGNORECASE)
+_VALUES_REF = re.compile(r"\bVALUES\((\w+)\)", re.IGNORECASE)
+_REWRITES = [
+    (re.compile(r"\bIF\(", re.IGNORECASE), "iif("),
+    (re.compile(r"\s+FOR\s+UPDATE\b", re.IGNORECASE), ""),  # SQLite serialises writers anyway
+    (re.compile(r"\bTIMESTAMPDIFF\(\s*SECOND\s*,", re.IGNORECASE), "TIMESTAMPDIFF_SECONDS("),
+]
+_db_path = None
+_original_connect = None
+
+sqlite3.register_adapter(datetime, lambda d: d.isoformat(" "))
+sqlite3.register_adapter(date, lambda d: d.isoformat())
+sqlite3.register_converter("TIMESTAMP", lambda b: datetime.fromisoformat(b.decode()))
+sqlite3.register_converter("DATE", lambda b: date.fromisoformat(b.decode()[:10]))
+
+
+def _translate(operation: str) -> str:
+    """MySQL statement -> SQLite statement, for the dialect bits the app uses."""
+    sql = _PLACEHOLDER.sub("?", operation)
+    sql = sql.replace("INSERT IGNORE", "INSERT OR IGNORE")
+    upsert = _UPSERT.search(sql)
+    if upsert:
+        update = _VALUES_REF.sub(r"excluded.\1", sql[upsert.end():])
+        sql = sql[:upsert.start()] + "ON CONFLICT DO UPDATE SET" + update
+    for pattern, replacement in _REWRITES:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+
+def _extreme(pick):
+    """MySQL LEAST/GREATEST: NULL if any argument is NULL."""
+    def fn(*values):
+        return None if any(v is None for v in values) else pick(values)
+    return fn
+
+
+def _timestampdiff_seconds(start, end):
+    if start is None or end is None:
+        return None
+    return int((datetime.fromisoformat(str(end)) - datetime.fromisoformat(str(start))).total_seconds())
+
+
+class FakeCursor:
+    def __init__(self, conn, dictionary=False):
+        self._cursor = conn._sqlite.cursor()
+        self._dictionary = dictionary
+        self.rowcount = -1
+        self.lastrowid = None
+        self.description = None
+
+    def execute(self, operation, params=()):
+        sql = _translate(operation)
+        try:
+            self._cursor.execute(sql, tuple(params or ()))
+        except sqlite3.IntegrityError as e:
+            raise mysql.connector.IntegrityError(msg=str(e), errno=errorcode.ER_DUP_ENTRY)
+        except sqlite3.Error as e:
+            raise mysql.connector.ProgrammingError(msg=f"{e} [fake_db: {sql.strip()[:120]}]")
+        self.rowcount = self._cursor.rowcount
+        self.lastrowid = self._cursor.lastrowid
+        self.description = self._cursor.description
+
+    def executemany(self, operation, seq_params):
+        for params in seq_params:
+            self.execute(operation, params)
+
+    def _convert(self, row):
+        if row is None or not self._dictionary:
+            return row
+        return {col[0]: value for col, value in zip(self._cursor.description, row)}
+
+    def fetchone(self):
+        return self._convert(self._cursor.fetchone())
+
+    def fetchall(self):
+        return [self._convert(row) for row in self._cursor.fetchall()]
+
+    def close(self):
+        # Like mysql-connector: closing twice, or after the connection, is a no-op
+        try:
+            self._cursor.close()
+        except sqlite3.ProgrammingError:
+            pass
+
+
+class FakeConnection:
+    def __init__(self, path):
+        self._sqlite = sqlite3.connect(
+            path, timeout=30, check_same_thread=False,
+            detect_types=sqlite3.PARSE_DECLTYPES, isolation_level="DEFERRED"
+        )
+        self._sqlite.execute("PRAGMA busy_timeout = 30000")
+        self._sqlite.create_function("LEAST", -1, _extreme(min), deterministic=True)
+        self._sqlite.create_function("GREATEST", -1, _extreme(max), deterministic=True)
+        self._sqlite.create_function("TIMESTAMPDIFF_SECONDS", 2, _timestampdiff_seconds, deterministic=True)
+        self._open = True
+
+    def cursor(self, dictionary=False, buffered=None):
+        return FakeCursor(self, dictionary=dictionary)
+
+    def commit(self):
+        self._sqlite.commit()
+
+    def rollback(self):
+        self._sqlite.rollback()
+
+    def start_transaction(self):
+        pass
+
+    def is_connected(self):
+        return self._open
+
+    def close(self):
+        if self._open:
+            self._sqlite.close()
+            self._open = False
+
+
+def install(path: str = None) -> str:
+    """Points mysql.connector.connect at a fresh SQLite database and returns its path."""
+    global _db_path, _original_connect
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix="cricketapp-bench-", suffix=".sqlite3")
+        os.close(fd)
+    _db_path = path
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(SCHEMA)
+    conn.commit()
+    conn.close()
+
+    if _original_connect is None:
+        _original_connect = mysql.connector.connect
+    mysql.connector.connect = lambda *args, **kwargs: FakeConnection(_db_path)
+    return path
+
+
+def uninstall():
+    """Restores the real mysql.connector.connect and removes the SQLite file."""
+    global _db_path, _original_connect
+    if _original_connect is not None:
+        mysql.connector.connect = _original_connect
+        _original_connect = None
+    if _db_path:
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(_db_path + suffix)
+            except OSError:
+                pass
+        _db_path = None
+
+
+def seed_users(users: list):
+    """Bulk-inserts user rows (dicts of column -> value) into the fake database."""
+    if not users:
+        return
+    conn = FakeConnection(_db_path)
+    cursor = conn.cursor()
+    columns = list(users[0].keys())
+    sql = f"INSERT INTO users ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+    for user in users:
+        cursor.execute(sql, tuple(user[c] for c in columns))
+    conn.commit()
+    conn.close()
@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+# fake_stripe.py
+"""
+Local Stripe API stand-in for benchmarks and offline testing.
+
+Serves the subset of the Stripe REST API the app uses from in-memory state:
+customers (list/retrieve/create), subscriptions (list/retrieve/modify/cancel),
+checkout sessions (create/retrieve, with line_items/subscription expansion),
+billing portal sessions and prices. Latency, jitter and error rates are
+configurable, POSTs honour Idempotency-Key, and WebhookEmitter sends
+correctly signed events to a webhook endpoint at a chosen rate.
+
+Point the SDK at it with:
+
+    stripe.api_base = fake.base_url
+
+Usage:
+    python fake_stripe.py --port 12111 --latency-ms 150 --error-rate 0.02
+    python fake_stripe.py --emit-webhooks http://127.0.0.1:8000/api/webhook \\
+        --webhook-secret whsec_test --customers 200 --rate 50
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+DEFAULT_PRICES = [
+    {"id": "price_monthly", "nickname": "Monthly", "unit_amount": 499, "interval": "month"},
+    {"id": "price_annual", "nickname": "Annual", "unit_amount": 4999, "interval": "year"},
+]
+
+
+def _new_id(prefix: str) -> str:
+    return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+
+def _list_object(url: str, data: list, has_more: bool = False) -> dict:
+    return {"object": "list", "url": url, "has_more": has_more, "data": data}
+
+
+def _error(status: int, message: str, error_type: str = "invalid_request_error") -> tuple:
+    return status, {"error": {"type": error_type, "message": message}}
+
+
+def _expansions(params: dict) -> set:
+    """Collects expand[]/expand[0]... values from form-encoded params."""
+    return {v for k, v in params.items() if k == "expand" or k.startswith("expand[")}
+
+
+def _page(items: list, params: dict, url: str) -> tuple:
+    """Cursor pagination over items (already in list order) using starting_after/limit."""
+    limit = min(int(params.get("limit", 10)), 100)
+    start = 0
+    starting_after = params.get("starting_after")
+    if starting_after:
+        ids = [i["id"] for i in items]
+        if starting_after not in ids:
+            return _error(400, f"No such object: '{starting_after}'")
+        start = ids.index(starting_after) + 1
+    page = items[start:start + limit]
+    return 200, _list_object(url, page, has_more=start + limit < len(items))
+
+
+class FakeStripe:
+    """In-memory Stripe state plus the HTTP server that exposes it."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.customers = {}
+        self.subscriptions = {}
+        self.checkout_sessions = {}
+        self.prices = {}
+        self.request_count = 0
+        self.requests_by_route = {}
+        self._injected = []  # [path prefix, status, remaining]
+        self._idempotent = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        for price in DEFAULT_PRICES:
+            self.add_price(price["id"], price["unit_amount"], price["interval"], nickname=price["nickname"])
+
+    # --- State helpers ---
+
+    def add_price(self, price_id: str, unit_amount: int, interval: str, currency: str = "usd", nickname: str = None) -> dict:
+        price = {
+            "id": price_id, "object": "price", "active": True, "currency": currency,
+            "unit_amount": unit_amount, "nickname": nickname, "product": _new_id("prod"),
+            "recurring": {"interval": interval, "interval_count": 1}, "type": "recurring",
+        }
+        with self._lock:
+            self.prices[price_id] = price
+        return price
+
+    def add_customer(self, email: str, customer_id: str = None) -> dict:
+        customer = {"id": customer_id or _new_id("cus"), "object": "customer", "email": email, "created": int(time.time())}
+        with self._lock:
+            self.customers[customer["id"]] = customer
+        return customer
+
+    def add_subscription(self, customer_id: str, price_id: str = "price_monthly", status: str = "active", period_days: int = None) -> dict:
+        now = int(time.time())
+        price = self.prices.get(price_id) or {"id": price_id, "object": "price"}
+        if period_days is None:
+            period_days = 365 if (price.get("recurring") or {}).get("interval") == "year" else 30
+        subscription = {
+            "id": _new_id("sub"),
+            "object": "subscription",
+            "customer": customer_id,
+            "status": status,
+            "created": now,
+            "current_period_start": now,
+            "current_period_end": now + period_days * 86400,
+            "cancel_at_period_end": False,
+            "canceled_at": None,
+            "metadata": {},
+            "items": _list_object("/v1/subscription_items", [
+                {"id": _new_id("si"), "object": "subscription_item", "price": price, "quantity": 1}
+            ]),
+        }
+        with self._lock:
+            self.subscriptions[subscription["id"]] = subscription
+        return subscription
+
+    def complete_checkout(self, session_id: str) -> dict:
+        """Simulates the customer paying: creates customer + subscription and completes the session."""
+        session = self.checkout_sessions[session_id]
+        customer_id = session.get("customer")
+        if not customer_id:
+            customer_id = self.add_customer(session["customer_email"])["id"]
+        price_id = session["_line_items"][0]["price"]["id"]
+        subscription = self.add_subscription(customer_id, price_id)
+        with self._lock:
+            session.update(customer=customer_id, subscription=subscription["id"], status="complete", payment_status="paid")
+        return self._public_session(session)
+
+    def inject_errors(self, path_prefix: str, status: int, count: int = 1):
+        """Makes the next `count` requests under path_prefix fail with `status`."""
+        with self._lock:
+            self._injected.append([path_prefix, status, count])
+
+    # --- Routing ---
+
+    def handle(self, method: str, path: str, params: dict, headers: dict = None) -> tuple:
+        """Dispatches a Stripe API request and returns (status, body)."""
+        parts = [p for p in path.split("/") if p]
+        if not parts or parts[0] != "v1":
+            return _error(404, f"Unrecognized request URL ({method}: {path})")
+        resource = parts[1:]
+        route = f"{method} /v1/{resource[0] if resource else ''}"
+        with self._lock:
+            self.requests_by_route[route] = self.requests_by_route.get(route, 0) + 1
+
+        injected = self._take_injected_error(path)
+        if injected:
+            return injected
+
+        idempotency_key = (headers or {}).get("Idempotency-Key")
+        if method == "POST" and idempotency_key:
+            with self._lock:
+                cached = self._idempotent.get(idempotency_key)
+            if cached:
+                return cached
+            result = self._route(method, resource, params)
+            with self._lock:
+                self._idempotent[idempotency_key] = result
+            return result
+        return self._route(method, resource, params)
+
+    def _take_injected_error(self, path: str):
+        with self._lock:
+            for entry in self._injected:
+                if path.startswith(entry[0]) and entry[2] > 0:
+                    entry[2] -= 1
+                    return self._error_for(entry[1])
+            self._injected = [e for e in self._injected if e[2] > 0]
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            return self._error_for(429)
+        if roll < self.rate_limit_rate + self.error_rate:
+            return self._error_for(500)
+        return None
+
+    @staticmethod
+    def _error_for(status: int) -> tuple:
+        if status == 429:
+            return _error(429, "Too many requests hit the API too quickly.", "rate_limit_error")
+        if status >= 500:
+            return _error(status, "An unexpected error occurred (injected by fake Stripe).", "api_error")
+        return _error(status, "Injected error.")
+
+    def _route(self, method: str, resource: list, params: dict) -> tuple:
+        if resource == ["customers"]:
+            if method == "GET":
+                return self._list_customers(params)
+            if method == "POST":
+                return 200, self.add_customer(params.get("email"))
+        if len(resource) == 2 and resource[0] == "customers" and method == "GET":
+            customer = self.customers.get(resource[1])
+            return (200, customer) if customer else _error(404, f"No such customer: '{resource[1]}'")
+
+        if resource == ["subscriptions"] and method == "GET":
+            return self._list_subscriptions(params)
+        if len(resource) == 2 and resource[0] == "subscriptions":
+            return self._subscription(method, resource[1], params)
+
+        if resource == ["checkout", "sessions"] and method == "POST":
+            return self._create_checkout_session(params)
+        if len(resource) == 3 and resource[:2] == ["checkout", "sessions"] and method == "GET":
+            return self._retrieve_checkout_session(resource[2], params)
+
+        if resource == ["billing_portal", "sessions"] and method == "POST":
+            customer = params.get("customer")
+            if customer not in self.customers:
+                return _error(400, f"No such customer: '{customer}'")
+            session_id = _new_id("bps")
+            return 200, {"id": session_id, "object": "billing_portal.session", "customer": customer,
+                         "return_url": params.get("return_url"), "url": f"{self.base_url}/portal/{session_id}"}
+
+        if resource == ["prices"] and method == "GET":
+            prices = [p for p in self.prices.values()
+                      if params.get("active") is None or str(p["active"]).lower() == params["active"].lower()]
+            return _page(prices, params, "/v1/prices")
+
+        return _error(404, f"Unrecognized request URL ({method}: /v1/{'/'.join(resource)})")
+
+    def _list_customers(self, params: dict) -> tuple:
+        email = params.get("email")
+        with self._lock:
+            customers = [c for c in self.customers.values() if not email or c["email"] == email]
+        return _page(customers, params, "/v1/customers")
+
+    def _list_subscriptions(self, params: dict) -> tuple:
+        customer = params.get("customer")
+        status = params.get("status")
+        with self._lock:
+            # Stripe lists newest first
+            subs = sorted(
+                (s for s in self.subscriptions.values()
+                 if (not customer or s["customer"] == customer)
+                 and (status == "all" or (s["status"] == status if status else s["status"] != "canceled"))),
+                key=lambda s: s["created"], reverse=True,
+            )
+        status_code, body = _page(subs, params, "/v1/subscriptions")
+        if status_code == 200 and "data.customer" in _expansions(params):
+            body["data"] = [dict(s, customer=self.customers.get(s["customer"], s["customer"])) for s in body["data"]]
+        return status_code, body
+
+    def _subscription(self, method: str, subscription_id: str, params: dict) -> tuple:
+        with self._lock:
+            sub = self.subscriptions.get(subscription_id)
+            if not sub:
+                return _error(404, f"No such subscription: '{subscription_id}'")
+            if method == "POST":
+                if "cancel_at_period_end" in params:
+                    sub["cancel_at_period_end"] = params["cancel_at_period_end"] == "true"
+                for key, value in params.items():
+                    if key.startswith("metadata["):
+                        sub["metadata"][key[len("metadata["):-1]] = value
+            elif method == "DELETE":
+                sub.update(status="canceled", canceled_at=int(time.time()))
+            return 200, dict(sub)
+
+    def _create_checkout_session(self, params: dict) -> tuple:
+        price_id = params.get("line_items[0][price]")
+        if price_id not in self.prices:
+            return _error(400, f"No such price: '{price_id}'")
+        session_id = _new_id("cs_test")
+        session = {
+            "id": session_id, "object": "checkout.session", "mode": params.get("mode", "subscription"),
+            "customer": params.get("customer"), "customer_email": params.get("customer_email"),
+            "subscription": None, "status": "open", "payment_status": "unpaid",
+            "success_url": params.get("success_url"), "cancel_url": params.get("cancel_url"),
+            "url": f"{self.base_url}/checkout/{session_id}", "created": int(time.time()),
+            "_line_items": [{"id": _new_id("li"), "object": "item", "price": self.prices[price_id],
+                             "quantity": int(params.get("line_items[0][quantity]", 1))}],
+        }
+        with self._lock:
+            self.checkout_sessions[session_id] = session
+        return 200, self._public_session(session)
+
+    def _retrieve_checkout_session(self, session_id: str, params: dict) -> tuple:
+        session = self.checkout_sessions.get(session_id)
+        if not session:
+            return _error(404, f"No such checkout.session: '{session_id}'")
+        expand = _expansions(params)
+        body = self._public_session(session)
+        if "line_items" in expand:
+            body["line_items"] = _list_object(f"/v1/checkout/sessions/{session_id}/line_items", session["_line_items"])
+        if "subscription" in expand and session["subscription"]:
+            body["subscription"] = self.subscriptions.get(session["subscription"])
+        return 200, body
+
+    @staticmethod
+    def _public_session(session: dict) -> dict:
+        return {k: v for k, v in session.items() if not k.startswith("_")}
+
+    # --- Server lifecycle ---
+
+    def _simulate_latency(self):
+        delay = self.latency_ms
+        if self.jitter_ms:
+            delay += random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+    def start(self) -> str:
+        """Starts serving in a background thread and returns the base URL."""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self, method):
+                parsed = urlparse(self.path)
+                params = dict(parse_qsl(parsed.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    body = self.rfile.read(length).decode("utf-8")
+                    params.update(parse_qsl(body))
+                with fake._lock:
+                    fake.request_count += 1
+                fake._simulate_latency()
+                status, payload = fake.handle(method, parsed.path, params, dict(self.headers))
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("Request-Id", _new_id("req"))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._respond("GET")
+
+            def do_POST(self):
+                self._respond("POST")
+
+            def do_DELETE(self):
+                self._respond("DELETE")
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-stripe", daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+# --- Webhooks ---
+
+def sign_payload(payload: str, secret: str, timestamp: int = None) -> str:
+    """Builds a Stripe-Signature header value for payload."""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode("utf-8"), f"{timestamp}.{payload}".encode("utf-8"), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def make_event(event_type: str, obj: dict) -> dict:
+    return {
+        "id": _new_id("evt"), "object": "event", "type": event_type, "api_version": "2024-06-20",
+        "created": int(time.time()), "livemode": False, "pending_webhooks": 1,
+        "data": {"object": obj},
+    }
+
+
+class WebhookEmitter:
+    """Sends signed events to a webhook URL at a target rate and records the results."""
+
+    def __init__(self, fake: FakeStripe, url: str, secret: str, concurrency: int = 8):
+        self.fake = fake
+        self.url = url
+        self.secret = secret
+        self.concurrency = concurrency
+
+    def lifecycle_events(self, customers: int, updates_per_customer: int = 2, churn_fraction: float = 0.2):
+        """Yields checkout → updates → invoice → (some) deletions, in per-customer order."""
+        for i in range(customers):
+            price_id = "price_annual" if i % 4 == 0 else "price_monthly"
+            session = self.fake._create_checkout_session({
+                "mode": "subscription", "customer_email": f"bench-user-{i}@example.com",
+                "line_items[0][price]": price_id,
+            })[1]
+            session = self.fake.complete_checkout(session["id"])
+            sub = self.fake.subscriptions[session["subscription"]]
+            yield make_event("checkout.session.completed", session)
+            for _ in range(updates_per_customer):
+                sub["current_period_end"] += 1
+                yield make_event("customer.subscription.updated", dict(sub))
+            yield make_event("invoice.payment_succeeded", {
+                "id": _new_id("in"), "object": "invoice", "customer": sub["customer"], "subscription": sub["id"],
+                "customer_email": session["customer_email"], "amount_paid": sub["items"]["data"][0]["price"].get("unit_amount", 0),
+                "currency": "usd", "status": "paid", "created": int(time.time()),
+                "lines": _list_object("/v1/invoices/lines", [{"price": sub["items"]["data"][0]["price"]}]),
+            })
+            if random.random() < churn_fraction:
+                sub.update(status="canceled", canceled_at=int(time.time()))
+                yield make_event("customer.subscription.deleted", dict(sub))
+
+    def emit(self, events, rate: float = 0.0) -> dict:
+        """Posts events (rate per second, 0 = as fast as possible). Returns throughput stats."""
+        import requests  # Only needed when emitting
+
+        local = threading.local()
+        latencies = []
+        statuses = {}
+        results_lock = threading.Lock()
+
+        def send(event):
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+            payload = json.dumps(event)
+            headers = {"Content-Type": "application/json", "Stripe-Signature": sign_payload(payload, self.secret)}
+            started = time.perf_counter()
+            try:
+                status = local.session.post(self.url, data=payload, headers=headers, timeout=30).status_code
+            except requests.RequestException:
+                status = "connection_error"
+            with results_lock:
+                latencies.append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        sent = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for event in events:
+                if rate > 0:
+                    delay = started + sent / rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                pool.submit(send, event)
+                sent += 1
+        elapsed = time.perf_counter() - started
+        values = sorted(latencies)
+        return {
+            "sent": sent,
+            "elapsed_seconds": round(elapsed, 3),
+            "events_per_second": round(sent / elapsed, 2) if elapsed > 0 else 0.0,
+            "statuses": {str(k): v for k, v in statuses.items()},
+            "latency_ms": {
+                "p50": round(values[len(values) // 2] * 1000, 2) if values else 0.0,
+                "p99": round(values[min(len(values) - 1, int(len(values) * 0.99))] * 1000, 2) if values else 0.0,
+            },
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local fake Stripe API server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Added latency per request")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Random +/- jitter on the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with a 429")
+    parser.add_argument("--emit-webhooks", metavar="URL", help="Send a signed subscription lifecycle to this webhook URL")
+    parser.add_argument("--webhook-secret", default="whsec_test", help="Signing secret (must match STRIPE_WEBHOOK_SECRET)")
+    parser.add_argument("--customers", type=int, default=100, help="Customers in the emitted lifecycle")
+    parser.add_argument("--rate", type=float, default=0.0, help="Webhook events per second (0 = unthrottled)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent webhook senders")
+    args = parser.parse_args()
+
+    fake = FakeStripe(args.host, args.port, args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate)
+    print(f"🧪 Fake Stripe listening on {fake.start()} (latency {args.latency_ms}ms)")
+
+    if args.emit_webhooks:
+        emitter = WebhookEmitter(fake, args.emit_webhooks, args.webhook_secret, concurrency=args.concurrency)
+        stats = emitter.emit(emitter.lifecycle_events(args.customers), rate=args.rate)
+        print(json.dumps(stats, indent=2))
+        print("ℹ️ Keeping the API up so queued events can be processed; Ctrl+C to stop.")
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
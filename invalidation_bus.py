@@ -0,0 +1,234 @@
+# invalidation_bus.py
+import glob
+import json
+import os
+import socket
+import threading
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Lightweight pub/sub used to keep in-process caches coherent across Gunicorn
+# workers. Every publish is applied to the local process immediately and then
+# broadcast to the other processes, which apply it from a listener thread.
+#
+# Backends:
+#   - Redis pub/sub when INVALIDATION_BUS_URL is set (redis://host:port/db)
+#   - Unix datagram sockets otherwise: each worker binds <dir>/<pid>.sock and a
+#     publish is sent to every other socket in the directory
+# If neither is available (e.g. local Windows dev) the bus is local-only and the
+# cache TTLs remain the safety net.
+INVALIDATION_BUS_URL = os.getenv("INVALIDATION_BUS_URL")
+INVALIDATION_BUS_DIR = os.getenv("INVALIDATION_BUS_DIR", "/tmp/cricketapp-bus")
+INVALIDATION_BUS_CHANNEL = os.getenv("INVALIDATION_BUS_CHANNEL", "cricketapp:invalidate")
+
+_subscribers = {}  # namespace -> list of callbacks taking the key (None = everything)
+_subscribers_lock = threading.Lock()
+_backend = None
+_backend_lock = threading.Lock()
+_listener = None
+_origin = None
+
+
+def _current_origin() -> str:
+    """Identifies this process; recomputed after fork so workers differ."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class _UnixSocketBackend:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = None
+        self._recv_sock = None
+        self._send_sock = None
+
+    def bind(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"{os.getpid()}.sock")
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._recv_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._recv_sock.bind(self.path)
+
+    def send(self, data: bytes):
+        if self._send_sock is None:
+            self._send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            # Never block a request on a slow peer; a dropped message is covered by the cache TTL
+            self._send_sock.setblocking(False)
+        for peer in glob.glob(os.path.join(self.directory, "*.sock")):
+            if peer == self.path:
+                continue
+            try:
+                self._send_sock.sendto(data, peer)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Socket file left behind by a dead worker
+                try:
+                    os.unlink(peer)
+                except OSError:
+                    pass
+            except OSError as e:
+                print(f"⚠️ [Bus] Could not deliver invalidation to {peer}: {e}")
+
+    def receive(self) -> bytes:
+        return self._recv_sock.recv(65536)
+
+    def close(self):
+        for sock in (self._recv_sock, self._send_sock):
+            if sock:
+                sock.close()
+        if self.path and os.path.exists(self.path):
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class _RedisBackend:
+    def __init__(self, url: str, channel: str):
+        import redis  # Only needed when a bus URL is configured
+
+        self.channel = channel
+        self._client = redis.Redis.from_url(url)
+        self._pubsub = None
+
+    def bind(self):
+        self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(self.channel)
+
+    def send(self, data: bytes):
+        self._client.publish(self.channel, data)
+
+    def receive(self) -> bytes:
+        while True:
+            message = self._pubsub.get_message(timeout=5.0)
+            if message and message.get("type") == "message":
+                return message["data"]
+
+    def close(self):
+        if self._pubsub:
+            self._pubsub.close()
+        self._client.close()
+
+
+def _create_backend():
+    if INVALIDATION_BUS_URL:
+        return _RedisBackend(INVALIDATION_BUS_URL, INVALIDATION_BUS_CHANNEL)
+    if hasattr(socket, "AF_UNIX") and hasattr(socket, "SOCK_DGRAM") and os.name != "nt":
+        return _UnixSocketBackend(INVALIDATION_BUS_DIR)
+    return None
+
+
+def _get_backend():
+    """Returns the broadcast backend, creating a send-only one for CLI scripts."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            try:
+                _backend = _create_backend()
+            except Exception as e:
+                print(f"⚠️ [Bus] Invalidation bus unavailable, running local-only: {e}")
+                _backend = None
+        return _backend
+
+
+def _dispatch(namespace: str, key: Optional[str]):
+    with _subscribers_lock:
+        callbacks = list(_subscribers.get(namespace, ()))
+    for callback in callbacks:
+        try:
+            callback(key)
+        except Exception as e:
+            print(f"🔥 [Bus] Subscriber for '{namespace}' failed on key {key!r}: {e}")
+
+
+def subscribe(namespace: str, callback: Callable[[Optional[str]], None]):
+    """Registers a callback for invalidations in a key namespace.
+
+    The callback receives the invalidated key, or None when the whole namespace
+    should be dropped.
+    """
+    with _subscribers_lock:
+        _subscribers.setdefault(namespace, []).append(callback)
+
+
+def publish(namespace: str, key: Optional[str] = None):
+    """Invalidates a key locally and broadcasts it to the other app processes."""
+    _dispatch(namespace, key)
+
+    backend = _get_backend()
+    if backend is None:
+        return
+    message = json.dumps({
+        "origin": _origin or _current_origin(),
+        "namespace": namespace,
+        "key": key,
+    }).encode("utf-8")
+    try:
+        backend.send(message)
+    except Exception as e:
+        print(f"⚠️ [Bus] Failed to broadcast invalidation {namespace}:{key}: {e}")
+
+
+def _listen(backend):
+    while True:
+        try:
+            data = backend.receive()
+        except OSError:
+            # Socket closed by stop()
+            return
+        except Exception as e:
+            if _backend is not backend:
+                return
+            print(f"🔥 [Bus] Error receiving invalidation: {e}")
+            continue
+        try:
+            message = json.loads(data)
+        except (ValueError, TypeError):
+            print("⚠️ [Bus] Ignoring malformed invalidation message.")
+            continue
+        if message.get("origin") == _origin:
+            continue
+        _dispatch(message.get("namespace"), message.get("key"))
+
+
+def start():
+    """Binds this worker to the bus and starts the listener thread.
+
+    Must run after the fork, i.e. from the app's startup event, so each Gunicorn
+    worker gets its own socket/subscription.
+    """
+    global _backend, _listener, _origin
+    if _listener and _listener.is_alive():
+        return
+
+    _origin = _current_origin()
+    with _backend_lock:
+        try:
+            _backend = _create_backend()
+            if _backend is None:
+                print("ℹ️ [Bus] No invalidation transport on this platform; caches are local-only.")
+                return
+            _backend.bind()
+        except Exception as e:
+            print(f"⚠️ [Bus] Could not start invalidation bus, running local-only: {e}")
+            _backend = None
+            return
+        backend = _backend
+
+    _listener = threading.Thread(target=_listen, args=(backend,), name="invalidation-bus", daemon=True)
+    _listener.start()
+    print(f"✅ [Bus] Invalidation bus listening ({type(backend).__name__}, origin {_origin}).")
+
+
+def stop():
+    """Closes this worker's bus endpoint."""
+    global _backend
+    with _backend_lock:
+        if _backend is not None:
+            try:
+                _backend.close()
+            except Exception as e:
+                print(f"⚠️ [Bus] Error closing invalidation bus: {e}")
+            _backend = None
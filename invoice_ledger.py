@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# invoice_ledger.py
+"""
+Append-only ledger of paid Stripe invoices.
+
+Rows are written idempotently (INSERT IGNORE on the invoice ID) from the
+invoice.payment_succeeded webhook and by the one-off backfill below, which
+pages through Stripe's paid invoices with a resumable checkpoint. Revenue,
+ARPU and MRR are then plain indexed aggregates over this table.
+
+Schema: add_invoice_ledger_table.sql
+
+Usage:
+    python invoice_ledger.py --backfill [--since 2024-01-01] [--restart]
+    python invoice_ledger.py --summary
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import mysql.connector
+import stripe
+from dotenv import load_dotenv
+
+import plan_catalog
+import stripe_client
+from job_checkpoints import clear_checkpoint, load_checkpoint, save_checkpoint
+
+load_dotenv()
+
+BACKFILL_JOB_NAME = "invoice_ledger_backfill"
+PAGE_SIZE = 100
+INSERT_SQL = """
+    INSERT IGNORE INTO invoice_ledger
+        (invoice_id, customer_id, subscription_id, customer_email, amount_paid, currency,
+         period_start, period_end, paid_at, price_id, plan, billing_reason, recorded_at)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+
+def _connect():
+    return mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASS"),
+        database=os.getenv("DB_NAME")
+    )
+
+
+def _ts(value):
+    return datetime.utcfromtimestamp(value) if value else None
+
+
+def _id(value):
+    """Stripe fields may be an ID or an expanded object."""
+    return value.get("id") if hasattr(value, "get") else value
+
+
+def _subscription_line(invoice) -> dict:
+    """The invoice's subscription line (else its first line), paging past the embedded lines if needed."""
+    lines = invoice.get("lines") or {}
+    if lines.get("has_more") and hasattr(lines, "auto_paging_iter"):
+        items = lines.auto_paging_iter()
+    else:
+        items = lines.get("data") or []
+    first = None
+    for line in items:
+        if line.get("type") == "subscription":
+            return line
+        if first is None:
+            first = line
+    return first or {}
+
+
+def ledger_row(invoice) -> tuple:
+    """Maps a Stripe invoice (object or dict) to an invoice_ledger row."""
+    line = _subscription_line(invoice)
+    # The subscription line's period is the service period paid for;
+    # invoice.period_start/end describe the previous billing cycle
+    period = line.get("period") or {}
+    price = line.get("price") or {}
+    price_id = _id(price)
+    known = plan_catalog.plan_for_price_id(price_id) if price_id else None
+    paid_at = ((invoice.get("status_transitions") or {}).get("paid_at")) or invoice.get("created")
+    return (
+        invoice["id"],
+        _id(invoice.get("customer")),
+        _id(invoice.get("subscription")),
+        invoice.get("customer_email"),
+        int(invoice.get("amount_paid") or 0),
+        (invoice.get("currency") or "").lower(),
+        _ts(period.get("start") or invoice.get("period_start")),
+        _ts(period.get("end") or invoice.get("period_end")),
+        _ts(paid_at),
+        price_id,
+        known.name if known else None,
+        invoice.get("billing_reason"),
+        datetime.utcnow(),
+    )
+
+
+def record_invoice(invoice) -> bool:
+    """Records a paid invoice. Returns False if it was already in the ledger.
+
+    Raises mysql.connector.Error so the webhook queue retries.
+    """
+    conn = None
+    cursor = None
+    try:
+        conn = _connect()
+        cursor = conn.cursor()
+        cursor.execute(INSERT_SQL, ledger_row(invoice))
+        conn.commit()
+        return cursor.rowcount == 1
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+
+
+def backfill(since: datetime = None, restart: bool = False) -> dict:
+    """Pages through Stripe's paid invoices into the ledger, resuming from the last checkpoint."""
+    started = time.perf_counter()
+    counts = {"pages": 0, "invoices": 0, "inserted": 0}
+    conn = _connect()
+    try:
+        if restart:
+            clear_checkpoint(conn, BACKFILL_JOB_NAME)
+        params = {"status": "paid", "limit": PAGE_SIZE}  # Lines come inline (first page of them)
+        if since:
+            params["created"] = {"gte": int(since.timestamp())}
+        starting_after = load_checkpoint(conn, BACKFILL_JOB_NAME)
+        if starting_after:
+            print(f"↩️ [Ledger] Resuming backfill after invoice {starting_after}")
+            params["starting_after"] = starting_after
+
+        while True:
+            page = stripe_client.call("invoice.list", stripe.Invoice.list, **params)
+            counts["pages"] += 1
+            rows = [ledger_row(inv) for inv in page.data if inv.get("amount_paid")]
+            counts["invoices"] += len(page.data)
+            if rows:
+                cursor = conn.cursor()
+                try:
+                    cursor.executemany(INSERT_SQL, rows)
+                    conn.commit()
+                    counts["inserted"] += max(cursor.rowcount, 0)
+                finally:
+                    cursor.close()
+            if not page.has_more or not page.data:
+                break
+            params["starting_after"] = page.data[-1].id
+            save_checkpoint(conn, BACKFILL_JOB_NAME, params["starting_after"])
+
+        clear_checkpoint(conn, BACKFILL_JOB_NAME)
+    finally:
+        if conn.is_connected():
+            conn.close()
+
+    counts["elapsed_seconds"] = round(time.perf_counter() - started, 2)
+    print(f"✅ [Ledger] Backfilled {counts['inserted']} new invoice(s) from {counts['invoices']} "
+          f"over {counts['pages']} page(s) in {counts['elapsed_seconds']}s.")
+    return counts
+
+
+def revenue_summary(cursor, currency: str) -> dict:
+    """Ledger aggregates in major units for one currency, using an existing dictionary cursor."""
+    cursor.execute("""
+        SELECT COALESCE(SUM(amount_paid), 0) AS total,
+               COUNT(*) AS invoices,
+               COUNT(DISTINCT customer_id) AS paying_customers,
+               COALESCE(SUM(CASE WHEN paid_at >= DATE_SUB(UTC_TIMESTAMP(), INTERVAL 30 DAY) THEN amount_paid END), 0) AS last_30_days
+        FROM invoice_ledger
+        WHERE currency = %s
+    """, (currency,))
+    totals = cursor.fetchone() or {}
+
+    # MRR: each invoice covering today contributes its amount spread over a 30.4375-day month
+    cursor.execute("""
+        SELECT COALESCE(SUM(amount_paid * 2629800 / GREATEST(TIMESTAMPDIFF(SECOND, period_start, period_end), 1)), 0) AS mrr
+        FROM invoice_ledger
+        WHERE currency = %s AND period_start <= UTC_TIMESTAMP() AND period_end > UTC_TIMESTAMP()
+    """, (currency,))
+    mrr = (cursor.fetchone() or {}).get("mrr") or 0
+
+    return {
+        "currency": currency,
+        "all_time_revenue": float(totals.get("total") or 0) / 100.0,
+        "revenue_last_30_days": float(totals.get("last_30_days") or 0) / 100.0,
+        "invoices": int(totals.get("invoices") or 0),
+        "paying_customers": int(totals.get("paying_customers") or 0),
+        "mrr": float(mrr) / 100.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the paid invoice ledger.")
+    parser.add_argument("--backfill", action="store_true", help="Import paid invoices from Stripe")
+    parser.add_argument("--since", help="Only backfill invoices created on/after this ISO date")
+    parser.add_argument("--restart", action="store_true", help="Ignore any saved backfill checkpoint")
+    parser.add_argument("--summary", action="store_true", help="Print revenue aggregates from the ledger")
+    parser.add_argument("--currency", default=None, help="Currency for --summary (default: the monthly plan's)")
+    args = parser.parse_args(argv)
+
+    if not args.backfill and not args.summary:
+        parser.error("choose --backfill and/or --summary")
+    if args.backfill:
+        backfill(datetime.fromisoformat(args.since) if args.since else None, restart=args.restart)
+    if args.summary:
+        monthly = plan_catalog.plan("monthly")
+        currency = args.currency or (monthly.currency if monthly else "gbp")
+        conn = _connect()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            print(json.dumps(revenue_summary(cursor, currency), indent=2))
+            cursor.close()
+        finally:
+            conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,38 @@
+# job_checkpoints.py
+from datetime import datetime
+
+# Resume cursors for long-running batch jobs, one row per job name.
+# Callers pass their own connection so a checkpoint can share the job's
+# transaction boundaries. Schema: add_job_checkpoints_table.sql
+
+
+def load_checkpoint(conn, job_name: str):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT cursor_value FROM job_checkpoints WHERE job_name = %s", (job_name,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+    finally:
+        cursor.close()
+
+
+def save_checkpoint(conn, job_name: str, cursor_value: str):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            INSERT INTO job_checkpoints (job_name, cursor_value, updated_at)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE cursor_value = VALUES(cursor_value), updated_at = VALUES(updated_at)
+        """, (job_name, cursor_value, datetime.utcnow()))
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def clear_checkpoint(conn, job_name: str):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DELETE FROM job_checkpoints WHERE job_name = %s", (job_name,))
+        conn.commit()
+    finally:
+        cursor.close()
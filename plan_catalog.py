@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# plan_catalog.py
+"""
+Subscription plan catalog: the prices we sell, loaded from Stripe.
+
+The catalog is an immutable snapshot (read-only mappings of Plan tuples),
+replaced wholesale by a background refresh thread, so readers never lock
+and every lookup is a dict access. On import it is seeded from the local
+snapshot file (or, failing that, the configured price IDs with the
+launch prices), so the app never blocks on Stripe at startup. The first
+refresh then loads the live Price and Product objects and rewrites the
+snapshot. Only the configured STRIPE_PRICE_ID_* prices are offered for
+sale; other active prices are kept so existing subscriptions on them can
+still be looked up.
+
+Usage:
+    python plan_catalog.py            # Fetch from Stripe, print and save the snapshot
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+from datetime import datetime
+from types import MappingProxyType
+from typing import NamedTuple, Optional
+
+import stripe
+from dotenv import load_dotenv
+
+import stripe_client
+
+load_dotenv()
+
+PLAN_CATALOG_SNAPSHOT = os.getenv("PLAN_CATALOG_SNAPSHOT", os.path.join(os.path.dirname(os.path.abspath(__file__)), "plan_catalog.json"))
+PLAN_CATALOG_REFRESH_SECONDS = float(os.getenv("PLAN_CATALOG_REFRESH_SECONDS", "3600"))
+PLAN_NAMES = {"monthly": "STRIPE_PRICE_ID_MONTHLY", "annual": "STRIPE_PRICE_ID_ANNUAL"}
+INTERVAL_PLANS = {"month": "monthly", "year": "annual"}
+# Used only until the first snapshot or Stripe load succeeds
+FALLBACK_AMOUNTS = {"monthly": (500, "month"), "annual": (4999, "year")}
+CURRENCY_SYMBOLS = {"gbp": "£", "usd": "$", "eur": "€", "aud": "A$", "nzd": "NZ$", "inr": "₹"}
+
+
+class Plan(NamedTuple):
+    name: str
+    price_id: str
+    unit_amount: int  # Minor units (pence/cents)
+    currency: str
+    interval: str
+    interval_count: int = 1
+    product_name: Optional[str] = None
+
+    @property
+    def amount(self) -> float:
+        return self.unit_amount / 100.0
+
+    @property
+    def months(self) -> float:
+        """Length of one billing period in months."""
+        return {"month": 1, "year": 12, "week": 12 / 52, "day": 12 / 365}.get(self.interval, 1) * self.interval_count
+
+    @property
+    def monthly_amount(self) -> float:
+        """Price normalised to one month, for MRR."""
+        return self.amount / self.months
+
+    @property
+    def currency_symbol(self) -> str:
+        return CURRENCY_SYMBOLS.get(self.currency, self.currency.upper() + " ")
+
+    @property
+    def display_price(self) -> str:
+        return f"{self.currency_symbol}{self.amount:.2f}"
+
+
+class Catalog(NamedTuple):
+    plans: MappingProxyType       # plan name → Plan (the plans offered for sale)
+    by_price_id: MappingProxyType  # every known recurring price ID → Plan
+    source: str
+    loaded_at: str
+
+
+def _build(plans: list, source: str) -> Catalog:
+    configured = {os.getenv(env): name for name, env in PLAN_NAMES.items() if os.getenv(env)}
+    by_price = {plan.price_id: plan for plan in plans}
+    # Only configured price IDs are offered; other active prices (other products,
+    # legacy prices) are known for lookups but never sold
+    by_name = {plan.name: plan for plan in plans if plan.price_id in configured}
+    for name, env_name in PLAN_NAMES.items():
+        if name in by_name:
+            continue
+        if not os.getenv(env_name):
+            print(f"🔥 [Plans] {env_name} is not set; the {name} plan is not offered.")
+        else:
+            print(f"🔥 [Plans] {env_name}={os.getenv(env_name)} is not an active recurring price ({source}); "
+                  f"the {name} plan is not offered.")
+    return Catalog(MappingProxyType(by_name), MappingProxyType(by_price), source, datetime.utcnow().isoformat() + "Z")
+
+
+def _fallback_catalog() -> Catalog:
+    plans = []
+    for name, env_name in PLAN_NAMES.items():
+        if os.getenv(env_name):
+            unit_amount, interval = FALLBACK_AMOUNTS[name]
+            plans.append(Plan(name, os.getenv(env_name), unit_amount, "gbp", interval))
+    return _build(plans, "fallback")
+
+
+def load_from_stripe() -> Catalog:
+    """Loads every active recurring price (with its product) from Stripe."""
+    plans = []
+    params = {"active": True, "type": "recurring", "limit": 100, "expand": ["data.product"]}
+    while True:
+        page = stripe_client.call("price.list", stripe.Price.list, **params)
+        for price in page.data:
+            recurring = price.get("recurring") or {}
+            name = INTERVAL_PLANS.get(recurring.get("interval"))
+            if not name or price.get("unit_amount") is None:
+                continue
+            for plan_name, env_name in PLAN_NAMES.items():
+                if os.getenv(env_name) == price.id:
+                    name = plan_name
+            product = price.get("product")
+            plans.append(Plan(
+                name=name,
+                price_id=price.id,
+                unit_amount=price["unit_amount"],
+                currency=price.get("currency", "gbp"),
+                interval=recurring.get("interval"),
+                interval_count=recurring.get("interval_count") or 1,
+                product_name=product.get("name") if hasattr(product, "get") else None,
+            ))
+        if not page.has_more or not page.data:
+            break
+        params["starting_after"] = page.data[-1].id
+    return _build(plans, "stripe")
+
+
+def load_snapshot(path: str = PLAN_CATALOG_SNAPSHOT) -> Optional[Catalog]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return _build([Plan(**p) for p in data.get("plans", [])], "snapshot")
+
+
+def save_snapshot(cat: Catalog, path: str = PLAN_CATALOG_SNAPSHOT):
+    # Every worker refreshes, so each writes its own temp file and swaps it in atomically
+    f = tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix=".plan_catalog-", suffix=".tmp", delete=False)
+    try:
+        with f:
+            json.dump({"saved_at": cat.loaded_at, "plans": [p._asdict() for p in cat.by_price_id.values()]}, f, indent=2)
+        os.replace(f.name, path)
+    except BaseException:
+        os.remove(f.name)
+        raise
+
+
+_catalog = load_snapshot() or _fallback_catalog()
+_refresh_thread = None
+_stop = threading.Event()
+
+
+def catalog() -> Catalog:
+    return _catalog
+
+
+def plan(name: str) -> Optional[Plan]:
+    """The plan currently offered under this name ('monthly'/'annual')."""
+    return _catalog.plans.get(name)
+
+
+def plan_for_price_id(price_id: str) -> Optional[Plan]:
+    return _catalog.by_price_id.get(price_id)
+
+
+def refresh() -> bool:
+    """Reloads from Stripe and swaps the catalog in. Keeps the current one on failure."""
+    global _catalog
+    try:
+        new = load_from_stripe()
+    except stripe.error.StripeError as e:
+        print(f"⚠️ [Plans] Could not refresh plan catalog from Stripe ({_catalog.source} catalog kept): {e}")
+        return False
+    if not new.by_price_id:
+        print("⚠️ [Plans] Stripe returned no recurring prices; keeping the current catalog.")
+        return False
+    _catalog = new
+    try:
+        save_snapshot(new)
+    except OSError as e:
+        print(f"⚠️ [Plans] Could not write plan catalog snapshot: {e}")
+    return True
+
+
+def _refresh_loop():
+    while not _stop.is_set():
+        refresh()
+        _stop.wait(PLAN_CATALOG_REFRESH_SECONDS)
+
+
+def start_refresh():
+    """Starts the background refresh (first load immediately)."""
+    global _refresh_thread
+    if _refresh_thread and _refresh_thread.is_alive():
+        return
+    _stop.clear()
+    _refresh_thread = threading.Thread(target=_refresh_loop, name="plan-catalog-refresh", daemon=True)
+    _refresh_thread.start()
+
+
+def stop_refresh():
+    _stop.set()
+
+
+def main():
+    if not refresh():
+        return 1
+    cat = catalog()
+    for p in cat.by_price_id.values():
+        offered = " (offered)" if cat.plans.get(p.name) == p else ""
+        print(f"  {p.name:8s} {p.price_id:32s} {p.display_price:>10s}/{p.interval}{offered}")
+    print(f"📄 Snapshot written to {PLAN_CATALOG_SNAPSHOT}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
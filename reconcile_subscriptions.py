@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# reconcile_subscriptions.py
+"""
+Scheduled reconciliation of premium state against Stripe.
+
+Pages through every subscription (all statuses, customer expanded) and
+compares each one with the users table held in memory. Only rows that
+differ are written, with batched UPDATEs per page; every difference goes
+into a discrepancy report. The page cursor is checkpointed in
+job_checkpoints after each page so an interrupted run resumes where it
+stopped. Stripe rate limiting is handled with backoff, and pages can be
+paced with --max-pages-per-second.
+
+A run that starts from the beginning also reports premium users whose
+linked Stripe customer has no live subscription (and downgrades them with
+--fix-orphans). Premium users with no Stripe customer at all (comped or
+manually granted accounts) are listed separately and never downgraded.
+
+Schema: add_job_checkpoints_table.sql
+Cron (nightly):
+    15 3 * * *  cd /srv/cricketapp && python reconcile_subscriptions.py --report /var/log/cricketapp/reconcile.json
+
+Usage:
+    python reconcile_subscriptions.py [--dry-run] [--restart] [--report report.json]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+import mysql.connector
+import stripe
+from dotenv import load_dotenv
+
+import stripe_client
+from entitlement_cache import invalidate_entitlement
+from job_checkpoints import clear_checkpoint, load_checkpoint, save_checkpoint
+from stripe_webhook import PREMIUM_STATUSES, plan_for_price
+
+load_dotenv()
+
+JOB_NAME = "reconcile_subscriptions"
+PAGE_SIZE = 100
+MAX_RATE_LIMIT_RETRIES = 8
+COMPARED_FIELDS = [
+    "is_premium", "subscription_status", "subscription_type",
+    "current_period_end", "subscription_id", "stripe_customer_id",
+]
+
+
+def _connect():
+    return mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASS"),
+        database=os.getenv("DB_NAME")
+    )
+
+
+# --- Stripe paging ---
+
+def fetch_page(starting_after=None):
+    """One page of subscriptions, retrying with backoff while Stripe rate-limits us."""
+    params = {"status": "all", "limit": PAGE_SIZE, "expand": ["data.customer"]}
+    if starting_after:
+        params["starting_after"] = starting_after
+    for attempt in range(1, MAX_RATE_LIMIT_RETRIES + 1):
+        try:
+            return stripe_client.call("subscription.list", stripe.Subscription.list, retries=0, **params)
+        except (stripe.error.RateLimitError, stripe.error.APIConnectionError) as e:
+            if attempt == MAX_RATE_LIMIT_RETRIES:
+                raise
+            delay = random.uniform(0.5, 1.0) * min(60, 2 ** attempt)
+            print(f"⏳ [Reconcile] {type(e).__name__}; retrying page in {delay:.1f}s (attempt {attempt})")
+            time.sleep(delay)
+
+
+# --- Comparison ---
+
+def load_users(conn) -> tuple:
+    """All users keyed by email, plus a customer ID → email index."""
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute(f"SELECT email, {', '.join(COMPARED_FIELDS)} FROM users")
+        users = {row["email"]: row for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+    by_customer = {u["stripe_customer_id"]: email for email, u in users.items() if u["stripe_customer_id"]}
+    return users, by_customer
+
+
+def desired_state(sub, user: dict):
+    """The user's fields as this subscription says they should be, or None to leave them alone."""
+    status = sub.get("status")
+    premium = status in PREMIUM_STATUSES
+    # A lapsed subscription only downgrades a user it is (or could be) the current subscription of;
+    # older canceled subscriptions of a customer who resubscribed are ignored
+    if not premium and user["subscription_id"] not in (None, sub.id):
+        return None
+
+    items = (sub.get("items") or {}).get("data") or []
+    plan = plan_for_price(items[0].get("price")) if items else None
+    period_end_ts = sub.get("current_period_end")
+    customer = sub.get("customer")
+    return {
+        "is_premium": 1 if premium else 0,
+        "subscription_status": status,
+        "subscription_type": plan or user["subscription_type"],
+        "current_period_end": datetime.utcfromtimestamp(period_end_ts) if period_end_ts else None,
+        "subscription_id": sub.id,
+        "stripe_customer_id": customer.id if hasattr(customer, "id") else customer,
+    }
+
+
+def diff(user: dict, desired: dict) -> dict:
+    changes = {}
+    for field in COMPARED_FIELDS:
+        old = user.get(field)
+        new = desired[field]
+        if field == "is_premium":
+            old = int(bool(old))
+        if old != new:
+            changes[field] = (old, new)
+    return changes
+
+
+def apply_updates(conn, updates: list):
+    """Writes one page of differences in a single transaction."""
+    if not updates:
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.executemany("""
+            UPDATE users
+            SET is_premium = %s, subscription_status = %s, subscription_type = %s,
+                current_period_end = %s, subscription_id = %s, stripe_customer_id = %s
+            WHERE email = %s
+        """, [tuple(d[f] for f in COMPARED_FIELDS) + (email,) for email, d in updates])
+        conn.commit()
+    except mysql.connector.Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    for email, _ in updates:
+        invalidate_entitlement(email)
+
+
+def _serialize(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def reconcile(dry_run: bool = False, restart: bool = False, fix_orphans: bool = False,
+              max_pages_per_second: float = 0.0) -> dict:
+    started = time.perf_counter()
+    conn = _connect()
+    try:
+        if restart:
+            clear_checkpoint(conn, JOB_NAME)
+        cursor_value = load_checkpoint(conn, JOB_NAME)
+        full_pass = cursor_value is None
+        if not full_pass:
+            print(f"↩️ [Reconcile] Resuming after subscription {cursor_value}")
+
+        users, by_customer = load_users(conn)
+        by_email_lower = {email.lower(): email for email in users}
+        live_customers = set()
+        discrepancies = []
+        counts = {"pages": 0, "subscriptions": 0, "unmatched": 0, "updated": 0}
+
+        while True:
+            page_started = time.perf_counter()
+            page = fetch_page(cursor_value)
+            counts["pages"] += 1
+            updates = []
+            for sub in page.data:
+                counts["subscriptions"] += 1
+                customer = sub.get("customer")
+                customer_id = customer.id if hasattr(customer, "id") else customer
+                if sub.get("status") in PREMIUM_STATUSES:
+                    live_customers.add(customer_id)
+
+                email = by_customer.get(customer_id)
+                if not email and hasattr(customer, "get") and customer.get("email"):
+                    email = by_email_lower.get(customer["email"].lower())  # Not linked yet
+                if not email:
+                    counts["unmatched"] += 1
+                    continue
+
+                user = users[email]
+                desired = desired_state(sub, user)
+                if desired is None:
+                    continue
+                changes = diff(user, desired)
+                if not changes:
+                    continue
+                discrepancies.append({
+                    "email": email,
+                    "customer_id": customer_id,
+                    "subscription_id": sub.id,
+                    "changes": {f: [_serialize(o), _serialize(n)] for f, (o, n) in changes.items()},
+                })
+                updates.append((email, desired))
+                user.update(desired)  # Later subscriptions compare against the corrected row
+                by_customer[customer_id] = email
+
+            if not dry_run:
+                apply_updates(conn, updates)
+                counts["updated"] += len(updates)
+            if not page.has_more or not page.data:
+                break
+            cursor_value = page.data[-1].id
+            if not dry_run:
+                save_checkpoint(conn, JOB_NAME, cursor_value)
+            if max_pages_per_second > 0:
+                time.sleep(max(0.0, 1.0 / max_pages_per_second - (time.perf_counter() - page_started)))
+
+        orphans = []
+        without_customer = []
+        if full_pass:
+            orphans = [email for email, u in users.items()
+                       if u["is_premium"] and u["stripe_customer_id"]
+                       and u["stripe_customer_id"] not in live_customers]
+            without_customer = [email for email, u in users.items()
+                                if u["is_premium"] and not u["stripe_customer_id"]]
+            if fix_orphans and orphans and not dry_run:
+                apply_updates(conn, [(email, dict(users[email], is_premium=0, subscription_status="canceled"))
+                                     for email in orphans])
+                counts["updated"] += len(orphans)
+
+        if not dry_run:
+            clear_checkpoint(conn, JOB_NAME)
+    finally:
+        if conn.is_connected():
+            conn.close()
+
+    elapsed = time.perf_counter() - started
+    counts["discrepancies"] = len(discrepancies)
+    counts["premium_without_subscription"] = len(orphans)
+    counts["premium_without_customer"] = len(without_customer)
+    print(f"✅ [Reconcile] {counts['subscriptions']} subscription(s) over {counts['pages']} page(s) in {elapsed:.1f}s: "
+          f"{counts['discrepancies']} discrepancies, {counts['updated']} row(s) updated"
+          f"{' (dry run)' if dry_run else ''}, {counts['unmatched']} unmatched, {len(orphans)} premium without subscription, "
+          f"{len(without_customer)} premium without a Stripe customer.")
+    return {
+        "started_at": datetime.utcnow().isoformat() + "Z",
+        "dry_run": dry_run,
+        "full_pass": full_pass,
+        "elapsed_seconds": round(elapsed, 2),
+        "counts": counts,
+        "discrepancies": discrepancies,
+        "premium_without_subscription": orphans,
+        "premium_without_customer": without_customer,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reconcile users' premium state with Stripe subscriptions.")
+    parser.add_argument("--dry-run", action="store_true", help="Report differences without writing them")
+    parser.add_argument("--restart", action="store_true", help="Ignore any saved checkpoint and start from the beginning")
+    parser.add_argument("--fix-orphans", action="store_true", help="Downgrade premium users whose Stripe customer has no live subscription (full passes only)")
+    parser.add_argument("--max-pages-per-second", type=float, default=0.0, help="Pace Stripe list calls (0 = unpaced)")
+    parser.add_argument("--report", help="Write the discrepancy report as JSON to this file")
+    args = parser.parse_args(argv)
+
+    report = reconcile(dry_run=args.dry_run, restart=args.restart, fix_orphans=args.fix_orphans,
+                       max_pages_per_second=args.max_pages_per_second)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"📄 Discrepancy report written to {args.report}")
+    else:
+        for item in report["discrepancies"]:
+            print(f"  {item['email']} ({item['subscription_id']}): {item['changes']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
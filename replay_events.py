@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# replay_events.py
+"""
+Re-applies Stripe events through the webhook handler after an outage or a
+handler bug.
+
+Events come from the durable webhook log (stripe_webhook_events) or from an
+export file (a JSON array, NDJSON, or a saved Stripe list response). They are
+deduplicated by event ID, sorted by creation time and split into partitions
+per Stripe customer, the same way the webhook queue does. Partitions run in
+parallel and each one runs in order through stripe_webhook.handle_event.
+Replays deliberately bypass the processed_events claims, because re-applying
+already handled events is the point. Audit log rows (subscription_started/
+churn) are only skipped for events that already completed, i.e. that the
+queue marked done or an earlier replay recorded; dead-lettered events and
+events missed during an outage get theirs, so churn and cohort reports count
+them. Each replayed event is then claimed for the webhook endpoint and its
+queue row (if pending or dead) marked done, so neither a Stripe redelivery
+nor the queue applies it again.
+
+Usage:
+    python replay_events.py --from-db --since 2025-06-01T00:00 --until 2025-06-02T00:00 --dry-run
+    python replay_events.py --file events.ndjson --workers 16 --report replay.json
+    python replay_events.py --from-db --status dead --type checkout.session.completed
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import mysql.connector
+from dotenv import load_dotenv
+
+import event_store
+from stripe_webhook import EVENT_ENDPOINT, handle_event
+from webhook_queue import coalesce, partition_fields
+
+load_dotenv()
+
+DEFAULT_WORKERS = 8
+LOOKUP_CHUNK = 500
+
+
+def _connect():
+    return mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASS"),
+        database=os.getenv("DB_NAME")
+    )
+
+
+def load_from_db(since=None, until=None, event_types=None, statuses=None) -> list:
+    """Reads stored events from the webhook log."""
+    query = "SELECT payload FROM stripe_webhook_events WHERE 1 = 1"
+    params = []
+    if since:
+        query += " AND received_at >= %s"
+        params.append(since)
+    if until:
+        query += " AND received_at < %s"
+        params.append(until)
+    if event_types:
+        query += f" AND event_type IN ({', '.join(['%s'] * len(event_types))})"
+        params.extend(event_types)
+    if statuses:
+        query += f" AND status IN ({', '.join(['%s'] * len(statuses))})"
+        params.extend(statuses)
+    query += " ORDER BY event_created, received_at"
+
+    conn = None
+    cursor = None
+    try:
+        conn = _connect()
+        cursor = conn.cursor()
+        cursor.execute(query, tuple(params))
+        return [json.loads(row[0]) for row in cursor.fetchall()]
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+
+
+def load_from_file(path: str) -> list:
+    """Reads a JSON array, a Stripe list response ({"data": [...]}) or NDJSON."""
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    stripped = text.lstrip()
+    if stripped.startswith("["):
+        return json.loads(text)
+    if stripped.startswith("{"):
+        try:
+            doc = json.loads(text)
+            if isinstance(doc, dict) and doc.get("object") == "list":
+                return doc["data"]
+            if isinstance(doc, dict):
+                return [doc]
+        except json.JSONDecodeError:
+            pass  # NDJSON
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def prepare(events: list, event_types=None, since_ts=None, until_ts=None, use_coalesce=False) -> tuple:
+    """Filters, dedupes and orders events. Returns (rows, skipped counts by reason)."""
+    skipped = {"duplicate": 0, "filtered": 0, "coalesced": 0}
+    seen = set()
+    rows = []
+    for event in events:
+        if not isinstance(event, dict) or event.get("object", "event") != "event" or "id" not in event:
+            skipped["filtered"] += 1
+            continue
+        if event["id"] in seen:
+            skipped["duplicate"] += 1
+            continue
+        seen.add(event["id"])
+        created = event.get("created") or 0
+        if (event_types and event.get("type") not in event_types) \
+                or (since_ts and created < since_ts) or (until_ts and created >= until_ts):
+            skipped["filtered"] += 1
+            continue
+        try:
+            customer_id, object_id, _ = partition_fields(event)
+        except (KeyError, TypeError, AttributeError):
+            skipped["filtered"] += 1
+            continue
+        rows.append({"event_id": event["id"], "event_type": event["type"], "customer_id": customer_id,
+                     "object_id": object_id, "created": created, "event": event})
+    rows.sort(key=lambda r: r["created"])
+    if use_coalesce:
+        rows, superseded = coalesce(rows)
+        skipped["coalesced"] = len(superseded)
+    return rows, skipped
+
+
+def completed_events(event_ids: list) -> set:
+    """IDs of events that were already applied: done in the queue, or claimed with no queue row.
+
+    Claims alone do not prove completion while the queue row exists (the
+    webhook endpoint claims on enqueue), but without one they come from an
+    earlier replay.
+    """
+    completed = set()
+    conn = None
+    cursor = None
+    try:
+        conn = _connect()
+        cursor = conn.cursor()
+        for i in range(0, len(event_ids), LOOKUP_CHUNK):
+            chunk = event_ids[i:i + LOOKUP_CHUNK]
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute(f"""
+                SELECT event_id FROM stripe_webhook_events
+                WHERE event_id IN ({placeholders}) AND status = 'done'
+            """, tuple(chunk))
+            completed.update(row[0] for row in cursor.fetchall())
+            cursor.execute(f"""
+                SELECT p.event_id FROM processed_events p
+                LEFT JOIN stripe_webhook_events q ON q.event_id = p.event_id
+                WHERE p.event_id IN ({placeholders}) AND p.endpoint = %s AND q.event_id IS NULL
+            """, tuple(chunk) + (EVENT_ENDPOINT,))
+            completed.update(row[0] for row in cursor.fetchall())
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+    return completed
+
+
+def _record_replayed(conn, row: dict):
+    """Claims a replayed event for the webhook endpoint and closes out its queue row, in one transaction."""
+    cursor = conn.cursor()
+    try:
+        event_store.claim_in(cursor, row["event_id"], row["event_type"], EVENT_ENDPOINT)
+        cursor.execute("""
+            UPDATE stripe_webhook_events
+            SET status = 'done', processed_at = %s, locked_at = NULL, last_error = NULL
+            WHERE event_id = %s AND status IN ('pending', 'dead')
+        """, (datetime.utcnow(), row["event_id"]))
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def replay(rows: list, workers: int = DEFAULT_WORKERS, dry_run: bool = False, stop_partition_on_error: bool = True) -> dict:
+    """Runs events through handle_event, in order per customer and in parallel across customers."""
+    completed = completed_events([row["event_id"] for row in rows]) if rows and not dry_run else set()
+    partitions = {}
+    for row in rows:
+        partitions.setdefault(row["customer_id"] or row["event_id"], []).append(row)
+
+    by_type = {}
+    failures = []
+    lock = threading.Lock()
+
+    def count(event_type, outcome):
+        with lock:
+            by_type.setdefault(event_type, {"ok": 0, "failed": 0, "skipped": 0, "would_apply": 0})[outcome] += 1
+
+    def run_partition(events):
+        conn = None
+        try:
+            for i, row in enumerate(events):
+                if dry_run:
+                    count(row["event_type"], "would_apply")
+                    continue
+                try:
+                    handle_event(row["event"], replay=row["event_id"] in completed)
+                    if conn is None or not conn.is_connected():
+                        conn = _connect()
+                    _record_replayed(conn, row)
+                except Exception as e:
+                    count(row["event_type"], "failed")
+                    with lock:
+                        failures.append({"event_id": row["event_id"], "type": row["event_type"],
+                                         "customer_id": row["customer_id"], "error": f"{type(e).__name__}: {e}"})
+                    if stop_partition_on_error:
+                        # Later events for this customer would be applied out of order
+                        for later in events[i + 1:]:
+                            count(later["event_type"], "skipped")
+                        return
+                    continue
+                count(row["event_type"], "ok")
+        finally:
+            if conn and conn.is_connected(): conn.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(run_partition, partitions.values()))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "events": len(rows),
+        "partitions": len(partitions),
+        "elapsed_seconds": round(elapsed, 3),
+        "events_per_second": round(len(rows) / elapsed, 2) if elapsed > 0 else 0.0,
+        "already_completed": len(completed),
+        "by_type": by_type,
+        "failures": failures,
+    }
+
+
+def _parse_time(value: str):
+    return datetime.fromisoformat(value) if value else None
+
+
+def _epoch(value):
+    """Naive times are UTC, like the rest of the app's timestamps."""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay Stripe events through the webhook handler.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--from-db", action="store_true", help="Replay events from the stripe_webhook_events log")
+    source.add_argument("--file", help="Replay events from a JSON/NDJSON export")
+    parser.add_argument("--since", help="ISO start time (inclusive; received time for --from-db, event time for files)")
+    parser.add_argument("--until", help="ISO end time (exclusive)")
+    parser.add_argument("--type", action="append", dest="types", help="Only this event type (repeatable)")
+    parser.add_argument("--status", action="append", dest="statuses", help="Only events with this queue status (--from-db)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Parallel customer partitions")
+    parser.add_argument("--coalesce", action="store_true", help="Skip subscription updates superseded later in the replay")
+    parser.add_argument("--continue-on-error", action="store_true", help="Keep going within a customer after a failure")
+    parser.add_argument("--dry-run", action="store_true", help="Show what would be replayed without applying anything")
+    parser.add_argument("--report", help="Write the replay report as JSON to this file")
+    args = parser.parse_args(argv)
+
+    since, until = _parse_time(args.since), _parse_time(args.until)
+    if args.from_db:
+        events = load_from_db(since, until, args.types, args.statuses)
+        rows, skipped = prepare(events, use_coalesce=args.coalesce)
+    else:
+        events = load_from_file(args.file)
+        rows, skipped = prepare(events, args.types, _epoch(since), _epoch(until), use_coalesce=args.coalesce)
+
+    print(f"🔁 Replaying {len(rows)} event(s) with {args.workers} worker(s){' (dry run)' if args.dry_run else ''}; "
+          f"skipped {skipped['duplicate']} duplicate, {skipped['filtered']} filtered, {skipped['coalesced']} coalesced.")
+    report = replay(rows, workers=args.workers, dry_run=args.dry_run, stop_partition_on_error=not args.continue_on_error)
+    report["skipped_before_replay"] = skipped
+    report["dry_run"] = args.dry_run
+
+    print(f"✅ {report['events']} event(s) in {report['elapsed_seconds']}s ({report['events_per_second']}/s), "
+          f"{len(report['failures'])} failure(s).")
+    for event_type, outcomes in sorted(report["by_type"].items()):
+        print(f"  {event_type:40s} {outcomes}")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"📄 Replay report written to {args.report}")
+    return 0 if not report["failures"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
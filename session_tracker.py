@@ -0,0 +1,212 @@
+# session_tracker.py
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import mysql.connector
+from dotenv import load_dotenv
+
+import activity_leaderboard
+import activity_sketches
+import traffic_rollups
+
+load_dotenv()
+
+# Session activity tracked from request traffic instead of explicit logouts.
+#
+# Every request from a logged-in session calls touch(), which only updates an
+# in-memory entry (last seen, page count). A background thread flushes the
+# entries that changed into user_sessions every SESSION_FLUSH_SECONDS with one
+# batched upsert, and closes sessions idle for longer than
+# SESSION_IDLE_TIMEOUT_SECONDS: ended_at is their last request, not the time
+# the idleness was noticed. Each Gunicorn worker keeps its own entries. The
+# upsert merges them: earliest start, latest activity, pages summed. A sweep
+# in the database closes sessions whose worker exited before closing them.
+# A closed row is never reopened: when its cookie comes back after the idle
+# close, the closed row is moved to an ID derived from its end time and the
+# activity starts a new row (and counts as a new session) under the cookie's ID.
+#
+# The same transaction adds to the per-user daily activity counters
+# (activity_leaderboard.py), merges the distinct-count sketches
+# (activity_sketches.py) and adds to the traffic rollups (traffic_rollups.py).
+#
+# Schema: add_user_sessions_table.sql, add_user_activity_daily_table.sql,
+# add_activity_sketches_table.sql, add_traffic_rollup_tables.sql
+SESSION_FLUSH_SECONDS = float(os.getenv("SESSION_FLUSH_SECONDS", "30"))
+SESSION_IDLE_TIMEOUT_SECONDS = int(os.getenv("SESSION_IDLE_TIMEOUT_SECONDS", "1800"))
+
+_active = {}  # session id -> {"email", "started_at", "last_seen", "page_views", "ended_at", "dirty"}
+_lock = threading.Lock()
+_flush_thread = None
+_stop = threading.Event()
+
+
+def session_id_for(email: str, login_time: str) -> str:
+    """Stable ID for a login session, derived from what the session cookie already holds."""
+    return uuid.uuid5(uuid.NAMESPACE_URL, f"cricketapp-session:{email}|{login_time or ''}").hex
+
+
+def _closed_id(session_id: str, ended_at: datetime) -> str:
+    """ID a closed session row moves to when its cookie starts a new session."""
+    return uuid.uuid5(uuid.NAMESPACE_URL, f"cricketapp-session:{session_id}|{ended_at.isoformat()}").hex
+
+
+def touch(session_id: str, email: str, now: datetime = None):
+    """Records a request for this session. Memory only; never touches the database."""
+    now = now or datetime.utcnow()
+    with _lock:
+        entry = _active.get(session_id)
+        if entry is None:
+            _active[session_id] = {"email": email, "started_at": now, "last_seen": now,
+                                   "page_views": 1, "ended_at": None, "dirty": True}
+            return
+        if now - entry["last_seen"] > timedelta(seconds=SESSION_IDLE_TIMEOUT_SECONDS):
+            entry["started_at"] = now  # Resumed after an idle gap: a new session, not a longer one
+        entry["last_seen"] = now
+        entry["page_views"] += 1
+        entry["ended_at"] = None
+        entry["dirty"] = True
+
+
+def end(session_id: str, email: str, now: datetime = None):
+    """Closes a session explicitly (logout); written on the next flush.
+
+    Works even if this worker never saw the session: the upsert only moves
+    ended_at/last_seen_at forward and keeps the stored start.
+    """
+    now = now or datetime.utcnow()
+    with _lock:
+        entry = _active.setdefault(session_id, {"email": email, "started_at": now, "last_seen": now,
+                                                "page_views": 0, "ended_at": None, "dirty": True})
+        entry["last_seen"] = max(entry["last_seen"], now)
+        entry["ended_at"] = entry["last_seen"]
+        entry["dirty"] = True
+
+
+def _collect(now: datetime) -> list:
+    """Takes the changed entries (resetting their page deltas) and drops closed ones."""
+    idle_before = now - timedelta(seconds=SESSION_IDLE_TIMEOUT_SECONDS)
+    rows = []
+    with _lock:
+        for session_id, entry in list(_active.items()):
+            if entry["ended_at"] is None and entry["last_seen"] < idle_before:
+                entry["ended_at"] = entry["last_seen"]
+                entry["dirty"] = True
+            if entry["dirty"]:
+                rows.append((session_id, entry["email"], entry["started_at"], entry["last_seen"],
+                             entry["ended_at"], entry["page_views"]))
+                entry["page_views"] = 0
+                entry["dirty"] = False
+            if entry["ended_at"] is not None:
+                del _active[session_id]
+    return rows
+
+
+def _restore(rows: list):
+    """Puts unwritten page counts back after a failed flush so they go out next time."""
+    with _lock:
+        for session_id, email, started_at, last_seen, ended_at, page_views in rows:
+            entry = _active.get(session_id)
+            if entry is None:
+                _active[session_id] = {"email": email, "started_at": started_at, "last_seen": last_seen,
+                                       "page_views": page_views, "ended_at": ended_at, "dirty": True}
+            else:
+                entry["started_at"] = min(entry["started_at"], started_at)
+                entry["page_views"] += page_views
+                entry["dirty"] = True
+
+
+def flush(now: datetime = None) -> int:
+    """Writes changed sessions in one batch and closes idle ones. Returns rows written."""
+    now = now or datetime.utcnow()
+    rows = _collect(now)
+    sketches = activity_sketches.take()
+    traffic = traffic_rollups.take()
+    conn = None
+    cursor = None
+    try:
+        conn = mysql.connector.connect(
+            host=os.getenv("DB_HOST"),
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASS"),
+            database=os.getenv("DB_NAME")
+        )
+        cursor = conn.cursor()
+        if rows:
+            # Sessions not stored yet are new; counted once in the daily activity counters
+            placeholders = ", ".join(["%s"] * len(rows))
+            cursor.execute(f"SELECT session_id, ended_at FROM user_sessions WHERE session_id IN ({placeholders})",
+                           tuple(row[0] for row in rows))
+            known = dict(cursor.fetchall())
+            # Activity that started after the stored row was closed is a resumed session
+            for sid, email, started, last_seen, ended, pages in rows:
+                closed_at = known.get(sid)
+                if closed_at is not None and started > closed_at:
+                    cursor.execute("UPDATE user_sessions SET session_id = %s WHERE session_id = %s AND ended_at = %s",
+                                   (_closed_id(sid, closed_at), sid, closed_at))
+                    del known[sid]
+            # ended_at is decided before last_seen_at is overwritten: activity another
+            # worker saw after this one closed the session keeps it open
+            cursor.executemany("""
+                INSERT INTO user_sessions
+                    (session_id, email, started_at, last_seen_at, ended_at, duration_seconds, page_views)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE
+                    ended_at = IF(VALUES(last_seen_at) >= last_seen_at, VALUES(ended_at), ended_at),
+                    started_at = LEAST(started_at, VALUES(started_at)),
+                    last_seen_at = GREATEST(last_seen_at, VALUES(last_seen_at)),
+                    duration_seconds = TIMESTAMPDIFF(SECOND, started_at, last_seen_at),
+                    page_views = page_views + VALUES(page_views)
+            """, [(sid, email, started, last_seen, ended, int((last_seen - started).total_seconds()), pages)
+                  for sid, email, started, last_seen, ended, pages in rows])
+            activity = {}
+            for sid, email, started, last_seen, ended, pages in rows:
+                sessions, page_views = activity.get((last_seen.date(), email), (0, 0))
+                activity[(last_seen.date(), email)] = (sessions + (sid not in known), page_views + pages)
+            activity_leaderboard.add_activity(cursor, activity)
+        activity_sketches.write(cursor, sketches)
+        traffic_rollups.write(cursor, traffic)
+        # Sessions left open by a worker that exited, or idle on every worker
+        cursor.execute("""
+            UPDATE user_sessions SET ended_at = last_seen_at
+            WHERE ended_at IS NULL AND last_seen_at < %s
+        """, (now - timedelta(seconds=SESSION_IDLE_TIMEOUT_SECONDS),))
+        conn.commit()
+    except mysql.connector.Error as err:
+        print(f"⚠️ [Sessions] Flush of {len(rows)} session(s) failed, will retry: {err}")
+        _restore(rows)
+        activity_sketches.restore(sketches)
+        traffic_rollups.restore(traffic)
+        return 0
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+    return len(rows)
+
+
+def _flush_loop():
+    while not _stop.wait(SESSION_FLUSH_SECONDS):
+        flush()
+
+
+def start():
+    """Starts the periodic flush for this worker."""
+    global _flush_thread
+    if _flush_thread and _flush_thread.is_alive():
+        return
+    _stop.clear()
+    _flush_thread = threading.Thread(target=_flush_loop, name="session-tracker-flush", daemon=True)
+    _flush_thread.start()
+
+
+def stop():
+    """Stops the flush thread and writes what is still in memory."""
+    _stop.set()
+    flush()
+
+
+def tracker_stats() -> dict:
+    with _lock:
+        return {"active_sessions": len(_active),
+                "pending_writes": sum(1 for e in _active.values() if e["dirty"])}
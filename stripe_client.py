@@ -0,0 +1,268 @@
+# stripe_client.py
+import asyncio
+import functools
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import stripe
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Single place where the Stripe SDK is configured and every API call goes
+# through. Importing this module sets the API key and installs an HTTP client
+# that keeps a keep-alive session per thread and honours per-call timeouts.
+# call() adds jittered retries for transient failures (mutating calls carry an
+# idempotency key so a retry cannot double-charge or double-create), a circuit
+# breaker that fails fast with StripeUnavailable while Stripe is degraded, and
+# per-operation latency metrics. Async handlers use acall()/arun(), which run
+# the blocking SDK on a dedicated bounded thread pool so slow Stripe traffic
+# never occupies the event loop or the threadpool that login and dashboard
+# requests share. Their deadline also bounds call() itself: attempt timeouts
+# shrink to the time left and no retry starts that cannot finish, so a call
+# (mutations included) never completes after the caller has given up on it.
+STRIPE_TIMEOUT_SECONDS = float(os.getenv("STRIPE_TIMEOUT_SECONDS", "10"))
+STRIPE_MAX_RETRIES = int(os.getenv("STRIPE_MAX_RETRIES", "2"))
+STRIPE_RETRY_BASE_SECONDS = float(os.getenv("STRIPE_RETRY_BASE_SECONDS", "0.25"))
+STRIPE_BREAKER_THRESHOLD = int(os.getenv("STRIPE_BREAKER_THRESHOLD", "5"))
+STRIPE_BREAKER_COOLDOWN_SECONDS = float(os.getenv("STRIPE_BREAKER_COOLDOWN_SECONDS", "30"))
+STRIPE_ASYNC_MAX_CONCURRENCY = int(os.getenv("STRIPE_ASYNC_MAX_CONCURRENCY", "16"))
+STRIPE_ASYNC_DEADLINE_SECONDS = float(os.getenv("STRIPE_ASYNC_DEADLINE_SECONDS", "20"))
+STRIPE_MIN_ATTEMPT_SECONDS = 1.0  # No attempt starts with less time than this left before the deadline
+STRIPE_DEADLINE_GRACE_SECONDS = 2.0  # arun() waits this long past the deadline for call() to give up itself
+LATENCY_SAMPLES = 500
+
+MUTATING_METHODS = ("create", "modify", "cancel", "delete", "pay", "void_invoice")
+
+
+class StripeUnavailable(stripe.error.StripeError):
+    """Raised when the breaker is open or Stripe could not answer within the deadline."""
+
+
+class _TimeoutRequestsClient(stripe.RequestsClient):
+    """RequestsClient whose timeout can be overridden per call on the current thread."""
+
+    def __init__(self, timeout: float):
+        self._local_timeout = threading.local()
+        super().__init__(timeout=timeout)
+
+    @property
+    def _timeout(self):
+        return getattr(self._local_timeout, "value", None) or self._default_timeout
+
+    @_timeout.setter
+    def _timeout(self, value):
+        self._default_timeout = value
+
+    def override_timeout(self, value):
+        self._local_timeout.value = value
+
+
+_http_client = _TimeoutRequestsClient(timeout=STRIPE_TIMEOUT_SECONDS)
+stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+stripe.default_http_client = _http_client
+stripe.max_network_retries = 0  # Retries happen in call(), where the breaker can see them
+if os.getenv("STRIPE_API_BASE"):
+    stripe.api_base = os.getenv("STRIPE_API_BASE")  # e.g. fake_stripe.py for offline load tests
+
+
+# --- Circuit breaker ---
+
+_breaker_lock = threading.Lock()
+_breaker = {"state": "closed", "failures": 0, "opened_at": None, "trial_in_flight": False, "times_opened": 0}
+
+
+def _breaker_allow() -> bool:
+    with _breaker_lock:
+        if _breaker["state"] == "closed":
+            return True
+        if _breaker["state"] == "open":
+            if time.monotonic() - _breaker["opened_at"] < STRIPE_BREAKER_COOLDOWN_SECONDS:
+                return False
+            _breaker["state"] = "half_open"
+        # Half-open: let a single trial call through
+        if _breaker["trial_in_flight"]:
+            return False
+        _breaker["trial_in_flight"] = True
+        return True
+
+
+def _breaker_record(success: bool):
+    with _breaker_lock:
+        _breaker["trial_in_flight"] = False
+        if success:
+            if _breaker["state"] != "closed":
+                print("✅ [Stripe] Circuit breaker closed; Stripe is responding again.")
+            _breaker.update(state="closed", failures=0, opened_at=None)
+            return
+        _breaker["failures"] += 1
+        if _breaker["state"] == "half_open" or _breaker["failures"] >= STRIPE_BREAKER_THRESHOLD:
+            if _breaker["state"] != "open":
+                _breaker["times_opened"] += 1
+                print(f"🔥 [Stripe] Circuit breaker opened after {_breaker['failures']} failure(s); "
+                      f"failing fast for {STRIPE_BREAKER_COOLDOWN_SECONDS:.0f}s.")
+            _breaker.update(state="open", opened_at=time.monotonic())
+
+
+def _is_transient(err: Exception) -> bool:
+    if isinstance(err, (stripe.error.APIConnectionError, stripe.error.RateLimitError)):
+        return True
+    if isinstance(err, stripe.error.StripeError):
+        return (err.http_status or 0) >= 500
+    return False
+
+
+# --- Metrics ---
+
+_metrics_lock = threading.Lock()
+_metrics = {}
+
+
+def _record(op: str, elapsed_ms: float, outcome: str):
+    with _metrics_lock:
+        m = _metrics.get(op)
+        if m is None:
+            m = _metrics[op] = {"calls": 0, "errors": 0, "retries": 0, "fast_failed": 0,
+                                "total_ms": 0.0, "max_ms": 0.0, "samples": deque(maxlen=LATENCY_SAMPLES)}
+        if outcome == "fast_failed":
+            m["fast_failed"] += 1
+            return
+        if outcome == "retry":
+            m["retries"] += 1
+            return
+        m["calls"] += 1
+        if outcome == "error":
+            m["errors"] += 1
+        m["total_ms"] += elapsed_ms
+        m["max_ms"] = max(m["max_ms"], elapsed_ms)
+        m["samples"].append(elapsed_ms)
+
+
+def stripe_metrics() -> dict:
+    """Per-operation call counts and latencies, plus the breaker state."""
+    operations = {}
+    with _metrics_lock:
+        for op, m in _metrics.items():
+            samples = sorted(m["samples"])
+            def pct(p):
+                return round(samples[min(len(samples) - 1, int(p / 100 * len(samples)))], 1) if samples else 0.0
+            operations[op] = {
+                "calls": m["calls"],
+                "errors": m["errors"],
+                "retries": m["retries"],
+                "fast_failed": m["fast_failed"],
+                "avg_ms": round(m["total_ms"] / m["calls"], 1) if m["calls"] else 0.0,
+                "p50_ms": pct(50),
+                "p95_ms": pct(95),
+                "max_ms": round(m["max_ms"], 1),
+            }
+    with _breaker_lock:
+        breaker = {"state": _breaker["state"], "consecutive_failures": _breaker["failures"],
+                   "times_opened": _breaker["times_opened"]}
+    return {"breaker": breaker, "operations": operations}
+
+
+def is_degraded() -> bool:
+    with _breaker_lock:
+        return _breaker["state"] == "open"
+
+
+# --- Calls ---
+
+_deadline = threading.local()  # Monotonic deadline of the arun() job on this pool thread, if any
+
+
+def call(op: str, fn: Callable, *args, timeout: float = None, retries: int = None, **kwargs):
+    """Calls a Stripe SDK method with timeout, retries, breaker and metrics.
+
+    op names the operation in metrics, e.g. call("portal.create", stripe.billing_portal.Session.create, ...).
+    Raises StripeUnavailable while the breaker is open; other Stripe errors propagate
+    unchanged once retries are exhausted.
+    """
+    retries = STRIPE_MAX_RETRIES if retries is None else retries
+    if getattr(fn, "__name__", "") in MUTATING_METHODS and "idempotency_key" not in kwargs:
+        kwargs["idempotency_key"] = str(uuid.uuid4())
+    deadline_at = getattr(_deadline, "value", None)
+
+    attempt = 0
+    while True:
+        attempt_timeout = timeout
+        if deadline_at is not None:
+            remaining = deadline_at - time.monotonic()
+            if remaining < STRIPE_MIN_ATTEMPT_SECONDS:
+                _breaker_record(success=False)
+                _record(op, 0.0, "error")
+                raise StripeUnavailable("Stripe did not respond in time. Please try again shortly.")
+            # Connect and read are each bounded by the timeout
+            attempt_timeout = min(timeout or STRIPE_TIMEOUT_SECONDS, remaining / 2)
+
+        if not _breaker_allow():
+            _record(op, 0.0, "fast_failed")
+            raise StripeUnavailable("Stripe is temporarily unavailable. Please try again shortly.")
+
+        _http_client.override_timeout(attempt_timeout)
+        started = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            transient = _is_transient(e)
+            # Only outages count against the breaker, not card declines or bad requests
+            _breaker_record(success=not transient)
+            _record(op, elapsed_ms, "error")
+            if not transient or attempt >= retries:
+                raise
+            delay = random.uniform(0, STRIPE_RETRY_BASE_SECONDS * (2 ** (attempt + 1)))
+            if deadline_at is not None and time.monotonic() + delay + STRIPE_MIN_ATTEMPT_SECONDS > deadline_at:
+                raise  # No time left for another attempt
+            attempt += 1
+            _record(op, 0.0, "retry")
+            time.sleep(delay)
+            continue
+        finally:
+            _http_client.override_timeout(None)
+
+        _breaker_record(success=True)
+        _record(op, (time.perf_counter() - started) * 1000, "ok")
+        return result
+
+
+# --- Async facade ---
+
+_executor = ThreadPoolExecutor(max_workers=STRIPE_ASYNC_MAX_CONCURRENCY, thread_name_prefix="stripe")
+
+
+async def arun(fn: Callable, *args, deadline: float = None, **kwargs):
+    """Runs a blocking Stripe-bound function on the Stripe pool without blocking the event loop.
+
+    deadline bounds queueing plus execution. Every call() made by fn sees it and
+    gives up in time, raising StripeUnavailable; the wait here is only a backstop.
+    """
+    deadline = deadline or STRIPE_ASYNC_DEADLINE_SECONDS
+    loop = asyncio.get_running_loop()
+    job = functools.partial(_run_with_deadline, time.monotonic() + deadline, fn, *args, **kwargs)
+    future = loop.run_in_executor(_executor, job)
+    try:
+        return await asyncio.wait_for(future, timeout=deadline + STRIPE_DEADLINE_GRACE_SECONDS)
+    except asyncio.TimeoutError:
+        _breaker_record(success=False)
+        raise StripeUnavailable("Stripe did not respond in time. Please try again shortly.")
+
+
+def _run_with_deadline(deadline_at: float, fn: Callable, *args, **kwargs):
+    _deadline.value = deadline_at
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _deadline.value = None
+
+
+async def acall(op: str, fn: Callable, *args, deadline: float = None, **kwargs):
+    """Awaitable call(): same retries, breaker and metrics, run on the Stripe pool."""
+    return await arun(call, op, fn, *args, deadline=deadline, **kwargs)
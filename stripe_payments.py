@@ -1,13 +1,16 @@
 # stripe_payments.py
 import stripe
+import stripe_client
+import plan_catalog
 import os
 from fastapi import APIRouter, Request, Query, HTTPException
 from fastapi.responses import RedirectResponse
+from fastapi.templating import Jinja2Templates
 import mysql.connector # Keep import if needed elsewhere, but remove DB logic below
+from customer_resolver import customer_for_email
 
 router = APIRouter()
-
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+templates = Jinja2Templates(directory="templates")
 
 # This route correctly uses @router.post
 @router.post("/create-checkout-session")
@@ -26,23 +29,19 @@ async def create_checkout_session(
             print(f"Invalid email format found in session: {user_email}")
             raise HTTPException(status_code=400, detail="Invalid email format associated with user")
 
-        # Determine Stripe Price ID
-        if plan == "monthly":
-            price_id = os.getenv("STRIPE_PRICE_ID_MONTHLY")
-        elif plan == "annual":
-            price_id = os.getenv("STRIPE_PRICE_ID_ANNUAL")
-        else:
+        # Determine Stripe Price ID from the plan catalog
+        if plan not in plan_catalog.PLAN_NAMES:
             raise HTTPException(status_code=400, detail="Invalid plan")
-
-        # Check if price_id was actually found
-        if not price_id:
+        offered = plan_catalog.plan(plan)
+        if not offered:
              print(f"Stripe Price ID not found for plan: {plan}")
              raise HTTPException(status_code=500, detail=f"Configuration error: Price ID for plan '{plan}' not set.")
+        price_id = offered.price_id
 
         print(f"🔁 Creating Stripe checkout session for {user_email} (from session) with plan {plan} using Price ID: {price_id}") # Updated log
 
         # Create Stripe Checkout Session using the email from session
-        session = stripe.checkout.Session.create(
+        session = await stripe_client.acall("checkout.create", stripe.checkout.Session.create,
             payment_method_types=["card"],
             mode="subscription",
             customer_email=user_email, # Use the email from session
@@ -85,17 +84,15 @@ async def manage_subscription(request: Request):
 
     # Proceed with Stripe logic using the email from session
     try:
-        # Find Stripe customer by email
-        customers = stripe.Customer.list(email=email, limit=1)
-        if not customers.data:
+        # Resolve the Stripe customer (DB/cache first, Stripe search only as a fallback)
+        customer_id = await stripe_client.arun(customer_for_email, email)
+        if not customer_id:
             print(f"Stripe customer not found for email: {email}")
             raise HTTPException(status_code=404, detail="Stripe customer not found for this email.")
 
-        customer_id = customers.data[0].id
-
         # Create a billing portal session
         return_url = os.getenv("STRIPE_PORTAL_RETURN_URL", "https://cricketstatspack.com/dashboard")
-        portal_session = stripe.billing_portal.Session.create(
+        portal_session = await stripe_client.acall("portal.create", stripe.billing_portal.Session.create,
             customer=customer_id,
             return_url=return_url
         )
@@ -103,6 +100,15 @@ async def manage_subscription(request: Request):
         # Redirect to Stripe Billing Portal
         return RedirectResponse(portal_session.url, status_code=303)
 
+    except HTTPException:
+        raise
+    except stripe_client.StripeUnavailable:
+        print(f"⚠️ Stripe circuit open; billing portal unavailable for {email}")
+        return templates.TemplateResponse("error.html", {
+            "request": request,
+            "error_title": "Billing temporarily unavailable",
+            "error_message": "Our payment provider is having problems right now. Your subscription is unaffected; please try again in a few minutes."
+        }, status_code=503)
     except stripe.error.StripeError as e:
         print(f"Stripe error creating portal session for {email}: {e}")
         raise HTTPException(status_code=500, detail=f"Stripe error: {str(e)}")
@@ -1,15 +1,23 @@
 # stripe_webhook.py
 from fastapi import APIRouter, Request, Header, HTTPException
 import stripe
+import stripe_client
 import os
 import mysql.connector
 from datetime import datetime # Import datetime
 from auth_utils import log_action # Import log_action
+from entitlement_cache import invalidate_entitlement
+from webhook_queue import enqueue_event, partition_fields
+import event_store
+import customer_resolver
+import plan_catalog
+import invoice_ledger
 
 router = APIRouter()
 
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 endpoint_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
+EVENT_ENDPOINT = "api_webhook" # Key for this endpoint's claims in processed_events
+PREMIUM_STATUSES = ("active", "trialing") # Subscription statuses that grant premium
 
 # Modify function signature to accept status and period_end
 def update_subscription(email, is_active, customer_id=None, subscription_type=None, status=None, period_end=None):
@@ -58,9 +66,13 @@ def update_subscription(email, is_active, customer_id=None, subscription_type=No
             print(f"⚠️ [Webhook] No user found with email {email} to update subscription status.")
         else:
             print(f"✅ [Webhook] DB updated successfully for {email}.")
+            invalidate_entitlement(email)
+            if customer_id:
+                customer_resolver.linked(customer_id, email)
 
     except mysql.connector.Error as err:
         print(f"🔥 [Webhook] Database error updating subscription for {email}: {err}")
+        raise # Let the webhook queue retry the event
     except Exception as e:
         print(f"🔥 [Webhook] Unexpected error updating subscription for {email}: {e}")
     finally:
@@ -69,6 +81,59 @@ def update_subscription(email, is_active, customer_id=None, subscription_type=No
         if conn and conn.is_connected():
             conn.close()
 
+def plan_for_price(price):
+    """Maps an (expanded) Stripe price to 'monthly'/'annual', or None if unknown."""
+    if not price:
+        return None
+    plan = plan_catalog.plan_for_price_id(price.get("id"))
+    if plan:
+        return plan.name
+    # Not in the catalog yet (created since the last refresh): go by its billing interval
+    recurring = price.get("recurring") or {}
+    name = plan_catalog.INTERVAL_PLANS.get(recurring.get("interval"))
+    if name:
+        print(f"⚠️ [Webhook] Price ID {price.get('id')} is not in the plan catalog; using its '{recurring.get('interval')}' interval ({name}).")
+    return name
+
+
+def sync_subscription_state(customer_id, subscription_id, status, period_end):
+    """Mirrors a subscription's current state onto the user owning the Stripe customer."""
+    # Only a user linked to this customer; never a user who merely shares the Stripe email
+    email = customer_resolver.linked_email_for_customer(customer_id)
+    if not email:
+        print(f"⚠️ [Webhook] No user linked to customer {customer_id}; subscription update ignored.")
+        return None
+
+    conn = None
+    cursor = None
+    try:
+        conn = mysql.connector.connect(
+            host=os.getenv("DB_HOST"),
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASS"),
+            database=os.getenv("DB_NAME")
+        )
+        cursor = conn.cursor()
+        is_premium = 1 if status in PREMIUM_STATUSES else 0
+        cursor.execute("""
+            UPDATE users
+            SET is_premium = %s, subscription_id = %s, subscription_status = %s, current_period_end = %s
+            WHERE email = %s AND stripe_customer_id = %s  -- Unchanged if relinked since the lookup
+        """, (is_premium, subscription_id, status, period_end, email, customer_id))
+        conn.commit()
+        print(f"✅ [Webhook] Synced subscription {subscription_id} for {email}. Status: {status}, Period End: {period_end}")
+    except mysql.connector.Error as err:
+        print(f"🔥 [Webhook] Database error syncing subscription {subscription_id}: {err}")
+        raise # Let the webhook queue retry the event
+    finally:
+        if cursor:
+            cursor.close()
+        if conn and conn.is_connected():
+            conn.close()
+
+    invalidate_entitlement(email)
+    return email
+
 @router.post("/api/webhook")
 async def stripe_webhook(request: Request, stripe_signature: str = Header(None)):
     payload = await request.body()
@@ -95,102 +160,102 @@ async def stripe_webhook(request: Request, stripe_signature: str = Header(None))
         print(f"Webhook error: Unexpected error constructing event - {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+    # Reject redeliveries this worker has seen before doing any work
+    if event_store.seen_recently(event["id"], EVENT_ENDPOINT):
+        print(f"ℹ️ [Webhook] Duplicate delivery of event {event['id']} ignored.")
+        return {"status": "duplicate"}
+
+    # Claim and persist the verified event in one transaction and acknowledge
+    # immediately; the queue workers do the processing
+    try:
+        customer_id, object_id, created = partition_fields(event)
+        queued = enqueue_event(event["id"], event["type"], payload.decode("utf-8"),
+                               customer_id=customer_id, object_id=object_id, event_created=created,
+                               claim_endpoint=EVENT_ENDPOINT)
+    except mysql.connector.Error as err:
+        print(f"🔥 [Webhook] Could not persist event {event['id']}: {err}")
+        # 500 makes Stripe redeliver later
+        raise HTTPException(status_code=500, detail="Could not persist event")
+    if not queued:
+        print(f"ℹ️ [Webhook] Duplicate delivery of event {event['id']} ignored.")
+        return {"status": "duplicate"}
+
+    print(f"📥 [Webhook] Queued {event['type']} event {event['id']}.")
+    return {"status": "success"}
+
+
+def handle_event(event, replay=False):
+    """Applies a Stripe event to the database. Called by the webhook queue workers.
+
+    Raising makes the queue retry the event with backoff. replay=True (passed by
+    replay_events.py for events that already completed) re-applies state
+    without writing audit log rows, which were written the first time.
+    """
+    if not isinstance(event, stripe.StripeObject):
+        event = stripe.Event.construct_from(event, stripe.api_key)
 
     event_type = event['type']
     data = event['data']['object']
 
     # Handle checkout.session.completed
     if event_type == 'checkout.session.completed':
-        # Add the retrieve call here to ensure line_items are expanded
-        try:
-            session = stripe.checkout.Session.retrieve(
-                data["id"], # Use the ID from the event data
-                expand=["line_items"]
-            )
-            print(f"ℹ️ [Webhook] Retrieved expanded checkout session: {session.id}")
-        except stripe.error.StripeError as e:
-            print(f"🔥 [Webhook] Stripe error retrieving expanded checkout session {data.get('id')}: {e}")
-            # If retrieval fails, we might not be able to determine the plan reliably.
-            # Raise an exception to signal a server error.
-            raise HTTPException(status_code=500, detail="Failed to retrieve expanded session details from Stripe.")
-        except Exception as e:
-             print(f"🔥 [Webhook] Unexpected error retrieving expanded checkout session {data.get('id')}: {e}")
-             raise HTTPException(status_code=500, detail="Unexpected error retrieving session details.")
-
-        # Now use the retrieved 'session' object which includes line_items
+        # One expanded retrieve gives us the price and the subscription state.
+        # Stripe errors propagate so the queue retries the event later.
+        session = stripe_client.call("checkout.retrieve", stripe.checkout.Session.retrieve,
+            data["id"],
+            expand=["line_items", "subscription"]
+        )
+
         email = session.get('customer_email')
         customer_id = session.get('customer')
-        subscription_id = session.get('subscription') # Get subscription ID
 
         # Ensure essential data is present
         if email and customer_id:
-            subscription_type = "unknown" # Default
-            price_id = None
-            status = None # Default status
-            period_end = None # Default period end
-
-            # --- Try extracting price_id directly from the retrieved session line_items ---
-            try:
-                # Use line_items (should now be present due to expand)
-                if session.get('line_items') and session['line_items'].get('data'):
-                    price_id = session['line_items']['data'][0]['price']['id']
-                    print(f"ℹ️ [Webhook] Extracted price_id from expanded line_items: {price_id}")
-                else:
-                    # This case should be less likely now, but log it.
-                    print("⚠️ [Webhook] line_items not found in retrieved expanded session object.")
-                    # Optional: Add fallback logic here if needed, e.g., retrieving subscription
-
-                # Determine subscription type based on price_id
-                if price_id:
-                    monthly_id = os.getenv("STRIPE_PRICE_ID_MONTHLY")
-                    annual_id = os.getenv("STRIPE_PRICE_ID_ANNUAL")
-
-                    if price_id == monthly_id:
-                        subscription_type = "monthly"
-                    elif price_id == annual_id:
-                        subscription_type = "annual"
-                    else:
-                        print(f"⚠️ [Webhook] Price ID {price_id} does not match known monthly/annual IDs.")
-                        subscription_type = "unknown" # Keep as unknown if no match
-                else:
-                    print("⚠️ [Webhook] Failed to determine price_id. Subscription type remains 'unknown'.")
-
-                # --- Retrieve subscription details if ID exists ---
-                if subscription_id:
-                    try:
-                        sub = stripe.Subscription.retrieve(subscription_id)
-                        status = sub.get("status") # e.g., 'active', 'trialing', 'incomplete'
-                        period_end_ts = sub.get("current_period_end")
-                        if period_end_ts:
-                            period_end = datetime.utcfromtimestamp(period_end_ts) # Convert timestamp
-                        print(f"ℹ️ [Webhook] Retrieved subscription {subscription_id} details. Status: {status}, Period End: {period_end}")
-                    except stripe.error.StripeError as e:
-                        print(f"🔥 [Webhook] Stripe error retrieving subscription {subscription_id}: {e}")
-                        # Decide if you still want to grant access even if sub retrieval fails
-                        status = "error_retrieving" # Mark status as problematic
-                    except Exception as e:
-                        print(f"🔥 [Webhook] Unexpected error retrieving subscription {subscription_id}: {e}")
-                        status = "error_retrieving"
-
-                # Call updated function with determined type, status, and period_end
-                update_subscription(email, True, customer_id, subscription_type, status, period_end)
-                # Log subscription started after successful update
-                log_action(email, "subscription_started", f"Type: {subscription_type}, Status: {status}")
+            price = None
+            if session.get('line_items') and session['line_items'].get('data'):
+                price = session['line_items']['data'][0].get('price')
+            subscription_type = plan_for_price(price)
+            if not subscription_type:
+                # Never grant premium on a plan we cannot identify; retry/dead-letter instead
+                raise ValueError(f"Could not determine plan for checkout session {session.id} (price: {price.get('id') if price else None})")
 
-            except Exception as e:
-                 # Catch errors during price_id extraction or type determination
-                 print(f"🔥 [Webhook] Error processing session data for {email}: {e}")
-                 # Decide if you still want to grant premium access despite the error
-                 print(f"⚠️ [Webhook] Granting premium access for {email} despite error, type set to 'unknown', status/period_end set to None.")
-                 # Pass None for status and period_end in the fallback
-                 update_subscription(email, True, customer_id, "unknown", None, None)
-                 # Log subscription started even on fallback, noting the unknown type
-                 log_action(email, "subscription_started", "Type: unknown (fallback due to error)")
+            status = None
+            period_end = None
+            sub = session.get('subscription')
+            if sub:
+                status = sub.get("status") # e.g., 'active', 'trialing', 'incomplete'
+                period_end_ts = sub.get("current_period_end")
+                if period_end_ts:
+                    period_end = datetime.utcfromtimestamp(period_end_ts) # Convert timestamp
+            print(f"ℹ️ [Webhook] Checkout {session.id}: plan {subscription_type}, status {status}, period end {period_end}")
+
+            update_subscription(email, True, customer_id, subscription_type, status, period_end)
+            # Log subscription started after successful update
+            if not replay:
+                log_action(email, "subscription_started", f"Type: {subscription_type}, Status: {status}")
 
         else:
             # Log missing essential data more clearly
             print(f"⚠️ checkout.session.completed event received without required data after retrieve. Email: {email}, CustomerID: {customer_id}")
 
+    # Subscription changed (renewal, plan change, past_due, cancel_at_period_end...).
+    # The payload carries the full state; the queue coalesces bursts of these.
+    elif event_type == 'customer.subscription.updated':
+        customer_id = data.get('customer')
+        period_end_ts = data.get('current_period_end')
+        period_end = datetime.utcfromtimestamp(period_end_ts) if period_end_ts else None
+        if customer_id:
+            sync_subscription_state(customer_id, data.get('id'), data.get('status'), period_end)
+        else:
+            print(f"⚠️ [Webhook] customer.subscription.updated event {event['id']} has no customer.")
+
+    # Paid invoice: append to the revenue ledger (idempotent on the invoice ID)
+    elif event_type == 'invoice.payment_succeeded':
+        if not data.get('amount_paid'):
+            return  # $0 trial/proration invoices carry no revenue
+        if invoice_ledger.record_invoice(data):
+            print(f"💷 [Webhook] Recorded invoice {data.get('id')} ({data.get('amount_paid')} {data.get('currency')}) in the ledger.")
+
     # Handle subscription deleted or payment failed
     elif event_type in ['customer.subscription.deleted', 'invoice.payment_failed']:
         email = None
@@ -203,22 +268,16 @@ async def stripe_webhook(request: Request, stripe_signature: str = Header(None))
                  email = data['customer_details']['email']
              # Fallback: use customer ID if email not directly available
              elif not email and customer_id:
-                 try:
-                     customer = stripe.Customer.retrieve(customer_id)
-                     email = customer.email
-                 except stripe.error.StripeError as e:
-                     print(f"🔥 [Webhook] Error retrieving customer {customer_id} for event {event_type}: {e}")
+                 # Local index first; Stripe only for customers we have never linked.
+                 # Errors propagate so the queue retries the event.
+                 email = customer_resolver.email_for_customer(customer_id)
 
         # For invoice payment failed, email is often directly on the invoice object
         elif event_type == 'invoice.payment_failed':
             email = data.get('customer_email')
             # Fallback: use customer ID if email not on invoice
             if not email and customer_id:
-                 try:
-                     customer = stripe.Customer.retrieve(customer_id)
-                     email = customer.email
-                 except stripe.error.StripeError as e:
-                     print(f"🔥 [Webhook] Error retrieving customer {customer_id} for event {event_type}: {e}")
+                 email = customer_resolver.email_for_customer(customer_id)
 
 
         if email:
@@ -226,8 +285,7 @@ async def stripe_webhook(request: Request, stripe_signature: str = Header(None))
             # The update_subscription function already sets status to 'canceled'
             update_subscription(email, False)
             # Log churn action after successful update attempt
-            log_action(email, "churn", f"Subscription cancelled (Event: {event_type})") # Changed action to 'churn'
+            if not replay:
+                log_action(email, "churn", f"Subscription cancelled (Event: {event_type})") # Changed action to 'churn'
         else:
              print(f"⚠️ [Webhook] {event_type} event received without customer_email or could not retrieve.")
-
-    return {"status": "success"}
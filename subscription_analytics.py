@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# subscription_analytics.py
+"""
+Subscription analytics computed column-wise from the invoice ledger.
+
+Paid invoices are loaded once into a DataFrame, and each invoice's amount is
+spread over its service period as a monthly rate (amount divided by the
+billing interval in months, so 28- and 31-day months of the same plan give
+the same MRR). Daily MRR is then the
+cumulative sum of those rates starting and stopping, so there is no
+per-user or per-day Python loop. Consecutive periods of one customer are
+merged into subscription spans (with a grace window for late renewals),
+which gives new and churned customers and MRR per day, and from those
+churn rate, ARPU and LTV for any date range.
+
+The daily frame is built at most once per UTC day per currency and worker;
+range queries slice it. Schema: add_invoice_ledger_table.sql
+
+Usage:
+    python subscription_analytics.py [--start 2025-01-01] [--end 2025-06-30] [--currency gbp]
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+from datetime import date, datetime, timedelta
+
+import mysql.connector
+import pandas as pd
+from dotenv import load_dotenv
+
+import plan_catalog
+
+load_dotenv()
+
+AVG_MONTH_DAYS = 30.4375
+# A renewal paid this long after the previous period ended still counts as the same subscription
+RENEWAL_GRACE_DAYS = int(os.getenv("ANALYTICS_RENEWAL_GRACE_DAYS", "7"))
+DAILY_COLUMNS = ["mrr", "active_customers", "new_customers", "new_mrr",
+                 "churned_customers", "churned_mrr", "net_new_mrr", "revenue"]
+COUNT_COLUMNS = ["active_customers", "new_customers", "churned_customers"]
+
+_cache = {}  # currency -> (utc date built, daily frame)
+_lock = threading.Lock()
+
+
+def _connect():
+    return mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASS"),
+        database=os.getenv("DB_NAME")
+    )
+
+
+def default_currency() -> str:
+    monthly = plan_catalog.plan("monthly")
+    return monthly.currency if monthly else "gbp"
+
+
+def load_invoices(currency: str) -> pd.DataFrame:
+    """Paid invoices in one currency as columns (amounts in major units)."""
+    conn = None
+    cursor = None
+    try:
+        conn = _connect()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT customer_id, amount_paid, period_start, period_end, paid_at, price_id
+            FROM invoice_ledger
+            WHERE currency = %s AND amount_paid > 0 AND customer_id IS NOT NULL
+        """, (currency,))
+        rows = cursor.fetchall()
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+    return prepare_invoices(pd.DataFrame.from_records(
+        rows, columns=["customer_id", "amount_paid", "period_start", "period_end", "paid_at", "price_id"]))
+
+
+def prepare_invoices(invoices: pd.DataFrame) -> pd.DataFrame:
+    """Normalises raw ledger rows and adds each invoice's monthly rate."""
+    inv = invoices.copy()
+    for col in ("period_start", "period_end", "paid_at"):
+        inv[col] = pd.to_datetime(inv[col])
+    # Invoices recorded without a line period are treated as one month from payment
+    inv["period_start"] = inv["period_start"].fillna(inv["paid_at"])
+    inv["period_end"] = inv["period_end"].fillna(inv["period_start"] + pd.Timedelta(days=AVG_MONTH_DAYS))
+    inv["amount"] = inv["amount_paid"].astype("float64") / 100.0
+    # Billing interval from the plan catalog; prices it does not know use the
+    # period length rounded to whole months (annual periods come out as 12)
+    period_days = (inv["period_end"] - inv["period_start"]).dt.total_seconds() / 86400.0
+    months = (period_days / AVG_MONTH_DAYS).round().clip(lower=1.0)
+    if "price_id" in inv:
+        plan_months = {}
+        for price_id in inv["price_id"].dropna().unique():
+            plan = plan_catalog.plan_for_price_id(price_id)
+            if plan:
+                plan_months[price_id] = plan.months
+        months = inv["price_id"].map(plan_months).fillna(months)
+    inv["mrr"] = inv["amount"] / months
+    return inv.sort_values(["customer_id", "period_start"], kind="stable").reset_index(drop=True)
+
+
+def subscription_spans(inv: pd.DataFrame, as_of: pd.Timestamp) -> pd.DataFrame:
+    """Merges each customer's back-to-back invoice periods into spans of continuous subscription."""
+    grace = pd.Timedelta(days=RENEWAL_GRACE_DAYS)
+    covered_until = inv.groupby("customer_id")["period_end"].cummax()
+    prev_end = covered_until.groupby(inv["customer_id"]).shift()
+    starts_span = prev_end.isna() | (inv["period_start"] > prev_end + grace)
+    spans = inv.groupby(starts_span.cumsum()).agg(
+        customer_id=("customer_id", "first"),
+        start=("period_start", "min"),
+        end=("period_end", "max"),
+        first_mrr=("mrr", "first"),
+        last_mrr=("mrr", "last"),
+    )
+    spans["churned"] = spans["end"] + grace < as_of
+    return spans.reset_index(drop=True)
+
+
+def _per_day(values: pd.Series, days: pd.Series, index: pd.DatetimeIndex) -> pd.Series:
+    return values.groupby(days).sum().reindex(index, fill_value=0)
+
+
+def build_daily(inv: pd.DataFrame, until: date = None) -> pd.DataFrame:
+    """One row per day from the first paid period to `until` with the DAILY_COLUMNS metrics."""
+    until = pd.Timestamp(until or datetime.utcnow().date())
+    if inv.empty:
+        return pd.DataFrame(columns=DAILY_COLUMNS, index=pd.DatetimeIndex([], name="date"), dtype="float64")
+    index = pd.date_range(inv["period_start"].min().normalize(), until, freq="D", name="date")
+
+    # MRR: each invoice's rate switches on at period start and off at period end
+    mrr_delta = (_per_day(inv["mrr"], inv["period_start"].dt.normalize(), index)
+                 - _per_day(inv["mrr"], inv["period_end"].dt.normalize(), index))
+    mrr = mrr_delta.cumsum().round(6).clip(lower=0)
+
+    spans = subscription_spans(inv, until + pd.Timedelta(days=1))
+    churned = spans[spans["churned"]]
+    start_days = spans["start"].dt.normalize()
+    churn_days = churned["end"].dt.normalize()
+    ones = pd.Series(1, index=spans.index)
+    new_customers = _per_day(ones, start_days, index)
+    churned_customers = _per_day(ones[churned.index], churn_days, index)
+
+    daily = pd.DataFrame({
+        "mrr": mrr,
+        "active_customers": (new_customers - churned_customers).cumsum(),
+        "new_customers": new_customers,
+        "new_mrr": _per_day(spans["first_mrr"], start_days, index),
+        "churned_customers": churned_customers,
+        "churned_mrr": _per_day(churned["last_mrr"], churn_days, index),
+        "net_new_mrr": mrr.diff().fillna(mrr),
+        "revenue": _per_day(inv["amount"], inv["paid_at"].dt.normalize(), index),
+    }, index=index)
+    return daily.round(2)
+
+
+def daily_metrics(currency: str = None, refresh: bool = False) -> pd.DataFrame:
+    """The cached daily frame for this currency, rebuilt once per UTC day."""
+    currency = (currency or default_currency()).lower()
+    today = datetime.utcnow().date()
+    with _lock:
+        cached = _cache.get(currency)
+        if cached and cached[0] == today and not refresh:
+            return cached[1]
+    daily = build_daily(load_invoices(currency), today)
+    with _lock:
+        _cache[currency] = (today, daily)
+    return daily
+
+
+def summarize(daily: pd.DataFrame, start: date, end: date) -> dict:
+    """Range metrics (inclusive dates) from a daily frame."""
+    window = daily.loc[pd.Timestamp(start):pd.Timestamp(end)]
+    before = daily.loc[:pd.Timestamp(start) - pd.Timedelta(days=1)]
+    days = (end - start).days + 1
+    opening = before.iloc[-1] if len(before) else None
+    closing = window.iloc[-1] if len(window) else opening
+
+    mrr_start = float(opening["mrr"]) if opening is not None else 0.0
+    customers_start = int(opening["active_customers"]) if opening is not None else 0
+    mrr_end = float(closing["mrr"]) if closing is not None else 0.0
+    customers_end = int(closing["active_customers"]) if closing is not None else 0
+    new_customers = int(window["new_customers"].sum())
+    churned = int(window["churned_customers"].sum())
+
+    # Churned customers include some who joined inside the range, so they count in the base too
+    churn_base = customers_start + new_customers
+    churn_rate = churned / churn_base if churn_base else None
+    # Normalised to a month so ranges of different lengths compare
+    monthly_churn = 1 - (1 - churn_rate) ** (AVG_MONTH_DAYS / days) if churn_rate is not None else None
+    arpu = mrr_end / customers_end if customers_end else None
+    return {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "days": days,
+        "mrr_start": round(mrr_start, 2),
+        "mrr_end": round(mrr_end, 2),
+        "net_new_mrr": round(mrr_end - mrr_start, 2),
+        "new_mrr": round(float(window["new_mrr"].sum()), 2),
+        "churned_mrr": round(float(window["churned_mrr"].sum()), 2),
+        "revenue": round(float(window["revenue"].sum()), 2),
+        "customers_start": customers_start,
+        "customers_end": customers_end,
+        "new_customers": new_customers,
+        "churned_customers": churned,
+        "churn_base": churn_base,
+        "churn_rate": round(churn_rate * 100, 2) if churn_rate is not None else None,
+        "monthly_churn_rate": round(monthly_churn * 100, 2) if monthly_churn is not None else None,
+        "arpu": round(arpu, 2) if arpu is not None else None,
+        "ltv": round(arpu / monthly_churn, 2) if arpu is not None and monthly_churn else None,
+    }
+
+
+def report(start: date = None, end: date = None, currency: str = None, refresh: bool = False) -> dict:
+    """Summary plus the daily series for a date range (default: the last 30 days)."""
+    currency = (currency or default_currency()).lower()
+    end = end or datetime.utcnow().date()
+    start = start or end - timedelta(days=29)
+    if start > end:
+        raise ValueError("start must be on or before end")
+    daily = daily_metrics(currency, refresh=refresh)
+    window = daily.loc[pd.Timestamp(start):pd.Timestamp(end)]
+    series = window.reset_index()
+    series["date"] = series["date"].dt.strftime("%Y-%m-%d")
+    plan = plan_catalog.plan("monthly")
+    return {
+        "currency": currency,
+        "currency_symbol": plan.currency_symbol if plan and plan.currency == currency else currency.upper() + " ",
+        "summary": summarize(daily, start, end),
+        "daily": series.astype({c: "int64" for c in COUNT_COLUMNS}).to_dict("records"),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print subscription analytics from the invoice ledger.")
+    parser.add_argument("--start", help="First day (YYYY-MM-DD, default 30 days before --end)")
+    parser.add_argument("--end", help="Last day (YYYY-MM-DD, default today)")
+    parser.add_argument("--currency", help="Ledger currency (default: the monthly plan's)")
+    parser.add_argument("--daily", action="store_true", help="Include the daily series")
+    args = parser.parse_args(argv)
+
+    result = report(date.fromisoformat(args.start) if args.start else None,
+                    date.fromisoformat(args.end) if args.end else None, args.currency)
+    if not args.daily:
+        result.pop("daily")
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+# traffic_rollups.py
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import mysql.connector
+from dotenv import load_dotenv
+
+import activity_sketches
+
+load_dotenv()
+
+# Pre-aggregated page traffic for the admin traffic dashboard (/admin/traffic).
+#
+# page_views keeps one raw row per request and is never read at request time.
+# The page-view middleware also calls record(), which only bumps in-memory
+# counters keyed by viewer segment ("anonymous", "free" or "premium"):
+#   traffic_hourly       - views per UTC hour per segment
+#   traffic_paths_daily  - views per UTC day per route per segment
+# Paths are the matched route template ("/admin/user/{email}", not every
+# address), so the number of rows per day is bounded by the number of routes;
+# requests that match no route share UNMATCHED_PATH. session_tracker's periodic
+# flush adds the counters to both tables in its batched transaction, next to
+# the distinct-count sketches that supply unique visitors.
+#
+# report() reads only these rollups and the sketches, a few thousand small rows
+# at most, and each worker caches the result for TRAFFIC_CACHE_TTL seconds.
+#
+# Schema: add_traffic_rollup_tables.sql, add_activity_sketches_table.sql
+TRAFFIC_WINDOWS = (1, 7, 30, 90)
+TRAFFIC_HOURLY_HOURS = 48
+TRAFFIC_CACHE_TTL = int(os.getenv("TRAFFIC_CACHE_TTL", "60"))
+TRAFFIC_TOP_PATHS = 20
+SEGMENTS = ("anonymous", "free", "premium")
+UNMATCHED_PATH = "(unmatched)"
+# Pages only premium subscribers can use; non-premium hits are upsell bounces
+PREMIUM_PATHS = tuple(p.strip() for p in os.getenv(
+    "PREMIUM_PATHS", "/billing,/manage-subscription,/cancel-subscription").split(",") if p.strip())
+
+_hourly = {}  # (hour, segment) -> views
+_paths = {}  # (day, path, segment) -> views
+_lock = threading.Lock()
+
+_reports = {}  # window days -> (monotonic time built, report)
+_report_lock = threading.Lock()
+
+
+def segment_for(email: str = None, is_premium: bool = False) -> str:
+    if not email:
+        return "anonymous"
+    return "premium" if is_premium else "free"
+
+
+def record(path: str, segment: str, now: datetime = None):
+    """Counts one page view. Memory only."""
+    now = now or datetime.utcnow()
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    with _lock:
+        _hourly[(hour, segment)] = _hourly.get((hour, segment), 0) + 1
+        key = (now.date(), path or UNMATCHED_PATH, segment)
+        _paths[key] = _paths.get(key, 0) + 1
+
+
+def take() -> tuple:
+    """Hands over the pending counters for a flush."""
+    global _hourly, _paths
+    with _lock:
+        taken, _hourly, _paths = (_hourly, _paths), {}, {}
+    return taken
+
+
+def restore(taken: tuple):
+    """Adds counters from a failed flush back to the pending ones."""
+    hourly, paths = taken
+    with _lock:
+        for key, views in hourly.items():
+            _hourly[key] = _hourly.get(key, 0) + views
+        for key, views in paths.items():
+            _paths[key] = _paths.get(key, 0) + views
+
+
+def write(cursor, taken: tuple):
+    """Adds taken counters to the rollup tables. Runs inside the caller's transaction."""
+    hourly, paths = taken
+    if hourly:
+        cursor.executemany("""
+            INSERT INTO traffic_hourly (hour, segment, views) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE views = views + VALUES(views)
+        """, [(hour, segment, views) for (hour, segment), views in hourly.items()])
+    if paths:
+        cursor.executemany("""
+            INSERT INTO traffic_paths_daily (day, path, segment, views) VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE views = views + VALUES(views)
+        """, [(day, path, segment, views) for (day, path, segment), views in paths.items()])
+
+
+def _build_report(days: int, now: datetime) -> dict:
+    today = now.date()
+    since_day = today - timedelta(days=days - 1)
+    since_hour = now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=TRAFFIC_HOURLY_HOURS - 1)
+    conn = None
+    cursor = None
+    try:
+        conn = mysql.connector.connect(
+            host=os.getenv("DB_HOST"),
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASS"),
+            database=os.getenv("DB_NAME")
+        )
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT hour, segment, views FROM traffic_hourly
+            WHERE hour >= %s
+        """, (min(since_hour, datetime.combine(since_day, datetime.min.time())),))
+        hourly_rows = cursor.fetchall()
+        cursor.execute("""
+            SELECT path, segment, SUM(views) FROM traffic_paths_daily
+            WHERE day >= %s
+            GROUP BY path, segment
+        """, (since_day,))
+        path_rows = cursor.fetchall()
+        visitors = activity_sketches.daily_counts(cursor, "ips", since_day, today)
+        users = activity_sketches.daily_counts(cursor, "users", since_day, today)
+        uniques = activity_sketches.active_counts(cursor, today)
+        window_visitors = activity_sketches.distinct_count(cursor, "ips", days, today)
+        window_users = activity_sketches.distinct_count(cursor, "users", days, today)
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+
+    hours = [since_hour + timedelta(hours=i) for i in range(TRAFFIC_HOURLY_HOURS)]
+    hourly = {hour: dict.fromkeys(SEGMENTS, 0) for hour in hours}
+    daily = {since_day + timedelta(days=i): dict.fromkeys(SEGMENTS, 0) for i in range(days)}
+    totals = dict.fromkeys(SEGMENTS, 0)
+    for hour, segment, views in hourly_rows:
+        if segment not in totals:
+            continue
+        if hour in hourly:
+            hourly[hour][segment] += views
+        if hour.date() in daily:
+            daily[hour.date()][segment] += views
+            totals[segment] += views
+
+    paths = {}
+    for path, segment, views in path_rows:
+        if segment in totals:
+            paths.setdefault(path, dict.fromkeys(SEGMENTS, 0))[segment] += int(views)
+    top_paths = sorted(paths.items(), key=lambda item: sum(item[1].values()), reverse=True)[:TRAFFIC_TOP_PATHS]
+    premium_paths = [(path, paths.get(path, dict.fromkeys(SEGMENTS, 0))) for path in PREMIUM_PATHS]
+
+    views = sum(totals.values())
+    logged_in = totals["free"] + totals["premium"]
+    return {
+        "days": days,
+        "start": since_day.isoformat(),
+        "end": today.isoformat(),
+        "generated_at": now.isoformat(timespec="seconds"),
+        "summary": {
+            "views": views,
+            "anonymous_views": totals["anonymous"],
+            "logged_in_views": logged_in,
+            "premium_views": totals["premium"],
+            "logged_in_share": round(100 * logged_in / views, 1) if views else None,
+            "unique_visitors": window_visitors,
+            "unique_users": window_users,
+            "dau": uniques["dau"],
+            "wau": uniques["wau"],
+            "mau": uniques["mau"],
+        },
+        "hourly": [dict(hour=hour.isoformat(timespec="minutes"), views=sum(s.values()), **s)
+                   for hour, s in hourly.items()],
+        "daily": [dict(date=day.isoformat(), views=sum(s.values()), unique_visitors=visitors.get(day, 0),
+                       unique_users=users.get(day, 0), **s)
+                  for day, s in daily.items()],
+        "top_paths": [dict(path=path, views=sum(s.values()), **s) for path, s in top_paths],
+        "premium_paths": [dict(path=path, views=sum(s.values()), **s) for path, s in premium_paths],
+    }
+
+
+def report(days: int = 7, refresh: bool = False) -> dict:
+    """The traffic dashboard data for the last `days` UTC days, cached per worker."""
+    if days not in TRAFFIC_WINDOWS:
+        raise ValueError(f"days must be one of {TRAFFIC_WINDOWS}")
+    cached = _reports.get(days)
+    if not refresh and cached and time.monotonic() - cached[0] <= TRAFFIC_CACHE_TTL:
+        return cached[1]
+    with _report_lock:
+        # Another thread may have rebuilt it while we waited
+        cached = _reports.get(days)
+        if not refresh and cached and time.monotonic() - cached[0] <= TRAFFIC_CACHE_TTL:
+            return cached[1]
+        built = _build_report(days, datetime.utcnow())
+        _reports[days] = (time.monotonic(), built)
+        return built
@@ -0,0 +1,142 @@
+# user_activity.py
+import os
+from datetime import datetime
+
+import mysql.connector
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Data for the admin user-activity page (/admin/user/{email}/activity).
+#
+# Everything comes back from one statement: the users row, the password reset
+# count and one keyset page each of sessions and audit events. The reset count
+# is an index lookup on (email, category); the two pages walk
+# user_sessions (email, started_at) and audit_logs (email, timestamp) newest
+# first with the primary key as tie-breaker, so older pages cost the same as the
+# first. The user columns repeat on each page row (at most 2 * (PAGE_SIZE + 1)
+# rows), which is cheaper than the extra round trips.
+#
+# Schema: add_user_sessions_table.sql, add_audit_log_category.sql
+PAGE_SIZE = 20
+
+USER_COLUMNS = ("email", "created_at", "is_premium", "subscription_type", "subscription_status",
+                "current_period_end", "stripe_customer_id", "is_banned", "is_disabled", "reset_attempts",
+                "failed_logins", "lock_until")
+
+
+def encode_cursor(at: datetime, key) -> str:
+    return f"{at.strftime('%Y%m%d%H%M%S%f')}-{key}"
+
+
+def decode_cursor(value: str) -> tuple:
+    """Inverse of encode_cursor; raises ValueError for anything else."""
+    stamp, key = value.split("-", 1)
+    if not key:
+        raise ValueError("empty cursor key")
+    return datetime.strptime(stamp, "%Y%m%d%H%M%S%f"), key
+
+
+def _format_duration(seconds) -> str:
+    if seconds is None:
+        return "—"
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes}m"
+    if minutes:
+        return f"{minutes}m {secs}s"
+    return f"{secs}s"
+
+
+def fetch(email: str, sessions_before: str = None, events_before: str = None, limit: int = PAGE_SIZE):
+    """The page's data in one round trip, or None if there is no such user.
+
+    Returns {"user", "reset_activity_count", "sessions", "events",
+    "next_sessions", "next_events"}; the next_* values are cursors for the
+    following page of each list, or None on the last page.
+    """
+    session_filter, session_params = "", []
+    if sessions_before:
+        before_at, before_id = decode_cursor(sessions_before)
+        session_filter = " AND (started_at < %s OR (started_at = %s AND session_id < %s))"
+        session_params = [before_at, before_at, before_id]
+    event_filter, event_params = "", []
+    if events_before:
+        before_at, before_id = decode_cursor(events_before)
+        event_filter = " AND (timestamp < %s OR (timestamp = %s AND id < %s))"
+        event_params = [before_at, before_at, int(before_id)]
+
+    user_columns = ", ".join(f"u.{c}" for c in USER_COLUMNS)
+    query = f"""
+        SELECT {user_columns}, r.reset_count,
+               x.kind, x.at, x.row_key, x.ended_at, x.seconds, x.page_views, x.action, x.details
+        FROM users u
+        CROSS JOIN (
+            SELECT COUNT(*) AS reset_count FROM audit_logs WHERE email = %s AND category = 'password_reset'
+        ) r
+        LEFT JOIN (
+            (SELECT 'session' AS kind, started_at AS at, session_id AS row_key, ended_at,
+                    duration_seconds AS seconds, page_views, NULL AS action, NULL AS details
+             FROM user_sessions
+             WHERE email = %s{session_filter}
+             ORDER BY started_at DESC, session_id DESC
+             LIMIT %s)
+            UNION ALL
+            (SELECT 'event', timestamp, CAST(id AS CHAR), NULL, NULL, NULL, action, details
+             FROM audit_logs
+             WHERE email = %s AND timestamp IS NOT NULL{event_filter}
+             ORDER BY timestamp DESC, id DESC
+             LIMIT %s)
+        ) x ON TRUE
+        WHERE u.email = %s
+    """
+    params = [email, email, *session_params, limit + 1, email, *event_params, limit + 1, email]
+
+    conn = None
+    cursor = None
+    try:
+        conn = mysql.connector.connect(
+            host=os.getenv("DB_HOST"),
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASS"),
+            database=os.getenv("DB_NAME")
+        )
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(query, tuple(params))
+        rows = cursor.fetchall()
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+
+    if not rows:
+        return None
+    user = {c: rows[0][c] for c in USER_COLUMNS}
+    sessions = [r for r in rows if r["kind"] == "session"]
+    events = [r for r in rows if r["kind"] == "event"]
+    # Each branch is already ordered; the join does not promise to keep that order
+    sessions.sort(key=lambda r: (r["at"], r["row_key"]), reverse=True)
+    events.sort(key=lambda r: (r["at"], int(r["row_key"])), reverse=True)
+    next_sessions = encode_cursor(sessions[limit - 1]["at"], sessions[limit - 1]["row_key"]) if len(sessions) > limit else None
+    next_events = encode_cursor(events[limit - 1]["at"], events[limit - 1]["row_key"]) if len(events) > limit else None
+
+    return {
+        "user": user,
+        "reset_activity_count": rows[0]["reset_count"] or 0,
+        "sessions": [{
+            "login_time": s["at"],
+            "logout_time": s["ended_at"],
+            "page_views": s["page_views"],
+            "login_time_formatted": s["at"].strftime('%Y-%m-%d %H:%M:%S'),
+            "logout_time_formatted": s["ended_at"].strftime('%Y-%m-%d %H:%M:%S') if s["ended_at"] else "Active",
+            "duration_formatted": _format_duration(s["seconds"]),
+        } for s in sessions[:limit]],
+        "events": [{
+            "timestamp": e["at"],
+            "action": e["action"],
+            "details": e["details"],
+            "timestamp_formatted": e["at"].strftime('%Y-%m-%d %H:%M:%S UTC'),
+        } for e in events[:limit]],
+        "next_sessions": next_sessions,
+        "next_events": next_events,
+    }
@@ -0,0 +1,536 @@
+# webhook_queue.py
+import json
+import os
+import queue
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import Callable
+
+import mysql.connector
+from dotenv import load_dotenv
+
+import event_store
+import invalidation_bus
+
+load_dotenv()
+
+# Durable queue for Stripe webhook events. The HTTP endpoint only verifies the
+# signature and persists the raw event here, then acknowledges Stripe. The
+# event_store claim that rejects redeliveries is written in the same
+# transaction, so an event is never claimed without also being queued.
+#
+# Processing: one dispatcher per deployment (elected with a MySQL named lock,
+# the other Gunicorn workers stand by) claims batches of due events and splits
+# them into partitions by Stripe customer ID. Partitions run in parallel on a
+# pool of worker threads; a customer always hashes to the same worker, and the
+# events of a partition run strictly in order. A customer with an event waiting
+# on a retry, or still claimed by a worker, is held back entirely so later
+# events cannot overtake it. Claims record locked_at: events still 'processing'
+# after WEBHOOK_VISIBILITY_TIMEOUT_SECONDS (hung handler, failed status update)
+# go back to the queue on the dispatcher's next sweep, and the dispatcher stops
+# waiting for them, so one stuck customer cannot stall everyone else.
+# Superseded subscription updates within a batch are coalesced so a burst of
+# updates for one subscription costs a single DB write.
+#
+# Failures are retried with exponential backoff and parked as 'dead' after too
+# many attempts. Schema: add_webhook_queue_tables.sql
+WEBHOOK_QUEUE_WORKERS = int(os.getenv("WEBHOOK_QUEUE_WORKERS", "4"))
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "200"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "8"))
+WEBHOOK_BACKOFF_BASE_SECONDS = float(os.getenv("WEBHOOK_BACKOFF_BASE_SECONDS", "5"))
+WEBHOOK_BACKOFF_MAX_SECONDS = float(os.getenv("WEBHOOK_BACKOFF_MAX_SECONDS", "3600"))
+WEBHOOK_POLL_INTERVAL_SECONDS = float(os.getenv("WEBHOOK_POLL_INTERVAL_SECONDS", "2"))
+WEBHOOK_VISIBILITY_TIMEOUT_SECONDS = int(os.getenv("WEBHOOK_VISIBILITY_TIMEOUT_SECONDS", "300"))
+CLAIM_PRUNE_INTERVAL_SECONDS = 3600
+DISPATCHER_LOCK_NAME = "cricketapp_webhook_dispatcher"
+QUEUE_WAKEUP_NAMESPACE = "webhook_queue"
+
+# Event types whose payload carries the full subscription state, so a later one
+# for the same subscription makes an earlier update redundant
+SUPERSEDING_TYPES = ("customer.subscription.updated", "customer.subscription.deleted")
+COALESCIBLE_TYPES = ("customer.subscription.updated",)
+
+_wakeup = threading.Event()
+_stopping = threading.Event()
+_dispatcher = None
+_worker_threads = []
+_worker_queues = []
+_stats_lock = threading.Lock()
+_stats = {
+    "processed": 0,
+    "failed_attempts": 0,
+    "dead_lettered": 0,
+    "coalesced": 0,
+    "batches": 0,
+    "stale_claims_released": 0,
+    "processing_ms_total": 0.0,
+}
+
+
+def _connect():
+    return mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASS"),
+        database=os.getenv("DB_NAME")
+    )
+
+
+def _bump(key: str, amount=1):
+    with _stats_lock:
+        _stats[key] += amount
+
+
+def backoff_seconds(attempts: int) -> float:
+    """Exponential backoff with jitter for the given attempt number (1-based)."""
+    ceiling = min(WEBHOOK_BACKOFF_MAX_SECONDS, WEBHOOK_BACKOFF_BASE_SECONDS * (2 ** max(0, attempts - 1)))
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def partition_fields(event) -> tuple:
+    """Extracts (customer_id, object_id, created) used for partitioning and coalescing."""
+    obj = event["data"]["object"]
+    if obj.get("object") == "customer":
+        customer_id = obj.get("id")
+    else:
+        customer_id = obj.get("customer")
+    if isinstance(customer_id, dict):  # expanded customer
+        customer_id = customer_id.get("id")
+    if obj.get("object") == "subscription":
+        object_id = obj.get("id")
+    else:
+        object_id = obj.get("subscription")
+    if isinstance(object_id, dict):
+        object_id = object_id.get("id")
+    return customer_id, object_id, event.get("created")
+
+
+def enqueue_event(event_id: str, event_type: str, payload: str,
+                  customer_id: str = None, object_id: str = None, event_created: int = None,
+                  claim_endpoint: str = None) -> bool:
+    """Durably stores a verified event. Returns False if the event was already queued.
+
+    With claim_endpoint, the event_store claim for that endpoint is recorded in
+    the same transaction, and an already claimed event counts as queued.
+    Raises mysql.connector.Error so the endpoint can return 500 and let Stripe
+    retry; nothing (claim included) is kept in that case.
+    """
+    conn = None
+    cursor = None
+    try:
+        conn = _connect()
+        cursor = conn.cursor()
+        if claim_endpoint and not event_store.claim_in(cursor, event_id, event_type, claim_endpoint):
+            event_store.mark_seen(event_id, claim_endpoint)
+            return False
+        now = datetime.utcnow()
+        cursor.execute("""
+            INSERT IGNORE INTO stripe_webhook_events
+                (event_id, event_type, payload, customer_id, object_id, event_created,
+                 status, attempts, next_attempt_at, received_at)
+            VALUES (%s, %s, %s, %s, %s, %s, 'pending', 0, %s, %s)
+        """, (event_id, event_type, payload, customer_id, object_id, event_created, now, now))
+        inserted = cursor.rowcount == 1
+        conn.commit()
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+
+    if claim_endpoint:
+        event_store.mark_seen(event_id, claim_endpoint)
+    if inserted:
+        # Wakes the dispatcher, whichever worker process holds it
+        invalidation_bus.publish(QUEUE_WAKEUP_NAMESPACE, None)
+    return inserted
+
+
+# --- Dispatcher ---
+
+def _acquire_leadership(conn) -> bool:
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, 0)", (DISPATCHER_LOCK_NAME,))
+        result = cursor.fetchone()
+        return bool(result and result[0] == 1)
+    finally:
+        cursor.close()
+
+
+def _reset_orphaned_claims(conn) -> int:
+    """Events left 'processing' by a previous dispatcher go back to the queue."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            UPDATE stripe_webhook_events SET status = 'pending', locked_at = NULL WHERE status = 'processing'
+        """)
+        conn.commit()
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def release_stale_claims(conn) -> int:
+    """Returns events stuck in 'processing' past the visibility timeout to the queue."""
+    cursor = conn.cursor()
+    try:
+        now = datetime.utcnow()
+        cursor.execute("""
+            UPDATE stripe_webhook_events
+            SET status = 'pending', locked_at = NULL, next_attempt_at = %s
+            WHERE status = 'processing' AND (locked_at < %s OR locked_at IS NULL)
+        """, (now, now - timedelta(seconds=WEBHOOK_VISIBILITY_TIMEOUT_SECONDS)))
+        conn.commit()
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def _fetch_batch(conn) -> list:
+    """Returns due events in order, skipping customers with an event waiting on a retry or still claimed."""
+    cursor = conn.cursor(dictionary=True)
+    try:
+        now = datetime.utcnow()
+        cursor.execute("""
+            SELECT DISTINCT customer_id
+            FROM stripe_webhook_events
+            WHERE ((status = 'pending' AND next_attempt_at > %s) OR status = 'processing')
+              AND customer_id IS NOT NULL
+        """, (now,))
+        blocked = {row["customer_id"] for row in cursor.fetchall()}
+
+        cursor.execute("""
+            SELECT event_id, event_type, payload, attempts, customer_id, object_id
+            FROM stripe_webhook_events
+            WHERE status = 'pending' AND next_attempt_at <= %s
+            ORDER BY event_created, received_at
+            LIMIT %s
+        """, (now, WEBHOOK_BATCH_SIZE))
+        rows = [r for r in cursor.fetchall() if r["customer_id"] not in blocked]
+        conn.commit()
+        return rows
+    finally:
+        cursor.close()
+
+
+def coalesce(rows: list) -> tuple:
+    """Splits an ordered batch into (to_process, superseded) lists."""
+    latest = {}
+    for i, row in enumerate(rows):
+        if row["object_id"] and row["event_type"] in SUPERSEDING_TYPES:
+            latest[row["object_id"]] = i
+
+    keep, superseded = [], []
+    for i, row in enumerate(rows):
+        if (row["event_type"] in COALESCIBLE_TYPES and row["object_id"]
+                and latest.get(row["object_id"], i) > i):
+            superseded.append((row, rows[latest[row["object_id"]]]["event_id"]))
+        else:
+            keep.append(row)
+    return keep, superseded
+
+
+def _set_status(conn, event_ids: list, status: str, note: str = None):
+    if not event_ids:
+        return
+    cursor = conn.cursor()
+    try:
+        placeholders = ", ".join(["%s"] * len(event_ids))
+        if status in ("done", "coalesced"):
+            cursor.execute(f"""
+                UPDATE stripe_webhook_events
+                SET status = %s, processed_at = %s, locked_at = NULL, last_error = %s
+                WHERE event_id IN ({placeholders})
+            """, (status, datetime.utcnow(), note, *event_ids))
+        else:
+            # A claim records when it was taken, for the visibility timeout
+            locked_at = datetime.utcnow() if status == "processing" else None
+            cursor.execute(f"""
+                UPDATE stripe_webhook_events SET status = %s, locked_at = %s WHERE event_id IN ({placeholders})
+            """, (status, locked_at, *event_ids))
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def _partition(rows: list) -> dict:
+    partitions = {}
+    for row in rows:
+        key = row["customer_id"] or row["event_id"]
+        partitions.setdefault(key, []).append(row)
+    return partitions
+
+
+def _dispatch_batch(conn) -> bool:
+    """Claims, coalesces and runs one batch. Returns False when nothing was due."""
+    rows = _fetch_batch(conn)
+    if not rows:
+        return False
+
+    keep, superseded = coalesce(rows)
+    for row, winner in superseded:
+        _set_status(conn, [row["event_id"]], "coalesced", f"Superseded by {winner}")
+    if superseded:
+        _bump("coalesced", len(superseded))
+
+    _set_status(conn, [r["event_id"] for r in keep], "processing")
+    claimed = time.monotonic()
+
+    pending = []
+    for key, events in _partition(keep).items():
+        done = threading.Event()
+        slot = zlib.crc32(key.encode("utf-8")) % len(_worker_queues)
+        _worker_queues[slot].put((events, done, claimed))
+        pending.append(done)
+
+    # Barrier: the next batch may contain later events of the same customers.
+    # Bounded by the visibility timeout; customers still running stay blocked in
+    # _fetch_batch by their 'processing' rows until they finish or are released.
+    deadline = claimed + WEBHOOK_VISIBILITY_TIMEOUT_SECONDS
+    for done in pending:
+        while not done.wait(1.0):
+            if _stopping.is_set() and not any(t.is_alive() for t in _worker_threads):
+                return True
+            if time.monotonic() > deadline:
+                stuck = sum(1 for d in pending if not d.is_set())
+                print(f"⚠️ [Queue] {stuck} partition(s) still running after {WEBHOOK_VISIBILITY_TIMEOUT_SECONDS}s; dispatching past them.")
+                _bump("batches")
+                return True
+    _bump("batches")
+    return True
+
+
+def _dispatcher_loop():
+    conn = None
+    is_leader = False
+    last_prune = 0.0
+    while not _stopping.is_set():
+        try:
+            if conn is None or not conn.is_connected():
+                conn = _connect()
+                is_leader = False
+            if not is_leader:
+                is_leader = _acquire_leadership(conn)
+                if is_leader:
+                    reset = _reset_orphaned_claims(conn)
+                    print(f"✅ [Queue] This worker is now the webhook dispatcher (reset {reset} orphaned claim(s)).")
+            if is_leader:
+                released = release_stale_claims(conn)
+                if released:
+                    _bump("stale_claims_released", released)
+                    print(f"⚠️ [Queue] Released {released} stale webhook claim(s).")
+                if time.monotonic() - last_prune >= CLAIM_PRUNE_INTERVAL_SECONDS:
+                    last_prune = time.monotonic()
+                    pruned = event_store.prune(conn)
+                    if pruned:
+                        print(f"🧹 [Queue] Pruned {pruned} expired event claim(s).")
+            if is_leader and _dispatch_batch(conn):
+                continue
+        except mysql.connector.Error as err:
+            print(f"🔥 [Queue] DB error in webhook dispatcher: {err}")
+            if conn:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            conn = None
+            is_leader = False
+        except Exception as e:
+            print(f"🔥 [Queue] Unexpected error in webhook dispatcher: {e}")
+
+        _wakeup.wait(WEBHOOK_POLL_INTERVAL_SECONDS)
+        _wakeup.clear()
+
+    if conn and conn.is_connected():
+        conn.close()  # Releases the named lock
+
+
+# --- Workers ---
+
+def _mark_done(conn, event_id: str, attempts: int):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            UPDATE stripe_webhook_events
+            SET status = 'done', attempts = %s, processed_at = %s, locked_at = NULL, last_error = NULL
+            WHERE event_id = %s
+        """, (attempts, datetime.utcnow(), event_id))
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def _mark_failed(conn, event_id: str, attempts: int, error: str) -> str:
+    """Schedules a retry, or dead-letters the event once it is out of attempts."""
+    status = "dead" if attempts >= WEBHOOK_MAX_ATTEMPTS else "pending"
+    next_attempt = datetime.utcnow() + timedelta(seconds=backoff_seconds(attempts))
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            UPDATE stripe_webhook_events
+            SET status = %s, attempts = %s, next_attempt_at = %s, locked_at = NULL, last_error = %s
+            WHERE event_id = %s
+        """, (status, attempts, next_attempt, error[:2000], event_id))
+        conn.commit()
+    finally:
+        cursor.close()
+    return status
+
+
+def _run_partition(conn, handler: Callable[[dict], None], events: list, claimed: float = None):
+    """Handles a customer's events in order, stopping at the first failure.
+
+    Also stops once the claim is older than the visibility timeout: the sweep
+    has returned, or will return, the remaining events to the queue.
+    """
+    for i, row in enumerate(events):
+        if claimed is not None and time.monotonic() - claimed > WEBHOOK_VISIBILITY_TIMEOUT_SECONDS:
+            print(f"⚠️ [Queue] Claim on {len(events) - i} event(s) expired before they ran; left to the sweep.")
+            return
+        attempts = row["attempts"] + 1
+        started = time.perf_counter()
+        try:
+            handler(json.loads(row["payload"]))
+        except Exception as e:
+            status = _mark_failed(conn, row["event_id"], attempts, f"{type(e).__name__}: {e}")
+            _bump("failed_attempts")
+            if status == "dead":
+                _bump("dead_lettered")
+                print(f"☠️ [Queue] Event {row['event_id']} ({row['event_type']}) dead-lettered after {attempts} attempts: {e}")
+            else:
+                print(f"🔁 [Queue] Event {row['event_id']} ({row['event_type']}) failed attempt {attempts}, will retry: {e}")
+            if status != "dead":
+                # Later events for this customer wait behind the retry
+                _set_status(conn, [r["event_id"] for r in events[i + 1:]], "pending")
+                return
+            continue
+
+        _mark_done(conn, row["event_id"], attempts)
+        with _stats_lock:
+            _stats["processed"] += 1
+            _stats["processing_ms_total"] += (time.perf_counter() - started) * 1000
+
+
+def _worker_loop(handler: Callable[[dict], None], work: queue.Queue, worker_no: int):
+    conn = None
+    while True:
+        item = work.get()
+        if item is None:
+            break
+        events, done, claimed = item
+        try:
+            if conn is None or not conn.is_connected():
+                conn = _connect()
+            _run_partition(conn, handler, events, claimed)
+        except mysql.connector.Error as err:
+            # Status updates failed; the dispatcher's sweep returns these claims to the queue
+            # once the visibility timeout passes
+            print(f"🔥 [Queue] DB error in webhook worker {worker_no}: {err}")
+            conn = None
+        except Exception as e:
+            print(f"🔥 [Queue] Unexpected error in webhook worker {worker_no}: {e}")
+        finally:
+            done.set()
+
+    if conn and conn.is_connected():
+        conn.close()
+
+
+def start_workers(handler: Callable[[dict], None], num_workers: int = None):
+    """Starts the dispatcher and worker pool for this process."""
+    global _dispatcher
+    num_workers = WEBHOOK_QUEUE_WORKERS if num_workers is None else num_workers
+    if _dispatcher or num_workers <= 0:
+        return
+    _stopping.clear()
+    for i in range(num_workers):
+        work = queue.Queue()
+        t = threading.Thread(target=_worker_loop, args=(handler, work, i), name=f"webhook-worker-{i}", daemon=True)
+        t.start()
+        _worker_queues.append(work)
+        _worker_threads.append(t)
+    _dispatcher = threading.Thread(target=_dispatcher_loop, name="webhook-dispatcher", daemon=True)
+    _dispatcher.start()
+    print(f"✅ [Queue] Started webhook dispatcher with {num_workers} worker(s).")
+
+
+def stop_workers(timeout: float = 10.0):
+    """Stops the dispatcher, lets in-flight partitions finish and stops the workers."""
+    global _dispatcher
+    _stopping.set()
+    _wakeup.set()
+    if _dispatcher:
+        _dispatcher.join(timeout=timeout)
+        _dispatcher = None
+    for work in _worker_queues:
+        work.put(None)
+    for t in _worker_threads:
+        t.join(timeout=timeout)
+    _worker_queues.clear()
+    _worker_threads.clear()
+
+
+def requeue_dead(event_id: str = None) -> int:
+    """Moves dead-lettered events (one, or all) back to pending with a fresh attempt budget."""
+    conn = None
+    cursor = None
+    try:
+        conn = _connect()
+        cursor = conn.cursor()
+        query = """
+            UPDATE stripe_webhook_events
+            SET status = 'pending', attempts = 0, next_attempt_at = %s, last_error = NULL
+            WHERE status = 'dead'
+        """
+        params = [datetime.utcnow()]
+        if event_id:
+            query += " AND event_id = %s"
+            params.append(event_id)
+        cursor.execute(query, tuple(params))
+        conn.commit()
+        count = cursor.rowcount
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+    if count:
+        invalidation_bus.publish(QUEUE_WAKEUP_NAMESPACE, None)
+    return count
+
+
+def queue_metrics() -> dict:
+    """Queue depth by status plus this process's dispatcher/worker counters."""
+    conn = None
+    cursor = None
+    depth = {"pending": 0, "processing": 0, "done": 0, "coalesced": 0, "dead": 0}
+    oldest_pending_seconds = None
+    try:
+        conn = _connect()
+        cursor = conn.cursor()
+        cursor.execute("SELECT status, COUNT(*) FROM stripe_webhook_events GROUP BY status")
+        for status, count in cursor.fetchall():
+            depth[status] = count
+        cursor.execute("SELECT MIN(received_at) FROM stripe_webhook_events WHERE status = 'pending'")
+        result = cursor.fetchone()
+        if result and result[0]:
+            oldest_pending_seconds = int((datetime.utcnow() - result[0]).total_seconds())
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+
+    with _stats_lock:
+        stats = dict(_stats)
+    processed_ms = stats.pop("processing_ms_total")
+    stats["avg_processing_ms"] = round(processed_ms / stats["processed"], 2) if stats["processed"] else 0.0
+    return {
+        "depth": depth,
+        "oldest_pending_seconds": oldest_pending_seconds,
+        "dispatcher_alive": bool(_dispatcher and _dispatcher.is_alive()),
+        "workers_alive": sum(1 for t in _worker_threads if t.is_alive()),
+        "worker_queue_sizes": [q.qsize() for q in _worker_queues],
+        "worker_stats": stats,
+    }
+
+
+invalidation_bus.subscribe(QUEUE_WAKEUP_NAMESPACE, lambda _key: _wakeup.set())